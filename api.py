@@ -0,0 +1,332 @@
+"""Versioned JSON API for Warbler, under /api/v1.
+
+Read-only endpoints for the home timeline, users, their messages, followers,
+following and likes, and single messages, for clients that would otherwise
+scrape the HTML pages. Requests are authenticated by the same session as the
+website.
+
+- Responses are compact JSON: {"data": ...}, plus "next_cursor" on lists.
+- `fields` selects which fields of each item to return, e.g.
+  ?fields=id,text,timestamp. Fields that cost a query of their own
+  ("liked", "is_following") are only looked up when selected.
+- Lists are paginated with the same cursors as the pages (see
+  pagination.py): pass a response's next_cursor as `cursor` for the next
+  page, and `limit` to change the page size.
+- Every response has an ETag, and a request whose If-None-Match matches
+  it gets an empty 304 instead of the body.
+
+Likes are set with PUT (like) and DELETE (unlike) on
+/messages/<id>/like. Both are idempotent, and written behind within
+LIKE_FLUSH_SECONDS (see like_buffer.py), in order for changes that reach
+the same worker. Browsers only send PUT and DELETE
+cross-origin after a CORS preflight, which this API doesn't answer, so they
+need no CSRF token.
+"""
+
+import json
+
+from flask import Blueprint, Response, g, request
+from sqlalchemy.orm import joinedload
+from werkzeug.exceptions import BadRequest, HTTPException, NotFound
+from werkzeug.exceptions import Unauthorized
+
+from like_buffer import LikeBuffer
+from models import db, Follow, Like, Message, User
+from pagination import paginate
+import timeline
+
+api = Blueprint('api_v1', __name__, url_prefix='/api/v1')
+
+like_buffer = LikeBuffer()
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 100
+
+
+##############################################################################
+# Serialization
+#
+# Each kind of item has a dict of field name -> function(item, context)
+# returning the field's value. The context holds lookups shared by a whole
+# page of items, made once per page.
+
+
+def author(user):
+    return {'id': user.id, 'username': user.username,
+            'image_url': user.image_url}
+
+
+USER_FIELDS = {
+    'id': lambda user, context: user.id,
+    'username': lambda user, context: user.username,
+    'image_url': lambda user, context: user.image_url,
+    'header_image_url': lambda user, context: user.header_image_url,
+    'bio': lambda user, context: user.bio,
+    'location': lambda user, context: user.location,
+    'messages_count': lambda user, context: user.messages_count,
+    'followers_count': lambda user, context: user.followers_count,
+    'following_count': lambda user, context: user.following_count,
+    'likes_count': lambda user, context: user.likes_count,
+    'is_following':
+        lambda user, context: user.id in context['following_ids'],
+}
+
+MESSAGE_FIELDS = {
+    'id': lambda msg, context: msg.id,
+    'text': lambda msg, context: msg.text,
+    'timestamp': lambda msg, context: msg.timestamp.isoformat(),
+    'user_id': lambda msg, context: msg.user_id,
+    'user': lambda msg, context: author(msg.user),
+    'liked': lambda msg, context: msg.id in context['liked_ids'],
+}
+
+
+def selected_fields(fields):
+    """Return the names of the fields of `fields` asked for by the request."""
+
+    return parse_fields(fields, request.args.get('fields'))
+
+
+def parse_fields(fields, asked):
+    """Return the names of the fields of `fields` in the `fields` param
+    `asked`.
+
+    All of them if it's missing; 400 if it names any that don't exist.
+    """
+
+    if not asked:
+        return list(fields)
+
+    names = [name.strip() for name in asked.split(',') if name.strip()]
+    unknown = [name for name in names if name not in fields]
+    if unknown:
+        raise BadRequest(f"Unknown fields: {', '.join(unknown)}. "
+                         f"Available: {', '.join(fields)}.")
+
+    return names
+
+
+def serialize(items, fields, names, context):
+    """Return the `names` fields of each of `items`, from `fields`."""
+
+    return [{name: fields[name](item, context) for name in names}
+            for item in items]
+
+
+def serialize_users(users):
+    names = selected_fields(USER_FIELDS)
+
+    context = {}
+    if 'is_following' in names:
+        context['following_ids'] = g.user.following_ids_among(
+            user.id for user in users)
+
+    return serialize(users, USER_FIELDS, names, context)
+
+
+def serialize_messages(messages):
+    names = selected_fields(MESSAGE_FIELDS)
+
+    context = {}
+    if 'liked' in names:
+        context['liked_ids'] = Like.like_state_among(
+            g.user.id, (msg.id for msg in messages)).liked_ids
+
+    return serialize(messages, MESSAGE_FIELDS, names, context)
+
+
+def dumps(payload):
+    """Return `payload` as compact JSON."""
+
+    return json.dumps(payload, separators=(',', ':'), ensure_ascii=False)
+
+
+def json_response(payload):
+    """Return `payload` as compact JSON, or a 304 if the client has it."""
+
+    response = Response(dumps(payload), mimetype='application/json')
+
+    # Revalidate with the ETag every time, rather than not storing it at all
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+def page_response(page, serialize):
+    return json_response({'data': serialize(page.items),
+                          'next_cursor': page.next_cursor})
+
+
+##############################################################################
+# Request helpers
+
+
+@api.record_once
+def init_like_buffer(state):
+    like_buffer.init_app(state.app)
+
+
+@api.before_request
+def require_login():
+    if not g.user:
+        raise Unauthorized()
+
+
+# 404 is named too, or the app's own 404 page would take precedence
+@api.errorhandler(HTTPException)
+@api.errorhandler(404)
+def json_error(e):
+    return Response(dumps(error_payload(e)), status=e.code,
+                    mimetype='application/json')
+
+
+def error_payload(e):
+    """The JSON body describing HTTPException `e`."""
+
+    return {'error': {'code': e.code, 'message': e.description}}
+
+
+def page_args(args):
+    """Return the (cursor, limit) requested for a list in query `args`."""
+
+    try:
+        limit = int(args.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        raise BadRequest("limit must be a number.")
+
+    return args.get('cursor'), max(1, min(limit, MAX_LIMIT))
+
+
+def get_user_or_404(user_id):
+    user = db.session.get(User, user_id)
+
+    if user is None or user.deleted_at is not None:
+        raise NotFound("No such user.")
+
+    return user
+
+
+def messages_query():
+    """Messages, with their authors if the "user" field is selected."""
+
+    query = Message.query
+
+    if 'user' in selected_fields(MESSAGE_FIELDS):
+        query = query.options(joinedload(Message.user))
+
+    return query
+
+
+##############################################################################
+# Endpoints
+
+
+@api.get('/timeline')
+def home_timeline():
+    """Messages by the current user and those they follow, newest first."""
+
+    cursor, limit = page_args(request.args)
+    page = timeline.home_timeline(g.user, cursor, limit)
+
+    return page_response(page, serialize_messages)
+
+
+@api.get('/users/<int:user_id>')
+def show_user(user_id):
+    user = get_user_or_404(user_id)
+
+    return json_response({'data': serialize_users([user])[0]})
+
+
+@api.get('/users/<int:user_id>/messages')
+def user_messages(user_id):
+    """A user's messages, newest first."""
+
+    user = get_user_or_404(user_id)
+    cursor, limit = page_args(request.args)
+    page = paginate(messages_query().filter_by(user_id=user.id),
+                    (Message.timestamp, Message.id), cursor, limit)
+
+    return page_response(page, serialize_messages)
+
+
+@api.get('/users/<int:user_id>/following')
+def user_following(user_id):
+    """Users this user follows, in order of id."""
+
+    user = get_user_or_404(user_id)
+    cursor, limit = page_args(request.args)
+    following = (User
+                 .query
+                 .join(Follow, Follow.user_being_followed_id == User.id)
+                 .filter(Follow.user_following_id == user.id,
+                         User.deleted_at.is_(None)))
+    page = paginate(following, (User.id,), cursor, limit, descending=False)
+
+    return page_response(page, serialize_users)
+
+
+@api.get('/users/<int:user_id>/followers')
+def user_followers(user_id):
+    """Users following this user, in order of id."""
+
+    user = get_user_or_404(user_id)
+    cursor, limit = page_args(request.args)
+    followers = (User
+                 .query
+                 .join(Follow, Follow.user_following_id == User.id)
+                 .filter(Follow.user_being_followed_id == user.id,
+                         User.deleted_at.is_(None)))
+    page = paginate(followers, (User.id,), cursor, limit, descending=False)
+
+    return page_response(page, serialize_users)
+
+
+@api.get('/users/<int:user_id>/likes')
+def user_likes(user_id):
+    """Messages this user has liked, newest first."""
+
+    user = get_user_or_404(user_id)
+    cursor, limit = page_args(request.args)
+    liked = (messages_query()
+             .join(Like, Like.message_id == Message.id)
+             .filter(Like.user_id == user.id))
+    page = paginate(liked, (Message.timestamp, Message.id), cursor, limit)
+
+    return page_response(page, serialize_messages)
+
+
+@api.get('/messages/<int:message_id>')
+def show_message(message_id):
+    msg = messages_query().filter_by(id=message_id).first()
+
+    if msg is None:
+        raise NotFound("No such message.")
+
+    return json_response({'data': serialize_messages([msg])[0]})
+
+
+@api.put('/messages/<int:message_id>/like')
+def like_message(message_id):
+    """Like a message. Liking it again does nothing."""
+
+    return set_like(message_id, True)
+
+
+@api.delete('/messages/<int:message_id>/like')
+def unlike_message(message_id):
+    """Unlike a message. Unliking one that isn't liked does nothing."""
+
+    return set_like(message_id, False)
+
+
+def set_like(message_id, liked):
+    if db.session.get(Message, message_id) is None:
+        raise NotFound("No such message.")
+
+    like_buffer.set(g.user.id, message_id, liked)
+
+    return json_response({'data': {'message_id': message_id,
+                                   'liked': liked}})
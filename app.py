@@ -1,19 +1,37 @@
+import hmac
 import os
 from dotenv import load_dotenv
 
-from flask import Flask, render_template, request, flash, redirect, session, g, jsonify
+from flask import Flask, render_template, request, flash, redirect, session, g, jsonify, abort, make_response
 from flask_debugtoolbar import DebugToolbarExtension
+from sqlalchemy import select
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 from werkzeug.exceptions import Unauthorized
 
 
 from forms import UserAddForm, LoginForm, MessageForm, EditProfileForm, BlankForm
-from models import db, connect_db, User, Message, Like, DEFAULT_HEADER_IMAGE_URL, DEFAULT_IMAGE_URL
+from models import db, connect_db, hasher, User, Message, Like, Follow, DEFAULT_HEADER_IMAGE_URL, DEFAULT_IMAGE_URL
+import timeline
+from search import search_users, search_messages, autocomplete_users
+from user_cache import UserCache
+from fragment_cache import FragmentCache
+from instrumentation import Instrumentation
+from api import api
+from replicas import ReplicaRouter
+from pooling import engine_options, pool_stats
+from assets import Assets
+from http_cache import conditional, viewer_version
+from pagination import paginate
+from pubsub import MessageHub, default_broker
 
 load_dotenv()
 
 CURR_USER_KEY = "curr_user"
 
+MESSAGES_PER_PAGE = 50
+USERS_PER_PAGE = 60
+
 app = Flask(__name__)
 
 ## Use this line if local!
@@ -28,11 +46,121 @@ app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL').replace("postgres://", "postgresql://", 1)
 
 app.config['SQLALCHEMY_ECHO'] = False
+
+# Connection pool sizing, from the connection budget shared by the web
+# workers (see pooling.py)
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options()
+
+# Read replicas for the read-only views, as a comma separated list of URLs.
+# Replicas more than REPLICA_MAX_LAG_SECONDS behind, as measured every
+# REPLICA_LAG_CHECK_SECONDS, aren't used (see replicas.py).
+app.config['DATABASE_REPLICA_URLS'] = [
+    url.strip().replace("postgres://", "postgresql://", 1)
+    for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+    if url.strip()
+]
+app.config['REPLICA_MAX_LAG_SECONDS'] = float(
+    os.environ.get('REPLICA_MAX_LAG_SECONDS', 5))
+app.config['REPLICA_LAG_CHECK_SECONDS'] = float(
+    os.environ.get('REPLICA_LAG_CHECK_SECONDS', 5))
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
 #toolbar = DebugToolbarExtension(app)
 
+# Cache of logged-in users' rows. Set USER_CACHE_DIR to share it between
+# worker processes on the same host.
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 10000))
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 60))
+app.config['USER_CACHE_DIR'] = os.environ.get('USER_CACHE_DIR')
+
+# Cache of rendered message items and user cards (see fragment_cache.py)
+app.config['FRAGMENT_CACHE_SIZE'] = int(
+    os.environ.get('FRAGMENT_CACHE_SIZE', 10000))
+app.config['FRAGMENT_CACHE_TTL'] = int(
+    os.environ.get('FRAGMENT_CACHE_TTL', 3600))
+
+# Password hashing runs on its own process pool, one per host under gunicorn
+# (see hashing.py); HASH_WORKERS defaults to the number of CPUs
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['HASH_WORKERS'] = (int(os.environ['HASH_WORKERS'])
+                              if 'HASH_WORKERS' in os.environ else None)
+app.config['HASH_MAX_PENDING'] = int(os.environ.get('HASH_MAX_PENDING', 32))
+app.config['HASH_QUEUE_TIMEOUT'] = float(os.environ.get('HASH_QUEUE_TIMEOUT', 2))
+
+# Accounts with at least this many messages are deleted by tombstoning them
+# and leaving the rows for `flask purge-deleted-users`, so the request
+# returns straight away
+app.config['PURGE_IN_BACKGROUND_MESSAGES'] = int(
+    os.environ.get('PURGE_IN_BACKGROUND_MESSAGES', 1000))
+app.config['PURGE_BATCH_SIZE'] = int(os.environ.get('PURGE_BATCH_SIZE', 5000))
+
+# Requests slower than this are logged with their slowest SQL, for a
+# sample of them (see instrumentation.py). /metrics requires METRICS_TOKEN
+# as a bearer token, and is turned off (404) unless it's set.
+app.config['SLOW_REQUEST_SECONDS'] = float(
+    os.environ.get('SLOW_REQUEST_SECONDS', 1))
+app.config['SLOW_REQUEST_SAMPLE_RATE'] = float(
+    os.environ.get('SLOW_REQUEST_SAMPLE_RATE', 1))
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+
+# Where gunicorn workers pool their metrics, so /metrics on any of them
+# reports them all (see instrumentation.py); by default a temporary
+# directory gunicorn.conf.py makes for each run.
+app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR')
+
+# Likes set through the API are written in batches, at most this many
+# seconds later, or sooner once LIKE_BUFFER_SIZE are waiting (see
+# like_buffer.py). 0 writes each in its own request.
+app.config['LIKE_FLUSH_SECONDS'] = float(
+    os.environ.get('LIKE_FLUSH_SECONDS', 0.5))
+app.config['LIKE_BUFFER_SIZE'] = int(os.environ.get('LIKE_BUFFER_SIZE', 1000))
+
+# Most like changes kept waiting while writes fail (say, with the database
+# down); beyond it, requests to change a like get a 503.
+app.config['LIKE_BUFFER_LIMIT'] = int(
+    os.environ.get('LIKE_BUFFER_LIMIT', 10000))
+
+# New messages are pushed to the home timelines open in browsers by ASGI
+# workers (see asgi.py), through PUBSUB_BROKER: by default 'local' for one
+# worker, 'postgres' for several (see pubsub.py). They hold each stream open
+# for SSE_STREAM_SECONDS, sending a heartbeat every SSE_HEARTBEAT_SECONDS.
+# Sync workers can't, so browsers poll them every SSE_POLL_SECONDS instead,
+# and nothing is published ('none').
+app.config['PUBSUB_BROKER'] = os.environ.get('PUBSUB_BROKER',
+                                             default_broker())
+app.config['PUBSUB_DATABASE_URL'] = os.environ.get(
+    'PUBSUB_DATABASE_URL', '').replace("postgres://", "postgresql://", 1)
+app.config['SSE_POLL_SECONDS'] = float(os.environ.get('SSE_POLL_SECONDS', 15))
+app.config['SSE_STREAM_SECONDS'] = float(
+    os.environ.get('SSE_STREAM_SECONDS', 300))
+app.config['SSE_HEARTBEAT_SECONDS'] = float(
+    os.environ.get('SSE_HEARTBEAT_SECONDS', 15))
+
 connect_db(app)
+hasher.init_app(app)
+
+replicas = ReplicaRouter()
+replicas.init_app(app, db)
+
+instrumentation = Instrumentation()
+instrumentation.init_app(app, db.engine, hasher)
+for engine in replicas.engines:
+    instrumentation.watch_engine(engine)
+
+app.register_blueprint(api)
+
+# Fingerprinted static files, if built with build_assets.py
+assets = Assets()
+assets.init_app(app)
+
+user_cache = UserCache.from_config(app.config)
+user_cache.watch(db.session)
+
+fragment_cache = FragmentCache.from_config(app.config)
+fragment_cache.init_app(app)
+
+message_hub = MessageHub()
+message_hub.init_app(app, db.session)
 
 
 ##############################################################################
@@ -43,15 +171,20 @@ connect_db(app)
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    if request.endpoint == 'asset':
+        # Built assets are the same for everyone, and cached publicly, so
+        # mustn't touch the session (or they'd get Vary: Cookie, or set one)
+        g.user = None
+    elif CURR_USER_KEY in session:
+        g.user = user_cache.load(session[CURR_USER_KEY])
     else:
         g.user = None
 
 
 @app.before_request
 def add_csrf():
-    g.csrf_form = BlankForm()
+    if request.endpoint != 'asset':
+        g.csrf_form = BlankForm()
 
 
 
@@ -66,6 +199,49 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
+def wants_next_page():
+    """Is this an infinite-scroll request for the next page, as JSON?"""
+
+    best = request.accept_mimetypes.best_match(['text/html', 'application/json'])
+    return best == 'application/json'
+
+
+def render_page(template, items_template, page, **context):
+    """Render a paginated page.
+
+    Infinite-scroll requests get just the rendered items and the cursor for
+    the page after; everything else gets the full page.
+    """
+
+    if wants_next_page():
+        return jsonify({
+            'html': render_template(items_template, **context),
+            'next_cursor': page.next_cursor,
+        })
+
+    return render_template(template, next_cursor=page.next_cursor, **context)
+
+
+def like_context(messages):
+    """Template context with the like state of a page of `messages`, for
+    messages/items.html."""
+
+    likes = Like.like_state_among(g.user.id, (msg.id for msg in messages))
+
+    return {'liked_message_ids': likes.liked_ids, 'like_counts': likes.counts}
+
+
+def get_user_or_404(user_id):
+    """Return the user with `user_id`, or 404 if missing or tombstoned."""
+
+    user = User.query.get_or_404(user_id)
+
+    if user.deleted_at is not None:
+        abort(404)
+
+    return user
+
+
 
 @app.route('/signup', methods=["GET", "POST"])
 def signup():
@@ -121,6 +297,7 @@ def login():
         )
 
         if user:
+            db.session.commit() # saves the password hash if it was upgraded
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -150,10 +327,13 @@ def logout():
 # General user routes:
 
 @app.get('/users')
+@replicas.reads_from_replica
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search users by username,
+    location and bio (best matches first), and a 'cursor' param to continue
+    from a previous page.
     """
     form = g.csrf_form
 
@@ -163,15 +343,69 @@ def list_users():
 
     search = request.args.get('q')
 
-    if not search:
-        users = User.query.all()
+    if search:
+        page = search_users(search, request.args.get('cursor'),
+                            USERS_PER_PAGE)
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        page = paginate(User.query.filter_by(deleted_at=None), (User.id,),
+                        request.args.get('cursor'), USERS_PER_PAGE,
+                        descending=False)
+
+    following_ids = g.user.following_ids_among(u.id for u in page.items)
+
+    return render_page('users/index.html', 'users/cards.html', page,
+                       users=page.items,
+                       following_ids=following_ids,
+                       form=form)
+
+
+@app.get('/users/autocomplete')
+def autocomplete():
+    """Suggest users whose username starts with the 'q' param, as JSON."""
+
+    if not g.user:
+        raise Unauthorized()
+
+    users = autocomplete_users(request.args.get('q'))
+
+    return jsonify([
+        {'id': user.id, 'username': user.username, 'image_url': user.image_url}
+        for user in users
+    ])
+
+
+def profile_version(user_id):
+    """Version stamp of a profile page (see http_cache.py)."""
 
-    return render_template('users/index.html', users=users, form=form)
+    if not g.user:
+        return None
+
+    user = get_user_or_404(user_id)
+
+    # Likes don't touch any user's row, so the stamp includes the like
+    # counts of the page's messages; show_user reuses the page
+    g.profile_page = profile_page(user)
+    like_counts = g.profile_page[1]['like_counts']
+
+    return ((user.id, user.version, sorted(like_counts.items()))
+            + viewer_version())
+
+
+def profile_page(user):
+    """Return the page of `user`'s messages asked for, and the like_context
+    of its messages."""
+
+    page = paginate(Message.query.filter_by(user_id=user.id),
+                    (Message.timestamp, Message.id),
+                    request.args.get('cursor'),
+                    MESSAGES_PER_PAGE)
+
+    return page, like_context(page.items)
 
 
 @app.get('/users/<int:user_id>')
+@replicas.reads_from_replica
+@conditional(profile_version)
 def show_user(user_id):
     """Show user profile."""
 
@@ -181,17 +415,21 @@ def show_user(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    messages = (Message
-                .query
-                .filter_by(user_id=user.id)
-                .order_by(Message.timestamp.desc())
-                .all())
+    user = get_user_or_404(user_id)
+    page, likes = g.pop('profile_page', None) or profile_page(user)
+
+    following_ids = g.user.following_ids_among([user.id])
 
-    return render_template('users/show.html', user=user, form=form, messages=messages)
+    return render_page('users/show.html', 'messages/items.html', page,
+                       user=user,
+                       form=form,
+                       following_ids=following_ids,
+                       messages=page.items,
+                       **likes)
 
 
 @app.get('/users/<int:user_id>/following')
+@replicas.reads_from_replica
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -201,11 +439,27 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user, form=form)
+    user = get_user_or_404(user_id)
+    following = (User
+                 .query
+                 .join(Follow, Follow.user_being_followed_id == User.id)
+                 .filter(Follow.user_following_id == user.id,
+                         User.deleted_at.is_(None)))
+    page = paginate(following, (User.id,), request.args.get('cursor'),
+                    USERS_PER_PAGE, descending=False)
+
+    following_ids = g.user.following_ids_among(
+        [user.id] + [u.id for u in page.items])
+
+    return render_page('users/following.html', 'users/cards.html', page,
+                       user=user,
+                       users=page.items,
+                       following_ids=following_ids,
+                       form=form)
 
 
 @app.get('/users/<int:user_id>/followers')
+@replicas.reads_from_replica
 def show_followers(user_id):
     """Show list of followers of this user."""
 
@@ -215,8 +469,23 @@ def show_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user, form=form)
+    user = get_user_or_404(user_id)
+    followers = (User
+                 .query
+                 .join(Follow, Follow.user_following_id == User.id)
+                 .filter(Follow.user_being_followed_id == user.id,
+                         User.deleted_at.is_(None)))
+    page = paginate(followers, (User.id,), request.args.get('cursor'),
+                    USERS_PER_PAGE, descending=False)
+
+    following_ids = g.user.following_ids_among(
+        [user.id] + [u.id for u in page.items])
+
+    return render_page('users/followers.html', 'users/cards.html', page,
+                       user=user,
+                       users=page.items,
+                       following_ids=following_ids,
+                       form=form)
 
 
 @app.post('/users/follow/<int:follow_id>')
@@ -231,8 +500,11 @@ def start_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    followed_user = get_user_or_404(follow_id)
+    g.user.follow(followed_user)
+    db.session.flush()
+    timeline.mark_high_fanout(followed_user.id)
+    timeline.backfill_author(g.user.id, followed_user.id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -254,7 +526,8 @@ def stop_following(follow_id):
 
     if form.validate_on_submit():
         followed_user = User.query.get_or_404(follow_id)
-        g.user.following.remove(followed_user)
+        g.user.unfollow(followed_user)
+        timeline.remove_author(g.user.id, followed_user.id)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}/following")
@@ -284,6 +557,8 @@ def profile():
                 user.bio = form.bio.data
 
                 db.session.commit()
+                user_cache.invalidate(user.id)
+                fragment_cache.invalidate(('user', user.id))
                 return redirect(f'/users/{g.user.id}')
 
             else:
@@ -301,7 +576,8 @@ def profile():
 def delete_user():
     """Delete user.
 
-    Redirect to signup page.
+    Accounts with many messages are tombstoned, and their rows are removed
+    later by `flask purge-deleted-users`. Redirect to signup page.
     """
     form = g.csrf_form
 
@@ -309,16 +585,14 @@ def delete_user():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    Like.query.filter_by(user_id=g.user.id).delete()
-
-    #for each message in user's messages, we have message.likes, and delete
-    for message in g.user.messages:
-        Like.query.filter_by(message_id = message.id).delete()
-
-    Message.query.filter_by(user_id=g.user.id).delete()
+    if g.user.messages_count >= app.config['PURGE_IN_BACKGROUND_MESSAGES']:
+        g.user.tombstone()
+    else:
+        g.user.delete_account()
 
-    db.session.delete(g.user)
     db.session.commit()
+    user_cache.invalidate(g.user.id)
+    fragment_cache.invalidate(('user', g.user.id))
     do_logout()
     return redirect("/signup")
 
@@ -344,6 +618,10 @@ def add_message():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        User.adjust_counts([g.user.id], messages_count=1)
+        db.session.flush()
+        timeline.fan_out_message(msg)
+        message_hub.publish(db.session, msg)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -351,7 +629,60 @@ def add_message():
     return render_template('messages/create.html', form=form)
 
 
+@app.get('/messages/search')
+def message_search():
+    """Search messages, newest first.
+
+    Takes a 'q' param (see search.parse_message_query), a 'following' param
+    to only search messages by users we follow, and a 'cursor' param to
+    continue from a previous page.
+    """
+
+    form = g.csrf_form
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    q = request.args.get('q', '')
+    following_only = bool(request.args.get('following'))
+
+    page = search_messages(q, request.args.get('cursor'), MESSAGES_PER_PAGE,
+                           following=g.user if following_only else None)
+
+    return render_page('messages/search.html', 'messages/items.html', page,
+                       q=q,
+                       following_only=following_only,
+                       messages=page.items,
+                       form=form,
+                       **like_context(page.items))
+
+
+def message_version(message_id):
+    """Version stamp of a message page (see http_cache.py)."""
+
+    if not g.user:
+        return None
+
+    msg = (Message
+           .query
+           .options(joinedload(Message.user))
+           .get_or_404(message_id))
+
+    # Holding on to it lets show_message find it in the session's identity
+    # map, rather than loading it again
+    g.message = msg
+
+    # Its like count changes without touching any user's row
+    g.message_likes = Like.like_state_among(g.user.id, [msg.id])
+
+    return ((msg.id, msg.user.version, g.message_likes.counts.get(msg.id))
+            + viewer_version())
+
+
 @app.get('/messages/<int:message_id>')
+@replicas.reads_from_replica
+@conditional(message_version)
 def show_message(message_id):
     """Show a message."""
 
@@ -361,11 +692,22 @@ def show_message(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get_or_404(message_id)
+    msg = (Message
+           .query
+           .options(joinedload(Message.user))
+           .get_or_404(message_id))
+
+    likes = (g.pop('message_likes', None)
+             or Like.like_state_among(g.user.id, [msg.id]))
 
-    like = Like.query.get((message_id, g.user.id))
+    following_ids = g.user.following_ids_among([msg.user_id])
 
-    return render_template('messages/show.html', like=like, message=msg, form=form)
+    return render_template('messages/show.html',
+                           like=msg.id in likes.liked_ids,
+                           like_count=likes.counts.get(msg.id),
+                           message=msg,
+                           following_ids=following_ids,
+                           form=form)
 
 
 
@@ -385,10 +727,16 @@ def delete_message(message_id):
     msg = Message.query.get_or_404(message_id)
     if msg.user_id == g.user.id:
 
+        User.adjust_counts(
+            select(Like.user_id).where(Like.message_id == msg.id),
+            likes_count=-1)
         Like.query.filter_by(message_id = msg.id).delete()
+        timeline.remove_message(msg.id)
+        User.adjust_counts([g.user.id], messages_count=-1)
 
         db.session.delete(msg)
         db.session.commit()
+        fragment_cache.invalidate(('message', msg.id))
         flash('message deleted', "success")
 
     return redirect(f"/users/{g.user.id}")
@@ -396,37 +744,99 @@ def delete_message(message_id):
 
 
 
+@app.get('/messages/items')
+def message_items():
+    """Render the messages with the given `ids` as home timeline items,
+    newest first, for warbler.js to add to the page."""
+
+    if not g.user:
+        raise Unauthorized()
+
+    ids = [int(id) for id in request.args.get('ids', '').split(',')
+           if id.isdigit()][:MESSAGES_PER_PAGE]
+
+    messages = (Message
+                .query
+                .options(joinedload(Message.user))
+                .filter(Message.id.in_(ids))
+                .order_by(Message.timestamp.desc(), Message.id.desc())
+                .all())
+
+    return render_template('messages/items.html', messages=messages,
+                           **like_context(messages))
+
+
+def events_after():
+    """Return the id of the newest message the browser has, for an event
+    stream: the last event it received, or the `after` param."""
+
+    after = request.headers.get('Last-Event-ID') or request.args.get('after')
+
+    return int(after) if after and after.isdigit() else None
+
+
+def message_events(message_ids):
+    """Return server-sent events for new messages, oldest first."""
+
+    return ''.join(f"id: {id}\ndata: {id}\n\n"
+                   for id in reversed(message_ids))
+
+
+@app.get('/timeline/events')
+def timeline_events():
+    """Server-sent events with the ids of new messages on the home timeline.
+
+    Served by sync workers, it sends those posted since the last the browser
+    received and closes, asking it to reconnect in SSE_POLL_SECONDS: polling,
+    with a query each time, rather than a push through message_hub, which
+    would hold a worker thread per open timeline. asgi.py serves it with a
+    stream held open instead.
+    """
+
+    if not g.user:
+        raise Unauthorized()
+
+    after = events_after()
+    if after is None:
+        message_ids = []
+    else:
+        pulled_ids = db.session.scalars(
+            timeline.pulled_author_ids(g.user.id)).all()
+        message_ids = db.session.scalars(
+            timeline.timeline_ids_after(g.user.id, pulled_ids, after)).all()
+
+    retry = int(app.config['SSE_POLL_SECONDS'] * 1000)
+
+    return (f"retry: {retry}\n\n" + message_events(message_ids), 200,
+            {'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+
+
 ##############################################################################
 # Homepage and error pages
 
 
 @app.get('/')
+@replicas.reads_from_replica
+@conditional(lambda: None if g.user else (), public=True, max_age=300)
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of self & followed_users
+    - logged in: most recent messages of self & followed_users, a page at
+      a time
     """
 
     if g.user:
-        following_ids = [u.id for u in g.user.following]
-        messages = (Message
-                    .query
-                    .filter((Message.user_id==g.user.id) |
-                            (Message.user_id.in_(following_ids)))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-
+        page = timeline.home_timeline(g.user,
+                                      request.args.get('cursor'),
+                                      MESSAGES_PER_PAGE)
 
         form = g.csrf_form
 
-        liked_message_ids = [ message.id for message in g.user.liked_messages]
-
-        return render_template('home.html',
-                               liked_message_ids = liked_message_ids,
-                               user=g.user,
-                               messages=messages, form=form)
+        return render_page('home.html', 'messages/items.html', page,
+                           user=g.user,
+                           messages=page.items, form=form,
+                           **like_context(page.items))
 
     else:
         return render_template('home-anon.html')
@@ -434,17 +844,58 @@ def homepage():
 
 @app.after_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers on every request that hasn't set its own."""
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
+    if 'Cache-Control' not in response.headers:
+        response.cache_control.no_store = True
     return response
 
 @app.errorhandler(404)
 def page_not_found(e):
     form = g.csrf_form
 
-    return render_template('404.html', form=form)
+    # Flashed messages are shown once, so their page can't be reused
+    cacheable = not session.get('_flashes')
+
+    response = make_response(render_template('404.html', form=form), 404)
+
+    if cacheable:
+        response.cache_control.private = True
+        response.cache_control.max_age = 60
+
+    return response
+
+
+##############################################################################
+# Monitoring
+
+
+@app.get('/metrics')
+def metrics():
+    """Request and password hashing metrics, for Prometheus to scrape."""
+
+    token = app.config['METRICS_TOKEN']
+    if not token:
+        abort(404)
+
+    if not hmac.compare_digest(
+            request.headers.get('Authorization', ''), f"Bearer {token}"):
+        raise Unauthorized()
+
+    return (instrumentation.render_metrics(*metric_stats()), 200,
+            {'Content-Type': 'text/plain; version=0.0.4'})
+
+
+def metric_stats():
+    """Return this process's password hashing and connection pool stats, for
+    Instrumentation.render_metrics."""
+
+    pools = {'primary': pool_stats(db.engine)}
+    for i, engine in enumerate(replicas.engines):
+        pools[f'replica{i}'] = pool_stats(engine)
+
+    return hasher.stats(), pools
 
 
 ##############################################################################
@@ -453,7 +904,11 @@ def page_not_found(e):
 
 @app.post('/messages/<int:msg_id>/toggle-like')
 def toggle_like(msg_id):
-    """Toggle a like for current message"""
+    """Toggle a like for current message.
+
+    Kept for old pages; the like buttons now use the idempotent
+    PUT/DELETE /api/v1/messages/<id>/like.
+    """
 
     #CSRF validation is surprisingly tricky. This works for now.
     if not g.user:# or not g.csrf_form.validate_on_submit():
@@ -463,12 +918,10 @@ def toggle_like(msg_id):
 
     like = Like.query.get((msg_id, g.user.id))
 
-    if like:
-        db.session.delete(like)
-        db.session.commit()
-    else:
-        like = Like.create_like(user_id = g.user.id, message_id= msg_id)
-        db.session.commit()
+    # Concurrent toggles (e.g. a double click) may both see the same state;
+    # set_liked makes the second a no-op rather than a duplicate key error
+    Like.set_liked({(g.user.id, msg_id): like is None})
+    db.session.commit()
 
 
     return jsonify({'status': 'ok'})
@@ -480,6 +933,7 @@ def toggle_like(msg_id):
 
 
 @app.get('/users/<int:user_id>/likes')
+@replicas.reads_from_replica
 def show_likes(user_id):
     """Show list of liked warbles of this user."""
 
@@ -489,11 +943,74 @@ def show_likes(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    liked_message_ids = [m.id for m in user.liked_messages]
+    user = get_user_or_404(user_id)
+    liked = (Message
+             .query
+             .options(joinedload(Message.user))
+             .join(Like, Like.message_id == Message.id)
+             .filter(Like.user_id == user.id))
+    page = paginate(liked, (Message.timestamp, Message.id),
+                    request.args.get('cursor'), MESSAGES_PER_PAGE)
+
+    following_ids = g.user.following_ids_among([user.id])
+
+    return render_page('users/likes.html', 'messages/items.html', page,
+                       user=user,
+                       form=form,
+                       following_ids=following_ids,
+                       messages=page.items,
+                       **like_context(page.items))
+
+##############################################################################
+# Maintenance commands (run with `flask <command>`):
+
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters():
+    """Repair drift in the denormalized user counters."""
+
+    repaired = User.reconcile_counts()
+    db.session.commit()
+
+    print(f"Repaired counters for {repaired} user(s).")
+
+
+@app.cli.command('backfill-timelines')
+def backfill_timelines():
+    """Switch authors whose following has fallen below FANOUT_RESUME_LIMIT
+    back to fan out on write (see timeline.py).
+
+    Copies each one's recent messages into their followers' inboxes, one
+    author per transaction. Run it periodically; safe to stop and rerun.
+    """
+
+    author_ids = db.session.scalars(timeline.dropped_author_ids()).all()
+    switched = 0
+
+    for author_id in author_ids:
+        switched += timeline.backfill_dropped_author(author_id)
+        db.session.commit()
+
+    print(f"Switched {switched} author(s) back to fan out on write.")
+
+
+@app.cli.command('purge-deleted-users')
+def purge_deleted_users():
+    """Delete the rows of tombstoned accounts (see delete_user).
+
+    Works through each account's messages in batches of PURGE_BATCH_SIZE,
+    committing between them to keep transactions short. Safe to stop and
+    rerun.
+    """
+
+    batch_size = app.config['PURGE_BATCH_SIZE']
+    tombstoned = User.query.filter(User.deleted_at.isnot(None)).all()
+
+    for user in tombstoned:
+        while user.purge_messages(batch_size):
+            db.session.commit()
+
+        user.delete_account()
+        db.session.commit()
 
-    return render_template('users/likes.html',
-                           user=user,
-                           form=form,
-                           liked_message_ids=liked_message_ids,
-                           messages=user.liked_messages)
\ No newline at end of file
+    print(f"Purged {len(tombstoned)} deleted user(s).")
@@ -0,0 +1,393 @@
+"""Warbler as an ASGI app, with async versions of the hottest API routes.
+
+A sync worker spends most of a request to the JSON API waiting on Postgres,
+and can't take another request meanwhile. Served from here, these routes
+run as coroutines on an async engine (asyncpg), so one worker keeps many of
+them waiting on the database at once:
+
+- GET /api/v1/timeline
+- GET /api/v1/users/<id> and /api/v1/users/<id>/messages
+- GET /api/v1/messages/<id>
+- PUT and DELETE /api/v1/messages/<id>/like
+- GET /timeline/events, held open as a stream of new messages
+
+They answer exactly as their Flask versions in api.py do, built from the
+same queries and serializers. Every other request goes to the Flask app,
+run in a pool of GUNICORN_THREADS threads, so the rest of the site works
+as before.
+
+Serve it with WEB_ASYNC=1, which has gunicorn.conf.py run uvicorn workers
+and splits each worker's database connections between the two engines (see
+pooling.py):
+
+    WEB_ASYNC=1 gunicorn --config gunicorn.conf.py
+
+Unlike their Flask versions, the async routes read from the primary even
+when read replicas are configured, and aren't counted in /metrics. Their
+writes pin the browser to the primary, as Flask's do (see replicas.py), so
+its next reads through Flask see them.
+"""
+
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from functools import wraps
+
+from a2wsgi import WSGIMiddleware
+from itsdangerous import BadSignature
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import joinedload
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.exceptions import HTTPException, NotFound, Unauthorized
+from werkzeug.http import generate_etag, parse_etags, quote_etag
+
+from api import (MESSAGE_FIELDS, USER_FIELDS, dumps, error_payload,
+                 like_buffer, page_args, parse_fields, serialize)
+from app import (app as flask_app, message_events, message_hub, replicas,
+                 user_cache, CURR_USER_KEY)
+from models import Follow, Like, Message, User
+from pagination import page_of, page_query
+from pooling import async_engine_options
+from replicas import PRIMARY_UNTIL
+from timeline import (TIMELINE_KEYS, followed_ids, home_timeline_query,
+                      pulled_author_ids, timeline_ids_after)
+from user_cache import row_of
+
+
+def async_url(url):
+    """Return database `url` with the async driver."""
+
+    return make_url(url).set(drivername='postgresql+asyncpg')
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Made in each worker, after gunicorn has forked it
+    engine = create_async_engine(
+        async_url(flask_app.config['SQLALCHEMY_DATABASE_URI']),
+        **async_engine_options())
+    app.state.sessions = async_sessionmaker(engine, expire_on_commit=False)
+
+    try:
+        yield
+    finally:
+        await engine.dispose()
+
+
+##############################################################################
+# Request helpers
+
+
+def load_session(request):
+    """Return the Flask session's contents, empty if there isn't a valid
+    one."""
+
+    cookie = request.cookies.get(flask_app.config['SESSION_COOKIE_NAME'])
+    if not cookie:
+        return {}
+
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    max_age = int(flask_app.permanent_session_lifetime.total_seconds())
+
+    try:
+        return serializer.loads(cookie, max_age=max_age)
+    except BadSignature:
+        return {}
+
+
+def session_user_id(request):
+    """Return the id of the user logged in to the Flask session, if any."""
+
+    return load_session(request).get(CURR_USER_KEY)
+
+
+def pin_to_primary(request, response):
+    """Have the browser read from the primary for as long as a replica could
+    be missing what it just wrote, as ReplicaRouter does after Flask's
+    writes."""
+
+    if not replicas.replicas:
+        return response
+
+    interface = flask_app.session_interface
+    session = interface.session_class(load_session(request))
+    session[PRIMARY_UNTIL] = time.time() + replicas.pin_seconds
+
+    response.set_cookie(
+        flask_app.config['SESSION_COOKIE_NAME'],
+        interface.get_signing_serializer(flask_app).dumps(dict(session)),
+        expires=interface.get_expiration_time(flask_app, session),
+        path=interface.get_cookie_path(flask_app),
+        domain=interface.get_cookie_domain(flask_app),
+        secure=interface.get_cookie_secure(flask_app),
+        httponly=interface.get_cookie_httponly(flask_app),
+        samesite=interface.get_cookie_samesite(flask_app))
+
+    return response
+
+
+async def load_user(session, user_id):
+    """Return `user_id`'s row, or None if they don't exist or have been
+    deleted (as UserCache.load)."""
+
+    row = user_cache.get_row(user_id)
+    if row is not None:
+        return row
+
+    user = await session.get(User, user_id)
+    if user is None or user.deleted_at is not None:
+        return None
+
+    row = row_of(user)
+    user_cache.set_row(user_id, row)
+
+    return row
+
+
+def api_view(view):
+    """Call `view` with an async session and the logged in user's id, or
+    answer 401 if no one is."""
+
+    @wraps(view)
+    async def endpoint(request):
+        async with request.app.state.sessions() as session:
+            viewer_id = session_user_id(request)
+
+            if (viewer_id is None
+                    or await load_user(session, viewer_id) is None):
+                raise Unauthorized()
+
+            return await view(request, session, viewer_id,
+                              **request.path_params)
+
+    return endpoint
+
+
+async def json_error(request, e):
+    return Response(dumps(error_payload(e)), status_code=e.code,
+                    media_type='application/json')
+
+
+def json_response(request, payload):
+    """Return `payload` as compact JSON, or a 304 if the client has it."""
+
+    body = dumps(payload).encode()
+    etag = generate_etag(body)
+
+    headers = {'ETag': quote_etag(etag), 'Cache-Control': 'private, no-cache'}
+
+    if parse_etags(request.headers.get('if-none-match')).contains(etag):
+        return Response(status_code=304, headers=headers)
+
+    return Response(body, media_type='application/json', headers=headers)
+
+
+async def ids_among(session, query, viewer_id, ids):
+    """Return the set of `ids` selected by `query(viewer_id, ids)`."""
+
+    if not ids:
+        return set()
+
+    return set(await session.scalars(query(viewer_id, ids)))
+
+
+async def serialize_users(request, session, viewer_id, users):
+    names = parse_fields(USER_FIELDS, request.query_params.get('fields'))
+
+    context = {}
+    if 'is_following' in names:
+        context['following_ids'] = await ids_among(
+            session, Follow.followed_among, viewer_id,
+            [user.id for user in users])
+
+    return serialize(users, USER_FIELDS, names, context)
+
+
+async def serialize_messages(request, session, viewer_id, messages):
+    names = parse_fields(MESSAGE_FIELDS, request.query_params.get('fields'))
+
+    context = {}
+    if 'liked' in names:
+        context['liked_ids'] = await ids_among(
+            session, Like.liked_among, viewer_id,
+            [msg.id for msg in messages])
+
+    return serialize(messages, MESSAGE_FIELDS, names, context)
+
+
+async def page_response(request, session, viewer_id, page):
+    return json_response(request, {
+        'data': await serialize_messages(request, session, viewer_id,
+                                         page.items),
+        'next_cursor': page.next_cursor,
+    })
+
+
+async def get_user_or_404(session, user_id):
+    user = await session.get(User, user_id)
+
+    if user is None or user.deleted_at is not None:
+        raise NotFound("No such user.")
+
+    return user
+
+
+##############################################################################
+# Endpoints
+
+
+@api_view
+async def home_timeline(request, session, viewer_id):
+    cursor, limit = page_args(request.query_params)
+
+    pulled_ids = (await session.scalars(pulled_author_ids(viewer_id))).all()
+    query = home_timeline_query(viewer_id, pulled_ids, cursor, limit)
+    page = page_of((await session.scalars(query)).all(), TIMELINE_KEYS, limit)
+
+    return await page_response(request, session, viewer_id, page)
+
+
+@api_view
+async def show_user(request, session, viewer_id, user_id):
+    user = await get_user_or_404(session, user_id)
+    users = await serialize_users(request, session, viewer_id, [user])
+
+    return json_response(request, {'data': users[0]})
+
+
+@api_view
+async def user_messages(request, session, viewer_id, user_id):
+    user = await get_user_or_404(session, user_id)
+    cursor, limit = page_args(request.query_params)
+
+    # Every message's author is `user`, already in the session, so isn't
+    # loaded again
+    keys = (Message.timestamp, Message.id)
+    query = page_query(select(Message).where(Message.user_id == user.id),
+                       keys, cursor, limit)
+    page = page_of((await session.scalars(query)).all(), keys, limit)
+
+    return await page_response(request, session, viewer_id, page)
+
+
+@api_view
+async def show_message(request, session, viewer_id, message_id):
+    msg = await session.scalar(select(Message)
+                               .options(joinedload(Message.user))
+                               .where(Message.id == message_id))
+
+    if msg is None:
+        raise NotFound("No such message.")
+
+    messages = await serialize_messages(request, session, viewer_id, [msg])
+
+    return json_response(request, {'data': messages[0]})
+
+
+@api_view
+async def set_like(request, session, viewer_id, message_id):
+    """Like (PUT) or unlike (DELETE) a message, as api.set_like."""
+
+    if await session.get(Message, message_id) is None:
+        raise NotFound("No such message.")
+
+    liked = request.method == 'PUT'
+
+    if like_buffer.flush_seconds:
+        like_buffer.set(viewer_id, message_id, liked)
+    else:
+        # Written in the request, by the sync engine
+        await run_in_threadpool(write_like, viewer_id, message_id, liked)
+
+    return pin_to_primary(request, json_response(
+        request, {'data': {'message_id': message_id, 'liked': liked}}))
+
+
+def write_like(user_id, message_id, liked):
+    with flask_app.app_context():
+        like_buffer.set(user_id, message_id, liked)
+
+
+@api_view
+async def timeline_events(request, session, viewer_id):
+    """Server-sent events with the ids of new messages on the home timeline,
+    as app.timeline_events, but streamed as they're posted.
+
+    The stream closes after SSE_STREAM_SECONDS, so the browser reconnects
+    and picks up any authors followed since.
+    """
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+
+    author_ids = [viewer_id, *await session.scalars(followed_ids(viewer_id))]
+
+    # Subscribed before catching up, so nothing posted in between is missed
+    subscription = message_hub.subscribe(
+        author_ids, lambda id: loop.call_soon_threadsafe(queue.put_nowait, id))
+
+    try:
+        after = (request.headers.get('last-event-id')
+                 or request.query_params.get('after'))
+
+        caught_up = []
+        if after and after.isdigit():
+            pulled_ids = (await session.scalars(
+                pulled_author_ids(viewer_id))).all()
+            caught_up = (await session.scalars(timeline_ids_after(
+                viewer_id, pulled_ids, int(after)))).all()
+    except BaseException:
+        message_hub.unsubscribe(subscription)
+        raise
+
+    async def stream():
+        try:
+            yield message_events(caught_up)
+
+            deadline = loop.time() + flask_app.config['SSE_STREAM_SECONDS']
+            heartbeat = flask_app.config['SSE_HEARTBEAT_SECONDS']
+
+            while (remaining := deadline - loop.time()) > 0:
+                try:
+                    id = await asyncio.wait_for(queue.get(),
+                                                min(heartbeat, remaining))
+                except asyncio.TimeoutError:
+                    # Keeps proxies from closing an idle stream
+                    if loop.time() < deadline:
+                        yield ": heartbeat\n\n"
+                    continue
+
+                if id not in caught_up:
+                    yield message_events([id])
+        finally:
+            message_hub.unsubscribe(subscription)
+
+    return StreamingResponse(stream(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache'})
+
+
+##############################################################################
+
+
+app = Starlette(
+    routes=[
+        Route('/api/v1/timeline', home_timeline),
+        Route('/api/v1/users/{user_id:int}', show_user),
+        Route('/api/v1/users/{user_id:int}/messages', user_messages),
+        Route('/api/v1/messages/{message_id:int}', show_message),
+        Route('/api/v1/messages/{message_id:int}/like', set_like,
+              methods=['PUT', 'DELETE']),
+        Route('/timeline/events', timeline_events),
+        Mount('/', WSGIMiddleware(
+            flask_app,
+            workers=max(1, int(os.environ.get('GUNICORN_THREADS', 1))))),
+    ],
+    exception_handlers={HTTPException: json_error},
+    lifespan=lifespan,
+)
@@ -0,0 +1,96 @@
+"""Serve the fingerprinted static files built by build_assets.py.
+
+Templates link to static files with asset_url('stylesheets/style.css'). Once
+the files have been built, that's their fingerprinted copy under /assets/,
+served with a year-long `immutable` Cache-Control, so browsers never ask for
+it again: a changed file gets a new name. Clients that accept them get the
+prebuilt brotli or gzip variant. Without a build (e.g. while working on the
+files locally), asset_url() links to the file under /static/ as usual.
+"""
+
+import json
+import mimetypes
+import os
+
+from flask import current_app, request, send_from_directory, url_for
+
+from build_assets import MANIFEST_NAME
+
+ONE_YEAR = 365 * 24 * 60 * 60
+
+# Prebuilt variants, in order of preference
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+class Assets:
+    """Links to and serves the built static files."""
+
+    def __init__(self):
+        self.directory = None
+        self.manifest = {}
+        self.encodings = {}
+
+    def init_app(self, app):
+        """Load the build in ASSETS_DIR (default static/dist) if there is one,
+        and add the /assets/ route and asset_url() template function."""
+
+        app.config.setdefault('ASSETS_DIR',
+                              os.path.join(app.static_folder, 'dist'))
+        self.load(app.config['ASSETS_DIR'])
+
+        app.add_url_rule('/assets/<path:filename>', 'asset', self.send)
+        app.add_template_global(self.url, 'asset_url')
+
+    def load(self, directory):
+        """Use the build in `directory`, or none if it hasn't been built."""
+
+        self.directory = directory
+
+        try:
+            with open(os.path.join(directory, MANIFEST_NAME)) as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            self.manifest = {}
+
+        self.encodings = {
+            path: [(encoding, suffix) for encoding, suffix in ENCODINGS
+                   if os.path.isfile(os.path.join(directory, path + suffix))]
+            for path in self.manifest.values()
+        }
+
+    def url(self, filename):
+        """Return the URL of static file `filename`, fingerprinted if built."""
+
+        path = self.manifest.get(filename)
+
+        if path is None:
+            return url_for('static', filename=filename)
+
+        return url_for('asset', filename=path)
+
+    def send(self, filename):
+        """Serve a built file, precompressed if the client accepts it."""
+
+        # Not the app's 404 page, which would need the session
+        if filename not in self.encodings:
+            return current_app.response_class(status=404)
+
+        encoding, suffix = next(
+            ((encoding, suffix) for encoding, suffix in self.encodings[filename]
+             if request.accept_encodings[encoding]),
+            (None, ''))
+
+        response = send_from_directory(
+            self.directory, filename + suffix,
+            mimetype=mimetypes.guess_type(filename)[0],
+            max_age=ONE_YEAR)
+
+        if encoding:
+            response.content_encoding = encoding
+        if self.encodings[filename]:
+            response.vary.add('Accept-Encoding')
+
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+
+        return response
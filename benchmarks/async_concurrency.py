@@ -0,0 +1,224 @@
+"""Compare how many concurrent API requests one worker serves, sync vs async.
+
+Starts the app with gunicorn, one worker at a time: first a sync worker (the
+baseline, with --threads threads), then a uvicorn worker serving asgi.py
+(WEB_ASYNC=1). Each is driven by 1, then 2, 4 ... up to --clients
+concurrent clients for --seconds each, all making a weighted mix of the
+routes asgi.py runs async (MIX) as random users, and the throughput and
+p50/p95 latency at each level are printed side by side.
+
+Latencies are measured by the clients, over HTTP, so they include the web
+server. The clients run on the same machine as the server and database, so
+with few CPUs they compete with them; compare the two modes with each other
+rather than with other machines' results. The async worker gains by
+overlapping requests' waits on the database, so it shows most with the
+database on another machine, as in production; against a local one on a
+machine with a CPU or two, both modes spend their time computing.
+
+Like load_test.py, this seeds (dropping and recreating every table) the
+database it's pointed at, unless given --reuse:
+
+    DATABASE_URL=postgresql:///warbler_bench python benchmarks/async_concurrency.py
+"""
+
+import argparse
+import http.client
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from random import Random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy import text  # noqa: E402
+
+from app import app, db, CURR_USER_KEY  # noqa: E402
+
+from load_test import percentile, seed_dataset  # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+
+# Relative frequency of each kind of request
+MIX = {
+    'GET /api/v1/timeline': 50,
+    'GET /api/v1/users/<id>': 20,
+    'GET /api/v1/messages/<id>': 15,
+    'PUT /api/v1/messages/<id>/like': 15,
+}
+
+
+def request_for(name, rng, size):
+    """Return the (method, path) of a random request of kind `name`."""
+
+    method, route = name.split(' ')
+    kind = 'users' if '/users/' in route else 'messages'
+
+    return method, route.replace('<id>', str(rng.randint(1, size[kind])))
+
+
+def session_cookie(user_id):
+    serializer = app.session_interface.get_signing_serializer(app)
+    return (f"{app.config['SESSION_COOKIE_NAME']}="
+            f"{serializer.dumps({CURR_USER_KEY: user_id})}")
+
+
+##############################################################################
+# Server
+
+
+def start_server(port, asynchronous, threads):
+    """Start one gunicorn worker on `port`; return its process once it
+    answers."""
+
+    env = dict(os.environ,
+               WEB_CONCURRENCY='1',
+               GUNICORN_THREADS=str(threads),
+               WEB_ASYNC='1' if asynchronous else '0')
+
+    server = subprocess.Popen(
+        ['gunicorn', '--config', 'gunicorn.conf.py',
+         '--bind', f"127.0.0.1:{port}", '--log-level', 'warning'],
+        cwd=ROOT, env=env)
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/api/v1/timeline')
+            conn.getresponse().read()
+            return server
+        except OSError:
+            time.sleep(0.2)
+
+    stop_server(server)
+    raise RuntimeError("The server didn't start")
+
+
+def stop_server(server):
+    server.send_signal(signal.SIGTERM)
+    server.wait()
+
+
+##############################################################################
+# Clients
+
+
+def run_client(port, rng, size, until, samples):
+    """Make requests from the mix until `until`, appending a (seconds, ok)
+    sample for each to `samples`."""
+
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    names = list(MIX)
+    weights = list(MIX.values())
+
+    while time.monotonic() < until:
+        name = rng.choices(names, weights)[0]
+        method, path = request_for(name, rng, size)
+        headers = {'Cookie': session_cookie(rng.randint(1, size['users']))}
+
+        start = time.perf_counter()
+        try:
+            conn.request(method, path, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            ok = response.status in (200, 404)
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            ok = False
+        samples.append((time.perf_counter() - start, ok))
+
+
+def run_level(port, size, clients, seconds, seed_value):
+    """Drive the server with `clients` clients; return their stats."""
+
+    samples = []
+    until = time.monotonic() + seconds
+    threads = [
+        threading.Thread(target=run_client, args=(
+            port, Random(f"{seed_value}:{i}"), size, until, samples))
+        for i in range(clients)
+    ]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_seconds = time.perf_counter() - start
+
+    latencies = [elapsed * 1000 for elapsed, _ in samples]
+    return {
+        'requests': len(samples),
+        'errors': sum(not ok for _, ok in samples),
+        'rps': len(samples) / wall_seconds,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+    }
+
+
+##############################################################################
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--follows', type=int, default=50000)
+    parser.add_argument('--likes', type=int, default=50000)
+    parser.add_argument('--reuse', action='store_true',
+                        help="use the data already in the database")
+    parser.add_argument('--clients', type=int, default=64,
+                        help="the most concurrent clients to try")
+    parser.add_argument('--seconds', type=float, default=10,
+                        help="how long to run each level for")
+    parser.add_argument('--threads', type=int, default=1,
+                        help="threads in the sync worker")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with app.app_context():
+        if not args.reuse:
+            seed_dataset(args)
+
+        size = {
+            'users': db.session.scalar(text("SELECT max(id) FROM users")),
+            'messages': db.session.scalar(text("SELECT max(id) FROM messages")),
+        }
+
+    levels = [1]
+    while levels[-1] * 2 <= args.clients:
+        levels.append(levels[-1] * 2)
+
+    results = {}
+    for mode, asynchronous in (('sync', False), ('async', True)):
+        server = start_server(args.port, asynchronous, args.threads)
+        try:
+            # Warm up the pools and caches
+            run_level(args.port, size, 4, 1, f"warmup:{args.seed}")
+
+            for clients in levels:
+                results[mode, clients] = run_level(
+                    args.port, size, clients, args.seconds, args.seed)
+                print(f"{mode} x{clients}: "
+                      f"{results[mode, clients]['rps']:.0f} req/s",
+                      flush=True)
+        finally:
+            stop_server(server)
+
+    print(f"\n{'clients':>7}  {'sync rps':>9}{'p50':>9}{'p95':>9}"
+          f"  {'async rps':>9}{'p50':>9}{'p95':>9}{'errs':>6}")
+
+    for clients in levels:
+        sync, asyn = results['sync', clients], results['async', clients]
+        print(f"{clients:>7}  {sync['rps']:>9.1f}{sync['p50_ms']:>7.1f}ms"
+              f"{sync['p95_ms']:>7.1f}ms  {asyn['rps']:>9.1f}"
+              f"{asyn['p50_ms']:>7.1f}ms{asyn['p95_ms']:>7.1f}ms"
+              f"{sync['errors'] + asyn['errors']:>6}")
+
+
+if __name__ == '__main__':
+    main()
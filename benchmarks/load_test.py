@@ -0,0 +1,387 @@
+"""Load test Warbler's main routes and record the results.
+
+Seeds a synthetic dataset (see query_plans.py), then drives the app through
+Flask's test client with a weighted mix of requests (MIX) from randomly
+chosen users, and reports for each route its p50/p95/p99 latency, requests
+per second and SQL statements per request.
+
+Each run is saved as JSON in benchmarks/results/, named by date and commit.
+Pass an earlier run as --baseline to compare against it: routes whose p95
+latency grew by more than --threshold, or which issue more SQL statements,
+are flagged and the script exits non-zero.
+
+This drops and recreates every table in the database it's pointed at, so
+point it at a scratch PostgreSQL database:
+
+    DATABASE_URL=postgresql:///warbler_bench python benchmarks/load_test.py
+    DATABASE_URL=postgresql:///warbler_bench python benchmarks/load_test.py \\
+        --reuse --baseline benchmarks/results/<earlier run>.json
+
+The same --seed and dataset size replay the same requests, so runs on
+different commits are comparable. Latencies are measured in-process, so
+they include the app and database but not a web server or the network.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from random import Random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import bcrypt  # noqa: E402
+from sqlalchemy import event, text  # noqa: E402
+
+from app import app, db, CURR_USER_KEY  # noqa: E402
+from models import User  # noqa: E402
+from timeline import rebuild_timelines  # noqa: E402
+
+from query_plans import WORDS, seed  # noqa: E402
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+# Settings that must match for two runs' results to be comparable
+COMPARABLE_SETTINGS = ['users', 'messages', 'follows', 'likes', 'requests',
+                       'clients', 'seed']
+
+# Every seeded user's password, so the mix can log in as anyone
+PASSWORD = "benchmark"
+
+# Relative frequency of each kind of request
+MIX = {
+    'GET /': 40,
+    'GET /users/<id>': 25,
+    'PUT /api/v1/messages/<id>/like': 15,
+    'GET /users': 10,
+    'POST /login': 5,
+    'POST /messages/new': 5,
+}
+
+
+##############################################################################
+# Requests
+#
+# Each takes a test client, a Random and the dataset size, and makes one
+# request as a random user, returning the response.
+
+
+def log_in_as(client, user_id):
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = user_id
+
+
+def homepage(client, rng, size):
+    log_in_as(client, rng.randint(1, size['users']))
+    return client.get('/')
+
+
+def show_user(client, rng, size):
+    log_in_as(client, rng.randint(1, size['users']))
+    return client.get(f"/users/{rng.randint(1, size['users'])}")
+
+
+def like_message(client, rng, size):
+    log_in_as(client, rng.randint(1, size['users']))
+    return client.put(
+        f"/api/v1/messages/{rng.randint(1, size['messages'])}/like")
+
+
+def list_users(client, rng, size):
+    log_in_as(client, rng.randint(1, size['users']))
+    return client.get('/users')
+
+
+def login(client, rng, size):
+    with client.session_transaction() as sess:
+        sess.pop(CURR_USER_KEY, None)
+
+    return client.post('/login', data={
+        'username': f"user{rng.randint(1, size['users'])}",
+        'password': PASSWORD,
+    })
+
+
+def add_message(client, rng, size):
+    log_in_as(client, rng.randint(1, size['users']))
+    return client.post('/messages/new', data={
+        'text': ' '.join(rng.choices(WORDS, k=rng.randint(3, 12))),
+    })
+
+
+REQUESTS = {
+    'GET /': (homepage, 200),
+    'GET /users/<id>': (show_user, 200),
+    'PUT /api/v1/messages/<id>/like': (like_message, 200),
+    'GET /users': (list_users, 200),
+    'POST /login': (login, 302),
+    'POST /messages/new': (add_message, 302),
+}
+
+
+##############################################################################
+# Running the mix
+
+
+class SQLCounter:
+    """Counts SQL statements executed by the current thread."""
+
+    def __init__(self, engine):
+        self._local = threading.local()
+        event.listen(engine, 'before_cursor_execute', self._record)
+
+    def _record(self, *args):
+        self._local.count = self.count + 1
+
+    @property
+    def count(self):
+        return getattr(self._local, 'count', 0)
+
+    def reset(self):
+        self._local.count = 0
+
+
+def run_client(rng, size, num_requests, sql_counter, samples):
+    """Make `num_requests` requests from the mix, appending a
+    (name, seconds, statements, ok) sample for each to `samples`.
+    """
+
+    client = app.test_client()
+    names = list(MIX)
+    weights = list(MIX.values())
+
+    for name in rng.choices(names, weights, k=num_requests):
+        make_request, expected_status = REQUESTS[name]
+
+        sql_counter.reset()
+        start = time.perf_counter()
+        response = make_request(client, rng, size)
+        elapsed = time.perf_counter() - start
+
+        samples.append((name, elapsed, sql_counter.count,
+                        response.status_code == expected_status))
+
+
+def run_mix(size, num_requests, clients, seed_value, sql_counter):
+    """Run the mix on `clients` threads; return (samples, wall seconds)."""
+
+    samples = []
+    threads = [
+        threading.Thread(target=run_client, args=(
+            Random(f"{seed_value}:{i}"), size, num_requests // clients,
+            sql_counter, samples))
+        for i in range(clients)
+    ]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return samples, time.perf_counter() - start
+
+
+def percentile(values, pct):
+    if len(values) < 2:
+        return values[0]
+    return statistics.quantiles(values, n=100, method='inclusive')[pct - 1]
+
+
+def summarize(samples, wall_seconds):
+    """Return {route: stats} for the samples, plus a 'total' entry."""
+
+    by_route = {name: [] for name in MIX}
+    for sample in samples:
+        by_route[sample[0]].append(sample)
+    by_route['total'] = samples
+
+    summary = {}
+    for name, route_samples in by_route.items():
+        if not route_samples:
+            continue
+
+        latencies = [elapsed * 1000 for _, elapsed, _, _ in route_samples]
+        summary[name] = {
+            'requests': len(route_samples),
+            'errors': sum(not ok for _, _, _, ok in route_samples),
+            'rps': len(route_samples) / wall_seconds,
+            'p50_ms': percentile(latencies, 50),
+            'p95_ms': percentile(latencies, 95),
+            'p99_ms': percentile(latencies, 99),
+            'sql_per_request': statistics.mean(
+                count for _, _, count, _ in route_samples),
+        }
+
+    return summary
+
+
+##############################################################################
+# Reporting
+
+
+def print_summary(summary, baseline=None, threshold=0.2):
+    """Print the results, comparing with `baseline` if given.
+
+    Returns the names of routes that regressed.
+    """
+
+    print(f"\n{'route':<34}{'reqs':>6}{'errs':>6}{'rps':>8}{'p50':>9}"
+          f"{'p95':>9}{'p99':>9}{'SQL':>6}")
+
+    regressed = []
+
+    for name, stats in summary.items():
+        line = (f"{name:<34}{stats['requests']:>6}{stats['errors']:>6}"
+                f"{stats['rps']:>8.1f}{stats['p50_ms']:>7.1f}ms"
+                f"{stats['p95_ms']:>7.1f}ms{stats['p99_ms']:>7.1f}ms"
+                f"{stats['sql_per_request']:>6.1f}")
+
+        before = (baseline or {}).get(name)
+        if before:
+            p95_change = stats['p95_ms'] / before['p95_ms'] - 1
+            line += f"  p95 {p95_change:+.0%}"
+
+            if (p95_change > threshold
+                    or stats['sql_per_request']
+                    > before['sql_per_request'] + 0.5):
+                regressed.append(name)
+                line += "  REGRESSED"
+
+        print(line)
+
+    return regressed
+
+
+def git_commit():
+    """Return (commit hash, whether the tree has uncommitted changes)."""
+
+    def git(*args):
+        return subprocess.run(['git', *args], capture_output=True, text=True,
+                              cwd=os.path.dirname(__file__)).stdout.strip()
+
+    return git('rev-parse', 'HEAD') or 'unknown', bool(git('status',
+                                                           '--porcelain'))
+
+
+def save_results(summary, args):
+    commit, dirty = git_commit()
+    now = datetime.now()
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(
+        RESULTS_DIR,
+        f"{now:%Y%m%d-%H%M%S}-{commit[:10]}{'-dirty' if dirty else ''}.json")
+
+    with open(path, 'w') as results_file:
+        json.dump({
+            'commit': commit,
+            'dirty': dirty,
+            'time': now.isoformat(timespec='seconds'),
+            'settings': vars(args),
+            'routes': summary,
+        }, results_file, indent=2)
+
+    return path
+
+
+##############################################################################
+
+
+def seed_dataset(args):
+    """Seed a fresh dataset where every user's password is PASSWORD."""
+
+    db.drop_all()
+    db.create_all()
+
+    start = time.perf_counter()
+    with db.engine.begin() as conn:
+        # Make random() in the seeding SQL repeatable
+        conn.execute(text("SELECT setseed(0)"))
+        seed(conn, args.users, args.messages, args.follows, args.likes)
+
+        # One hash at the configured cost, so logins don't rehash it
+        hashed = bcrypt.hashpw(
+            PASSWORD.encode('UTF-8'),
+            bcrypt.gensalt(app.config['BCRYPT_LOG_ROUNDS'])).decode('UTF-8')
+        conn.execute(text("UPDATE users SET password = :hashed"),
+                     {'hashed': hashed})
+
+    with app.app_context():
+        User.reconcile_counts()
+        rebuild_timelines()
+        db.session.commit()
+
+    with db.engine.connect() as conn:
+        conn.execute(text("ANALYZE"))
+
+    print(f"Seeded in {time.perf_counter() - start:.1f}s", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--follows', type=int, default=50000)
+    parser.add_argument('--likes', type=int, default=50000)
+    parser.add_argument('--reuse', action='store_true',
+                        help="use the data already in the database")
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--warmup', type=int, default=100,
+                        help="requests to make before measuring")
+    parser.add_argument('--clients', type=int, default=1,
+                        help="threads making requests concurrently")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="the same seed makes the same requests")
+    parser.add_argument('--baseline',
+                        help="results JSON of an earlier run to compare with")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="p95 increase counted as a regression")
+    args = parser.parse_args()
+
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    with app.app_context():
+        if not args.reuse:
+            seed_dataset(args)
+
+        # The mix's random ids must exist, whatever was seeded
+        size = {
+            'users': db.session.scalar(text("SELECT max(id) FROM users")),
+            'messages': db.session.scalar(text("SELECT max(id) FROM messages")),
+        }
+        sql_counter = SQLCounter(db.engine)
+
+    run_mix(size, args.warmup, 1, f"warmup:{args.seed}", sql_counter)
+    samples, wall_seconds = run_mix(size, args.requests, args.clients,
+                                    args.seed, sql_counter)
+
+    summary = summarize(samples, wall_seconds)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            before = json.load(baseline_file)
+        baseline = before['routes']
+
+        changed = [key for key in COMPARABLE_SETTINGS
+                   if before['settings'].get(key) != getattr(args, key)]
+        if changed:
+            print(f"\nNote: the baseline ran with different "
+                  f"{', '.join(changed)}")
+
+    regressed = print_summary(summary, baseline, args.threshold)
+    print(f"\nSaved results to {save_results(summary, args)}")
+
+    if regressed:
+        print(f"Regressed: {', '.join(regressed)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
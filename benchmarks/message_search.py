@@ -0,0 +1,125 @@
+"""Measure message search latency against its targets.
+
+Seeds a synthetic dataset (see query_plans.py), then times search.py's
+search_messages, as the /messages/search route calls it, for each kind of
+query and checks the 95th percentile against LATENCY_TARGETS.
+
+The targets, at the default scale of 200,000 messages:
+
+- a word, prefix or phrase search for the newest page of results: 50ms
+- the same, limited to messages by users one follows: 50ms
+- a later page of results: 50ms
+
+This drops and recreates every table in the database it's pointed at, so
+point it at a scratch PostgreSQL database:
+
+    DATABASE_URL=postgresql:///warbler_bench python benchmarks/message_search.py
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy import func, text  # noqa: E402
+
+from app import db, MESSAGES_PER_PAGE  # noqa: E402
+from models import Follow, User  # noqa: E402
+from search import search_messages  # noqa: E402
+
+from query_plans import WORDS, seed  # noqa: E402
+
+# 95th percentile latency targets in milliseconds
+LATENCY_TARGETS = {
+    'common word': 50,
+    'rare word': 50,
+    'prefix': 50,
+    'phrase': 50,
+    'following only': 50,
+    'second page': 50,
+}
+
+
+def search_cases(follower):
+    """Return {name: search_messages kwargs} for each kind of query."""
+
+    first_page = search_messages(WORDS[0])
+
+    return {
+        'common word': {'q': WORDS[0]},
+        'rare word': {'q': WORDS[-1]},
+        'prefix': {'q': f"{WORDS[-5][:3]}*"},
+        'phrase': {'q': f'"{WORDS[0]} {WORDS[1]}"'},
+        'following only': {'q': WORDS[20], 'following': follower},
+        'second page': {'q': WORDS[0], 'cursor': first_page.next_cursor},
+    }
+
+
+def time_search(runs, **kwargs):
+    """Return (latencies in ms, results on the page) for a search."""
+
+    latencies = []
+
+    for _ in range(runs):
+        db.session.expire_all()
+        start = time.perf_counter()
+        page = search_messages(per_page=MESSAGES_PER_PAGE, **kwargs)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    return latencies, len(page.items)
+
+
+def percentile(values, pct):
+    return statistics.quantiles(values, n=100, method='inclusive')[pct - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--follows', type=int, default=50000)
+    parser.add_argument('--runs', type=int, default=50)
+    args = parser.parse_args()
+
+    db.drop_all()
+    db.create_all()
+
+    start = time.perf_counter()
+    with db.engine.begin() as conn:
+        seed(conn, args.users, args.messages, args.follows, likes=0)
+        conn.execute(text("ANALYZE"))
+    print(f"Seeded in {time.perf_counter() - start:.1f}s\n", flush=True)
+
+    # The user following the most people
+    follower_id = (db.session
+                   .query(Follow.user_following_id)
+                   .group_by(Follow.user_following_id)
+                   .order_by(func.count().desc())
+                   .limit(1)
+                   .scalar())
+    follower = db.session.get(User, follower_id)
+
+    print(f"{'query':<16}{'results':>8}{'p50':>9}{'p95':>9}{'max':>9}"
+          f"{'target':>9}")
+
+    failed = False
+
+    for name, kwargs in search_cases(follower).items():
+        latencies, found = time_search(args.runs, **kwargs)
+        p95 = percentile(latencies, 95)
+        target = LATENCY_TARGETS[name]
+        failed = failed or p95 > target
+
+        print(f"{name:<16}{found:>8}"
+              f"{statistics.median(latencies):>7.1f}ms{p95:>7.1f}ms"
+              f"{max(latencies):>7.1f}ms{target:>7}ms"
+              f"{'' if p95 <= target else '  MISSED'}", flush=True)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
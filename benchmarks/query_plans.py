@@ -0,0 +1,199 @@
+"""Compare query plans for Warbler's hot queries with and without indexes.
+
+Seeds a scaled-up synthetic dataset, then runs EXPLAIN ANALYZE on the query
+shapes behind the homepage, profiles, likes, like toggling, the following
+list and account deletion, first without the secondary indexes from
+migrations/003_hot_query_indexes.sql and then with them.
+
+This drops and recreates every table in the database it's pointed at, so
+point it at a scratch PostgreSQL database:
+
+    DATABASE_URL=postgresql:///warbler_bench python benchmarks/query_plans.py \\
+        --users 2000 --messages 40000 --follows 20000 --likes 20000
+
+Without the index on timelines(message_id), deleting a prolific user's
+messages scans the whole timelines table once per message (for the ON DELETE
+CASCADE), so keep the scale modest: at the size above it takes over a minute
+unindexed and under a second indexed.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy import text  # noqa: E402
+
+from app import db  # noqa: E402
+from models import User  # noqa: E402
+from timeline import rebuild_timelines  # noqa: E402
+
+INDEXES = {
+    'ix_messages_user_id_timestamp':
+        "ON messages (user_id, timestamp, id)",
+    'ix_likes_user_id':
+        "ON likes (user_id, message_id)",
+    'ix_follows_user_following_id':
+        "ON follows (user_following_id, user_being_followed_id)",
+    'ix_timelines_message_id':
+        "ON timelines (message_id)",
+}
+
+# Each query runs with :user_id set to the most prolific user, who also
+# follows and likes the most, and :message_id set to one of their messages.
+QUERIES = {
+    'show_user (profile page)': """
+        SELECT * FROM messages
+        WHERE user_id = :user_id
+        ORDER BY timestamp DESC, id DESC
+        LIMIT 51""",
+    'show_likes (likes page)': """
+        SELECT messages.* FROM messages
+        JOIN likes ON likes.message_id = messages.id
+        WHERE likes.user_id = :user_id
+        ORDER BY messages.timestamp DESC, messages.id DESC
+        LIMIT 51""",
+    'like state (homepage stars)': """
+        SELECT message_id FROM likes WHERE user_id = :user_id""",
+    'toggle_like lookup': """
+        SELECT * FROM likes
+        WHERE message_id = :message_id AND user_id = :user_id""",
+    'show_following': """
+        SELECT users.* FROM users
+        JOIN follows ON follows.user_being_followed_id = users.id
+        WHERE follows.user_following_id = :user_id
+        ORDER BY users.id
+        LIMIT 61""",
+    'homepage (timeline inbox)': """
+        SELECT messages.* FROM messages
+        JOIN timelines ON timelines.message_id = messages.id
+        WHERE timelines.user_id = :user_id
+        ORDER BY timelines.timestamp DESC, timelines.message_id DESC
+        LIMIT 51""",
+    'delete_user (likes by user)': """
+        DELETE FROM likes WHERE user_id = :user_id""",
+    'delete_user (likes on their messages)': """
+        DELETE FROM likes WHERE message_id IN
+            (SELECT id FROM messages WHERE user_id = :user_id)""",
+    'delete_user (their messages)': """
+        WITH likes_on_them AS (
+            DELETE FROM likes WHERE message_id IN
+                (SELECT id FROM messages WHERE user_id = :user_id))
+        DELETE FROM messages WHERE user_id = :user_id""",
+}
+
+
+# Message text is drawn from these, earlier words much more often than later
+# ones, so searches range from very common to rare words
+WORDS = (
+    "the a to and of is in it you that i for on my just so be this with "
+    "day love time good new now today people like all get one more what "
+    "coffee work night morning weekend music game team city rain sun happy "
+    "dog cat food pizza tacos movie book coding python flask warbler bird "
+    "song beach mountain train concert museum garden tea cookie festival "
+    "giraffe volcano saxophone origami quokka zeppelin"
+).split()
+
+
+def seed(conn, users, messages, follows, likes):
+    """Fill the database with a synthetic dataset of the given size."""
+
+    conn.execute(text("""
+        INSERT INTO users (email, username, password, image_url,
+                           header_image_url, bio, location)
+        SELECT 'user' || n || '@example.com', 'user' || n, 'x', '', '', '', ''
+        FROM generate_series(1, :users) AS n"""), {'users': users})
+
+    # Skew authorship, follows and likes so the first users are much more
+    # prolific, followed and active than the rest
+    conn.execute(text("""
+        INSERT INTO messages (text, timestamp, user_id)
+        SELECT (SELECT string_agg(
+                    (:words)[1 + floor(:num_words * random() ^ 3)::int], ' ')
+                FROM generate_series(1, 6 + n % 7)),
+               now() - (n || ' seconds')::interval,
+               1 + floor(:users * random() ^ 2)::int
+        FROM generate_series(1, :messages) AS n"""),
+        {'users': users, 'messages': messages,
+         'words': list(WORDS), 'num_words': len(WORDS)})
+
+    conn.execute(text("""
+        INSERT INTO follows (user_being_followed_id, user_following_id)
+        SELECT DISTINCT 1 + floor(:users * random() ^ 2)::int,
+                        1 + floor(:users * random())::int
+        FROM generate_series(1, :follows)
+        ON CONFLICT DO NOTHING"""), {'users': users, 'follows': follows})
+
+    conn.execute(text("""
+        INSERT INTO likes (message_id, user_id)
+        SELECT DISTINCT 1 + floor(:messages * random())::int,
+                        1 + floor(:users * random() ^ 2)::int
+        FROM generate_series(1, :likes)
+        ON CONFLICT DO NOTHING"""),
+        {'users': users, 'messages': messages, 'likes': likes})
+
+
+def explain(conn, sql, params):
+    """Return the EXPLAIN ANALYZE output for `sql`, without keeping changes."""
+
+    trans = conn.begin_nested()
+    try:
+        rows = conn.execute(text(f"EXPLAIN (ANALYZE, BUFFERS) {sql}"), params)
+        return "\n".join(row[0] for row in rows)
+    finally:
+        trans.rollback()
+
+
+def run_plans(conn, params, label):
+    print(f"\n{'=' * 78}\n{label}\n{'=' * 78}")
+
+    for name, sql in QUERIES.items():
+        print(f"\n--- {name}\n{explain(conn, sql, params)}", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--messages', type=int, default=40000)
+    parser.add_argument('--follows', type=int, default=20000)
+    parser.add_argument('--likes', type=int, default=20000)
+    args = parser.parse_args()
+
+    db.drop_all()
+    db.create_all()
+
+    start = time.perf_counter()
+    with db.engine.begin() as conn:
+        seed(conn, args.users, args.messages, args.follows, args.likes)
+
+    User.reconcile_counts()
+    rebuild_timelines()
+    db.session.commit()
+    print(f"Seeded in {time.perf_counter() - start:.1f}s", flush=True)
+
+    with db.engine.begin() as conn:
+        user_id = conn.scalar(text(
+            "SELECT id FROM users ORDER BY messages_count DESC LIMIT 1"))
+        message_id = conn.scalar(text(
+            "SELECT id FROM messages WHERE user_id = :user_id LIMIT 1"),
+            {'user_id': user_id})
+    params = {'user_id': user_id, 'message_id': message_id}
+
+    with db.engine.begin() as conn:
+        for name in INDEXES:
+            conn.execute(text(f"DROP INDEX {name}"))
+        conn.execute(text("ANALYZE"))
+
+        run_plans(conn, params, "WITHOUT secondary indexes")
+
+        for name, definition in INDEXES.items():
+            conn.execute(text(f"CREATE INDEX {name} {definition}"))
+        conn.execute(text("ANALYZE"))
+
+        run_plans(conn, params, "WITH secondary indexes")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""Build fingerprinted, precompressed copies of the static files.
+
+Every file under static/ is copied to static/dist/ with a hash of its
+contents in its name (style.css -> style.3b1f0c9a2d4e.css), so the copies
+can be cached forever: a changed file gets a new name. References to
+/static/ files in stylesheets are rewritten to the fingerprinted names, and
+text files get gzip (and, if the Brotli package is installed, brotli)
+variants next to them. manifest.json maps each file's path under static/ to
+its fingerprinted path under static/dist/; the app's asset_url() uses it to
+link to them (see assets.py).
+
+Run it whenever the static files change, and on every deploy:
+
+    python build_assets.py
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MANIFEST_NAME = 'manifest.json'
+
+# Files worth compressing; the images are compressed already
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ico', '.json', '.txt'}
+
+STATIC_URL = re.compile(r"""url\((['"]?)/static/([^'")]+)\1\)""")
+
+
+def fingerprinted(path, data):
+    """Return `path` with a hash of `data` before its extension."""
+
+    root, ext = os.path.splitext(path)
+    return f"{root}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+
+
+def rewrite_css(data, manifest):
+    """Point a stylesheet's url(/static/...)s at the fingerprinted files."""
+
+    def replace(match):
+        path = manifest.get(match.group(2))
+        if path is None:
+            return match.group(0)
+        return f"url({match.group(1)}/assets/{path}{match.group(1)})"
+
+    return STATIC_URL.sub(replace, data.decode()).encode()
+
+
+def compress(path, data):
+    """Write the gzip and brotli variants of `data` that are smaller."""
+
+    variants = [('.gz', gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(data)))
+
+    for suffix, compressed in variants:
+        if len(compressed) < len(data):
+            with open(path + suffix, 'wb') as out:
+                out.write(compressed)
+
+
+def build(static_dir='static', out_dir=None):
+    """Build the fingerprinted files of `static_dir` into `out_dir`.
+
+    Returns the manifest. Stylesheets are built last, so the files they
+    refer to already have their names.
+    """
+
+    static_dir = os.path.abspath(static_dir)
+    out_dir = os.path.abspath(out_dir or os.path.join(static_dir, 'dist'))
+
+    # The output directory is replaced, so mustn't hold the sources
+    if os.path.commonpath([static_dir, out_dir]) == out_dir:
+        raise ValueError(f"{out_dir} contains {static_dir}")
+
+    sources = []
+    for dirpath, dirnames, filenames in os.walk(static_dir):
+        dirnames[:] = [name for name in dirnames
+                       if os.path.join(dirpath, name) != out_dir]
+        for filename in filenames:
+            path = os.path.relpath(os.path.join(dirpath, filename),
+                                   static_dir)
+            sources.append(path.replace(os.sep, '/'))
+
+    sources.sort(key=lambda path: (path.endswith('.css'), path))
+
+    if os.path.isdir(out_dir):
+        shutil.rmtree(out_dir)
+
+    manifest = {}
+    for source in sources:
+        with open(os.path.join(static_dir, source), 'rb') as f:
+            data = f.read()
+
+        if source.endswith('.css'):
+            data = rewrite_css(data, manifest)
+
+        manifest[source] = fingerprinted(source, data)
+
+        target = os.path.join(out_dir, manifest[source])
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as out:
+            out.write(data)
+
+        if os.path.splitext(source)[1] in COMPRESSIBLE:
+            compress(target, data)
+
+    with open(os.path.join(out_dir, MANIFEST_NAME), 'w') as out:
+        json.dump(manifest, out, indent=2, sort_keys=True)
+
+    return manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Build fingerprinted, precompressed static files.")
+    parser.add_argument('--static', default='static',
+                        help="directory of static files")
+    parser.add_argument('--out', default=None,
+                        help="output directory (default: <static>/dist)")
+    args = parser.parse_args()
+
+    manifest = build(args.static, args.out)
+
+    print(f"Built {len(manifest)} file(s).")
+    if brotli is None:
+        print("Brotli isn't installed; only gzip variants were built.")
@@ -0,0 +1,79 @@
+"""Cache of rendered message items and user cards.
+
+The same message or user card is rendered on many pages, for many viewers,
+but only a small part of it differs by viewer: the like star of a message,
+the follow button of a user card. FragmentCache renders the rest once and
+keeps it in an in-process LRU, keyed by what the fragment shows and stamped
+with a version that changes whenever that does: the values of the fields it
+renders (e.g. the author's username and image), so changes to anything else,
+such as the counters bumped on every follow or like, leave it be. Entries
+with an older version are treated as missing, so fragments are never stale,
+even in a worker that didn't see the change; routes that change or delete
+something also drop its fragments straight away, to free the memory.
+
+The viewer-specific part (the overlay) is rendered on every use, in the
+place the fragment's template puts `{{ overlay }}`.
+"""
+
+import secrets
+
+from flask import render_template
+from markupsafe import Markup
+
+from user_cache import LRUCache
+
+# Marks the overlay's place in a rendered fragment. User content is escaped,
+# so can't contain it.
+OVERLAY_MARKER = Markup(f"<!--overlay-{secrets.token_hex(8)}-->")
+
+
+class FragmentCache:
+    """Rendered fragments of templates, with a per-viewer overlay."""
+
+    def __init__(self, max_size=10000, ttl=3600):
+        self.fragments = LRUCache(max_size=max_size, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_config(cls, config):
+        """Build a cache from FRAGMENT_CACHE_SIZE and FRAGMENT_CACHE_TTL."""
+
+        return cls(max_size=config['FRAGMENT_CACHE_SIZE'],
+                   ttl=config['FRAGMENT_CACHE_TTL'])
+
+    def init_app(self, app):
+        """Make render() available to templates as `cached_fragment`."""
+
+        app.add_template_global(self.render, 'cached_fragment')
+
+    def render(self, template, key, version, overlay='', **context):
+        """Return `template` rendered with `context`, and `overlay` in it.
+
+        `key` identifies what the fragment shows, e.g. ('message', msg.id),
+        and `version` must change whenever rendering it would give
+        different HTML.
+        """
+
+        entry = self.fragments.get(key)
+
+        if entry is not None and entry[0] == version:
+            self.hits += 1
+            before, after = entry[1]
+        else:
+            self.misses += 1
+            html = render_template(template, overlay=OVERLAY_MARKER, **context)
+            before, _, after = html.partition(OVERLAY_MARKER)
+            self.fragments.set(key, (version, (before, after)))
+
+        return Markup(before) + overlay + Markup(after)
+
+    def invalidate(self, key):
+        """Drop the fragment for `key`, e.g. ('message', msg.id)."""
+
+        self.fragments.delete(key)
+
+    def clear(self):
+        """Drop every fragment."""
+
+        self.fragments.clear()
@@ -2,88 +2,310 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
-"""
+tweak the CSV formats or generate fewer/more rows:
 
-import os
-from dotenv import load_dotenv
+    python generator/create_csvs.py                # the sample data
+    python generator/create_csvs.py --users 1000000 --messages 10000000 \\
+        --follows 20000000 --likes 20000000 --out /data/big
 
-import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
-from helpers import get_random_datetime
+then load them with `python seed.py --dir /data/big`.
 
-load_dotenv()
+It runs offline and the output is reproducible for a given --seed (and
+--epoch, which the timestamps count back from). Rows are
+generated in blocks on a pool of worker processes and written in order, so
+memory use doesn't grow with the size of the data.
 
-UNSPLASH_CID = os.environ['UNSPLASH_CID']
+Like real social networks, the data is skewed: how many messages a user
+writes, how many followers they have, and how many likes a message gets each
+follow a power law, so a few users and messages have most of the activity.
+"""
+
+import argparse
+import csv
+import io
+import os
+import time
+from datetime import datetime
+from itertools import accumulate
+from multiprocessing import Pool
+from random import Random
+
+from helpers import (
+    FIRST_NAMES, LAST_NAMES, CITY_PREFIXES, CITY_NAMES, WORDS,
+    PROFILE_IMAGE_URLS, HEADER_IMAGE_URLS, Scatter, get_random_datetime,
+    hash_fraction, log_normal_length, power_law_rank)
 
 MAX_WARBLER_LENGTH = 140
 
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['message_id', 'user_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
-
-fake = Faker()
-
-# Generate random profile image URLs to use for users
-
-image_urls = [
-    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
-    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
-    for i in range(count)
-]
-
-# Generate random header image URLs to use for users
-# NOTE: You will need to create a dev account at unsplash.com, 
-# generate an access key and set that to an environment
-# variable to successfully ping the API. 
-
-header_image_urls = [
-    requests.get(
-        "https://api.unsplash.com/topics/wallpapers/photos" \
-        f"?per_page=30&orientation=landscape&client_id={UNSPLASH_CID}"
-    ).json()[i]['urls']['regular'] for i in range(0,29)
-]
-
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+NUM_FOLLOWS = 5000
+NUM_LIKES = 1000
+
+# bcrypt hash of "password", shared by every user (hashing millions of
+# passwords would take hours)
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+# Power law (Zipf) exponents: higher is more skewed. Under 1, the most
+# popular of a million users has a few percent of all follows, rather than
+# a large share of them.
+AUTHOR_EXPONENT = 0.8      # messages per user
+FOLLOWED_EXPONENT = 0.9    # followers per user
+LIKED_EXPONENT = 0.9       # likes per message
+WORD_EXPONENT = 1.0        # word frequencies
+
+# Rows per block of work handed to a worker process
+BLOCK_SIZE = 20000
+
+# Timestamps fall in the couple of years before this, unless given --epoch
+DEFAULT_EPOCH = '2024-01-01'
+
+
+class Config:
+    """Settings shared by every block, set in each worker by init_worker."""
+
+    seed = 0
+    now = None
+    num_users = NUM_USERS
+    num_messages = NUM_MESSAGES
+
+    # Map ranks to ids: authors by how much they write, users and messages
+    # by popularity. Authors are ranked independently of popularity, or the
+    # most prolific author would also be the most followed, and their
+    # messages would fill nearly every timeline.
+    author_ids = None
+    user_ids = None
+    message_ids = None
+
+
+def init_worker(seed, now, num_users, num_messages):
+    Config.seed = seed
+    Config.now = now
+    Config.num_users = num_users
+    Config.num_messages = num_messages
+    Config.author_ids = Scatter(num_users, offset=num_users // 2)
+    Config.user_ids = Scatter(num_users)
+    Config.message_ids = Scatter(num_messages)
+
+
+def block_rng(table, start):
+    """Return the random number generator for the block at `start`."""
+
+    return Random(f"{Config.seed}:{table}:{start}")
+
+
+def to_csv(rows):
+    """Return (number of rows, CSV text of the rows)."""
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return len(rows), buffer.getvalue()
+
+
+def author_of(message_id):
+    """Return the id of the user who wrote message `message_id`.
+
+    A pure function of the message id, so blocks of likes can avoid users
+    liking their own messages without reading the messages back.
+    """
+
+    rank = power_law_rank(hash_fraction(Config.seed, message_id),
+                          Config.num_users, AUTHOR_EXPONENT)
+
+    return Config.author_ids(rank)
+
+
+# Zipf weights for WORDS, as cumulative weights for Random.choices
+WORD_WEIGHTS = list(accumulate(
+    1 / rank ** WORD_EXPONENT for rank in range(1, len(WORDS) + 1)))
+
+
+def words(rng, count):
+    return rng.choices(WORDS, cum_weights=WORD_WEIGHTS, k=count)
+
+
+def sentence(rng, median_words):
+    text = ' '.join(words(rng, log_normal_length(rng, median_words, 1, 40)))
+    return text[:1].upper() + text[1:] + '.'
+
+
+##############################################################################
+# Blocks of rows, each generated by a worker
+#
+# Each takes a block of work and returns to_csv's result. Users and messages
+# get ids in the order they're loaded, so their blocks are ranges of ids;
+# follows and likes are split by the id of the follower or liker instead, so
+# that duplicate pairs can be caught within a block.
+
+
+def user_rows(block):
+    start, stop = block
+    rng = block_rng('users', start)
+
+    rows = []
+    for user_id in range(start, stop):
+        username = (f"{rng.choice(FIRST_NAMES)}{rng.choice(LAST_NAMES)}"
+                    f"{user_id}")
+        rows.append([
+            f"{username}@example.org",
+            username,
+            rng.choice(PROFILE_IMAGE_URLS),
+            PASSWORD,
+            sentence(rng, 6),
+            rng.choice(HEADER_IMAGE_URLS),
+            f"{rng.choice(CITY_PREFIXES)} {rng.choice(CITY_NAMES)}".strip(),
+        ])
+
+    return to_csv(rows)
+
+
+def message_rows(block):
+    start, stop = block
+    rng = block_rng('messages', start)
+
+    rows = []
+    for message_id in range(start, stop):
+        rows.append([
+            sentence(rng, 12)[:MAX_WARBLER_LENGTH],
+            get_random_datetime(rng, now=Config.now),
+            author_of(message_id),
+        ])
+
+    return to_csv(rows)
+
+
+def follow_rows(block):
+    """Follows by users start..stop-1, of users picked by popularity."""
+
+    (start, stop), count = block
+    rng = block_rng('follows', start)
+
+    pairs = set()
+    while len(pairs) < count:
+        follower = rng.randrange(start, stop)
+        followed = Config.user_ids(power_law_rank(
+            rng.random(), Config.num_users, FOLLOWED_EXPONENT))
+        if follower != followed:
+            pairs.add((followed, follower))
+
+    return to_csv(pairs)
+
+
+def like_rows(block):
+    """Likes by users start..stop-1, of messages picked by popularity."""
+
+    (start, stop), count = block
+    rng = block_rng('likes', start)
+
+    pairs = set()
+    while len(pairs) < count:
+        user_id = rng.randrange(start, stop)
+        message_id = Config.message_ids(power_law_rank(
+            rng.random(), Config.num_messages, LIKED_EXPONENT))
+        if author_of(message_id) != user_id:
+            pairs.add((message_id, user_id))
+
+    return to_csv(pairs)
+
+
+##############################################################################
+# Splitting the work
+
+
+def id_blocks(total):
+    """Return (start, stop) ranges of ids 1..total."""
+
+    return [(start, min(start + BLOCK_SIZE, total + 1))
+            for start in range(1, total + 1, BLOCK_SIZE)]
+
+
+def pair_blocks(total_pairs, num_users):
+    """Return ((start, stop), count) blocks of users, sharing out
+    `total_pairs` rows in proportion to the users in each block.
+
+    Blocks hold about BLOCK_SIZE pairs, however many users that takes.
+    """
+
+    users_per_block = max(1, num_users * BLOCK_SIZE // max(total_pairs, 1))
+
+    blocks = []
+    assigned = 0
+    for start in range(1, num_users + 1, users_per_block):
+        stop = min(start + users_per_block, num_users + 1)
+        target = total_pairs * (stop - 1) // num_users
+        blocks.append(((start, stop), target - assigned))
+        assigned = target
+
+    return blocks
+
+
+def write_csv(pool, path, headers, make_rows, blocks):
+    """Write the rows from make_rows for each block to `path`, in order."""
+
+    start = time.perf_counter()
+    written = 0
+
+    with open(path, 'w', newline='') as csv_file:
+        csv.writer(csv_file).writerow(headers)
+
+        for count, text in pool.imap(make_rows, blocks):
+            csv_file.write(text)
+
+            written += count
+            elapsed = time.perf_counter() - start
+            print(f"\r{os.path.basename(path)}: {written:,} rows, "
+                  f"{written / elapsed:,.0f} rows/s", end='', flush=True)
+
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate CSVs of random data for Warbler.")
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLOWS)
+    parser.add_argument('--likes', type=int, default=NUM_LIKES)
+    parser.add_argument('--seed', type=int, default=0,
+                        help="the same seed generates the same data")
+    parser.add_argument('--epoch', type=datetime.fromisoformat,
+                        default=DEFAULT_EPOCH,
+                        help="ISO date the timestamps count back from")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="processes generating rows")
+    parser.add_argument('--out', default=os.path.dirname(__file__) or '.',
+                        help="directory to write the CSVs to")
+    args = parser.parse_args()
+
+    # Picking distinct pairs at random slows as the pairs run out
+    if args.follows > args.users * (args.users - 1) // 2:
+        parser.error("--follows can be at most half of all user pairs")
+    if args.likes > args.users * args.messages // 2:
+        parser.error("--likes can be at most half of all user/message pairs")
+
+    start = time.perf_counter()
+
+    with Pool(args.workers, initializer=init_worker,
+              initargs=(args.seed, args.epoch, args.users,
+                        args.messages)) as pool:
+        write_csv(pool, os.path.join(args.out, 'users.csv'),
+                  USERS_CSV_HEADERS, user_rows, id_blocks(args.users))
+        write_csv(pool, os.path.join(args.out, 'messages.csv'),
+                  MESSAGES_CSV_HEADERS, message_rows, id_blocks(args.messages))
+        write_csv(pool, os.path.join(args.out, 'follows.csv'),
+                  FOLLOWS_CSV_HEADERS, follow_rows,
+                  pair_blocks(args.follows, args.users))
+        write_csv(pool, os.path.join(args.out, 'likes.csv'),
+                  LIKES_CSV_HEADERS, like_rows,
+                  pair_blocks(args.likes, args.users))
+
+    print(f"Generated in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
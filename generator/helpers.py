@@ -1,14 +1,166 @@
-"""Support functions for CSV generation."""
+"""Support functions for CSV generation.
 
-from datetime import datetime
-from random import uniform
+Everything here is offline and deterministic: random choices come from a
+seeded random.Random, or from hash_fraction where the same choice has to be
+made independently by several worker processes.
+"""
 
+from datetime import datetime, timedelta
+from math import gcd, log
 
-def get_random_datetime(year_gap=2):
+MASK_64 = (1 << 64) - 1
+
+FIRST_NAMES = [
+    "james", "mary", "robert", "patricia", "john", "jennifer", "michael",
+    "linda", "david", "elizabeth", "william", "barbara", "richard", "susan",
+    "joseph", "jessica", "thomas", "sarah", "chris", "karen", "daniel",
+    "lisa", "matthew", "nancy", "anthony", "betty", "mark", "sandra",
+    "donald", "ashley", "steven", "emily", "paul", "donna", "andrew",
+    "michelle", "joshua", "carol", "kenneth", "amanda", "kevin", "melissa",
+    "brian", "deborah", "george", "stephanie", "timothy", "rebecca", "ronald",
+    "laura", "jason", "sharon", "edward", "cynthia", "jeffrey", "kathleen",
+    "ryan", "amy", "jacob", "angela", "gary", "shirley", "nicholas", "anna",
+    "eric", "brenda", "jonathan", "pamela", "stephen", "emma", "larry",
+    "nicole", "justin", "helen", "scott", "samantha", "brandon", "katherine",
+    "benjamin", "christine", "samuel", "debra", "gregory", "rachel",
+    "alexander", "carolyn", "frank", "janet", "patrick", "maria", "raymond",
+    "olivia", "jack", "heather", "dennis", "diane", "jerry", "julie",
+    "tyler", "joyce", "aaron", "victoria", "jose", "ruth", "adam", "virginia",
+]
+
+LAST_NAMES = [
+    "smith", "johnson", "williams", "brown", "jones", "garcia", "miller",
+    "davis", "rodriguez", "martinez", "hernandez", "lopez", "gonzalez",
+    "wilson", "anderson", "thomas", "taylor", "moore", "jackson", "martin",
+    "lee", "perez", "thompson", "white", "harris", "sanchez", "clark",
+    "ramirez", "lewis", "robinson", "walker", "young", "allen", "king",
+    "wright", "scott", "torres", "nguyen", "hill", "flores", "green",
+    "adams", "nelson", "baker", "hall", "rivera", "campbell", "mitchell",
+    "carter", "roberts", "gomez", "phillips", "evans", "turner", "diaz",
+    "parker", "cruz", "edwards", "collins", "reyes", "stewart", "morris",
+    "morales", "murphy", "cook", "rogers", "gutierrez", "ortiz", "morgan",
+    "cooper", "peterson", "bailey", "reed", "kelly", "howard", "ramos",
+    "kim", "cox", "ward", "richardson", "watson", "brooks", "chavez", "wood",
+    "james", "bennett", "gray", "mendoza", "ruiz", "hughes", "price",
+    "alvarez", "castillo", "sanders", "patel", "myers", "long", "ross",
+]
+
+CITY_PREFIXES = ["North", "South", "East", "West", "New", "Port", "Lake", ""]
+
+CITY_NAMES = [
+    "Josephbury", "Markland", "Springfield", "Riverside", "Fairview",
+    "Franklin", "Greenville", "Bristol", "Clinton", "Georgetown", "Salem",
+    "Madison", "Ashland", "Burlington", "Milton", "Oxford", "Dover",
+    "Hudson", "Kingston", "Marion", "Newport", "Oakland", "Jackson",
+    "Lebanon", "Manchester", "Arlington", "Auburn", "Chester", "Dayton",
+    "Winchester", "Lexington", "Milford", "Shelby", "Centerville", "Troy",
+    "Cleveland", "Hamilton", "Mount Vernon", "Plymouth", "Harrison",
+]
+
+# Words for bios and messages, roughly most common first: they're drawn
+# with a power law, like words in real text
+WORDS = [
+    "the", "be", "to", "of", "and", "a", "in", "that", "have", "it", "for",
+    "not", "on", "with", "he", "as", "you", "do", "at", "this", "but",
+    "his", "by", "from", "they", "we", "say", "her", "she", "or", "an",
+    "will", "my", "one", "all", "would", "there", "their", "what", "so",
+    "up", "out", "if", "about", "who", "get", "which", "go", "me", "when",
+    "make", "can", "like", "time", "no", "just", "him", "know", "take",
+    "people", "into", "year", "your", "good", "some", "could", "them", "see",
+    "other", "than", "then", "now", "look", "only", "come", "its", "over",
+    "think", "also", "back", "after", "use", "two", "how", "our", "work",
+    "first", "well", "way", "even", "new", "want", "because", "any",
+    "these", "give", "day", "most", "us", "coffee", "today", "weekend",
+    "music", "game", "friends", "city", "night", "morning", "love", "team",
+    "book", "movie", "dog", "cat", "weather", "lunch", "dinner", "travel",
+    "summer", "winter", "rain", "sun", "beach", "mountain", "project",
+    "code", "bug", "deploy", "launch", "news", "vote", "art", "garden",
+    "recipe", "pizza", "tea", "run", "gym", "concert", "album", "podcast",
+    "train", "bike", "park", "river", "sea", "forest", "sky", "star",
+    "happy", "tired", "excited", "great", "terrible", "amazing", "quiet",
+    "busy", "late", "early", "finally", "again", "never", "always",
+]
+
+PROFILE_IMAGE_URLS = [
+    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
+    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
+    for i in range(count)
+]
+
+HEADER_IMAGE_URLS = [
+    "https://images.unsplash.com/photo-" + photo +
+    "?crop=entropy&cs=tinysrgb&fit=max&fm=jpg&ixlib=rb-4.0.3&q=80&w=1080"
+    for photo in [
+        "1573996987033-47fd3a4ca35e", "1574001412492-7555e61a9b53",
+        "1575015642299-5b92fcbd0ba4", "1647598939382-5637f4eeb7b9",
+        "1653061853347-4fbf052530e9", "1668353064375-d3dcd3346d53",
+        "1669375957059-0cd563ba4a02", "1673844968943-694c71e94e93",
+    ]
+]
+
+
+def get_random_datetime(rng, year_gap=2, now=None):
     """Get a random datetime within the last few years."""
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    now = now or datetime.now()
+    span = timedelta(days=365 * year_gap).total_seconds()
+
+    return now - timedelta(seconds=rng.uniform(0, span))
+
+
+def hash_fraction(*keys):
+    """Return a float in [0, 1) determined only by the integers `keys`.
+
+    A SplitMix64 hash, so any process can make the same "random" choice for
+    the same keys without sharing state.
+    """
+
+    x = 0
+    for key in keys:
+        x = (x + key + 0x9E3779B97F4A7C15) & MASK_64
+        x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK_64
+        x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK_64
+        x ^= x >> 31
+
+    return x / (1 << 64)
+
+
+def power_law_rank(u, n, exponent):
+    """Map u in [0, 1) to a rank in [0, n), where rank r has probability
+    roughly proportional to 1 / (r + 1) ** exponent.
+
+    Inverts the CDF of a bounded Pareto distribution over [1, n + 1), so it
+    needs no table of weights however large `n` is.
+    """
+
+    if exponent == 1:
+        x = (n + 1) ** u
+    else:
+        a = 1 - exponent
+        x = (1 + u * ((n + 1) ** a - 1)) ** (1 / a)
+
+    return min(int(x) - 1, n - 1)
+
+
+class Scatter:
+    """Maps ranks 0..n-1 to ids 1..n one-to-one, spreading neighbouring ranks
+    far apart, so the most popular ids aren't simply the lowest.
+
+    Scatters with different offsets put different ids at the top ranks.
+    """
+
+    def __init__(self, n, offset=0):
+        self.n = n
+        self.offset = offset
+        self.stride = max(int(n * 0.618), 1)
+        while gcd(self.stride, n) != 1:
+            self.stride += 1
+
+    def __call__(self, rank):
+        return (rank * self.stride + self.offset) % self.n + 1
+
+
+def log_normal_length(rng, median, low, high):
+    """Return an int near `median`, skewed long, clamped to [low, high]."""
 
-    return datetime.fromtimestamp(random_timestamp)
+    return max(low, min(high, int(rng.lognormvariate(log(median), 0.5))))
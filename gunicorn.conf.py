@@ -0,0 +1,93 @@
+"""Gunicorn settings for Warbler.
+
+WEB_CONCURRENCY (worker processes) and GUNICORN_THREADS (threads per worker)
+also size each worker's database connection pool (see pooling.py), so set
+them here rather than with command line flags.
+
+With WEB_ASYNC=1, workers serve the ASGI app in asgi.py with uvicorn, and
+GUNICORN_THREADS is the number of threads running its Flask views.
+"""
+
+import os
+import shutil
+import tempfile
+
+from pooling import serves_async
+
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+
+if serves_async():
+    wsgi_app = 'asgi:app'
+    worker_class = 'uvicorn_worker.UvicornWorker'
+else:
+    wsgi_app = 'app:app'
+    threads = int(os.environ.get('GUNICORN_THREADS', 1))
+
+# Import the app once in the master, so the workers share its memory and
+# start quickly. It's safe as long as nothing forked holds connections made
+# before the fork, which post_fork sees to.
+preload_app = True
+
+
+# The temporary directory on_starting made for the workers' metrics, if
+# METRICS_DIR isn't set
+metrics_tmpdir = None
+
+
+def on_starting(server):
+    """Have the workers pool their metrics, so /metrics on whichever one a
+    scrape reaches reports them all (see instrumentation.py)."""
+
+    global metrics_tmpdir
+
+    from app import app, instrumentation, metric_stats
+
+    directory = app.config['METRICS_DIR']
+    if not directory:
+        metrics_tmpdir = tempfile.mkdtemp(prefix='warbler-metrics-')
+        directory = metrics_tmpdir
+
+    instrumentation.share_metrics(directory, metric_stats)
+
+
+def when_ready(server):
+    """Start the password hashing pool, for every worker to share, so the
+    host has one pool sized to its CPUs (see hashing.py)."""
+
+    from models import hasher
+
+    hasher.share_pool()
+
+
+def on_exit(server):
+    """Stop the password hashing pool with the master, and remove the
+    metrics directory if it made one."""
+
+    from models import hasher
+
+    hasher.stop_pool()
+
+    if metrics_tmpdir is not None:
+        shutil.rmtree(metrics_tmpdir, ignore_errors=True)
+
+
+def post_fork(server, worker):
+    """Forget the master's database connections in the new worker.
+
+    Two processes using one connection corrupt each other's queries;
+    close=False leaves the connections to the master rather than closing
+    them under it.
+    """
+
+    from app import db, replicas
+
+    for engine in [db.engine, *replicas.engines]:
+        engine.dispose(close=False)
+
+
+def post_worker_init(worker):
+    """Give each request its own app context (see release_import_context)."""
+
+    from models import release_import_context
+
+    release_import_context()
@@ -0,0 +1,308 @@
+"""Password hashing on a dedicated process pool.
+
+bcrypt is deliberately slow (~250ms at the default cost), and CPU bound.
+PasswordHasher runs hashes on a pool of processes sized to the host's CPUs,
+so however many requests are logging in at once, hashes never compete for
+more CPUs than there are, and with a bounded number waiting: once the queue
+is full, new requests fail fast with a 503 rather than piling up. The
+request still waits for its hash, so its web worker (or thread) is tied up
+meanwhile; the pool bounds how much CPU hashing takes from the rest.
+
+Under gunicorn, the master starts the pool in a process of its own before
+forking the workers (see share_pool and gunicorn.conf.py), so the host has
+one pool however many workers it runs. Anywhere else, each process starts
+its own on first use.
+
+It also tracks queue depth and hash latency for monitoring (and passes each
+hash's latency to any `listeners`, such as instrumentation.py), and reports
+when a stored hash was made with a different cost than the configured one so
+it can be upgraded on the next successful login.
+"""
+
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.managers import BaseManager
+
+import bcrypt
+from werkzeug.exceptions import ServiceUnavailable
+
+
+class HashQueueFull(ServiceUnavailable):
+    """Too many password hashes are already waiting to run."""
+
+    description = "The server is busy logging people in. Please try again."
+
+
+def _hash_password(password, rounds):
+    return bcrypt.hashpw(password.encode('UTF-8'),
+                         bcrypt.gensalt(rounds)).decode('UTF-8')
+
+
+def _check_password(hashed, password):
+    return bcrypt.checkpw(password.encode('UTF-8'), hashed.encode('UTF-8'))
+
+
+class HashPool:
+    """A pool of `workers` processes running hashes."""
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, workers):
+        self._executor = ProcessPoolExecutor(workers)
+
+    @classmethod
+    def shared(cls, workers):
+        """Return the pool of the process serving HashPoolManager, which
+        every client of the manager shares."""
+
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls(workers)
+
+            return cls._shared
+
+    def run(self, fn, *args):
+        """Return `fn(*args)`, run on one of the pool's processes."""
+
+        return self._executor.submit(fn, *args).result()
+
+    def close(self):
+        """Stop the pool's processes, once they've finished their hashes."""
+
+        self._executor.shutdown()
+
+
+class HashPoolManager(BaseManager):
+    """Serves a HashPool to other processes, over a Unix socket."""
+
+
+HashPoolManager.register('pool', HashPool.shared, exposed=['run'])
+
+
+class PasswordHasher:
+    """Hash and check passwords on a bounded process pool.
+
+    Configured from the app with BCRYPT_LOG_ROUNDS (cost factor),
+    HASH_WORKERS (pool size, by default the number of CPUs; 0 hashes
+    inline), HASH_MAX_PENDING (queue bound, per process) and
+    HASH_QUEUE_TIMEOUT (seconds to wait for a queue slot).
+    """
+
+    def __init__(self, rounds=12, workers=None, max_pending=32,
+                 queue_timeout=2):
+        self.configure(rounds, workers, max_pending, queue_timeout)
+
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.hashes = 0
+        self.rejected = 0
+        self.hash_seconds = 0.0
+        self.max_hash_seconds = 0.0
+
+        # Called with the seconds each hash took, waiting included
+        self.listeners = []
+
+    def configure(self, rounds, workers, max_pending, queue_timeout):
+        self.rounds = rounds
+        self.workers = ((os.cpu_count() or 1) if workers is None
+                        else workers)
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+        # Set by share_pool: the shared pool's address, and the process
+        # serving it
+        self._pool_address = None
+        self._pool_server_pid = None
+
+        # The pool (or the connection to the shared one) is made on first
+        # use in each process, as a process pool can't be used across a fork
+        self._pool = None
+        self._pool_pid = None
+
+    def init_app(self, app):
+        """Configure the hasher from `app.config`."""
+
+        self.configure(
+            rounds=app.config.get('BCRYPT_LOG_ROUNDS', 12),
+            workers=app.config.get('HASH_WORKERS'),
+            max_pending=app.config.get('HASH_MAX_PENDING', 32),
+            queue_timeout=app.config.get('HASH_QUEUE_TIMEOUT', 2),
+        )
+
+    def share_pool(self):
+        """Start the pool in a process of its own, for this process and
+        every one forked from it to share, until stop_pool().
+
+        Called by the gunicorn master before it forks the workers. The
+        server process is forked directly rather than started as a
+        multiprocessing child, which the workers would inherit and try to
+        wait for as they exit. It opens its socket itself, after the fork,
+        so only it ever holds it: were it inherited, connections to a
+        stopped server would wait forever on the copies left open, hanging
+        every process that held a proxy as it exited.
+        """
+
+        if not self.workers or self._pool_server_pid is not None:
+            return
+
+        address = os.path.join(tempfile.mkdtemp(prefix='warbler-hashing-'),
+                               'pool.sock')
+        ready_read, ready_write = os.pipe()
+
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_read)
+            self._serve_pool(address, ready_write)
+
+        os.close(ready_write)
+
+        # Wait until the server listens, so the workers can connect
+        with os.fdopen(ready_read, 'rb') as ready:
+            started = ready.read(1)
+
+        if not started:
+            os.waitpid(pid, 0)
+            shutil.rmtree(os.path.dirname(address), ignore_errors=True)
+            raise RuntimeError("The password hashing pool failed to start")
+
+        self._pool_address = address
+        self._pool_server_pid = pid
+
+    @staticmethod
+    def _serve_pool(address, ready):
+        """Serve the shared pool at `address`, in the process share_pool
+        forked, until sent SIGTERM or SIGINT. Writes to the `ready` pipe
+        once listening."""
+
+        # Leave the handlers of the process this was forked from to it
+        for signum in signal.valid_signals():
+            if callable(signal.getsignal(signum)):
+                signal.signal(signum, signal.SIG_DFL)
+
+        try:
+            server = HashPoolManager(address).get_server()
+
+            def stop(signum, frame):
+                server.stop_event.set()
+
+            signal.signal(signal.SIGTERM, stop)
+            signal.signal(signal.SIGINT, stop)
+
+            os.write(ready, b'1')
+            os.close(ready)
+
+            server.serve_forever()
+        except Exception:
+            traceback.print_exc()
+        finally:
+            if HashPool._shared is not None:
+                HashPool._shared.close()
+
+            os._exit(0)
+
+    def stop_pool(self):
+        """Stop the pool started by share_pool.
+
+        This process's proxy is dropped first, while the server can still
+        hear that it's gone. Processes forked from this one that outlive
+        the server fail to reach it as they exit, rather than waiting on it.
+        """
+
+        if self._pool_server_pid is None:
+            return
+
+        with self._lock:
+            self._pool = None
+            self._pool_pid = None
+
+        try:
+            os.kill(self._pool_server_pid, signal.SIGTERM)
+            os.waitpid(self._pool_server_pid, 0)
+        except (ProcessLookupError, ChildProcessError):
+            # Already stopped, e.g. by a signal to the whole process group,
+            # and reaped by the gunicorn master
+            pass
+
+        shutil.rmtree(os.path.dirname(self._pool_address), ignore_errors=True)
+
+        self._pool_address = None
+        self._pool_server_pid = None
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool_pid != os.getpid():
+                if self._pool_address is not None:
+                    manager = HashPoolManager(self._pool_address)
+                    manager.connect()
+                    self._pool = manager.pool(self.workers)
+                else:
+                    self._pool = HashPool(self.workers)
+
+                self._pool_pid = os.getpid()
+
+            return self._pool
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            with self._lock:
+                self.rejected += 1
+            raise HashQueueFull()
+
+        with self._lock:
+            self.pending += 1
+
+        start = time.perf_counter()
+
+        try:
+            if not self.workers:
+                return fn(*args)
+
+            return self._get_pool().run(fn, *args)
+
+        finally:
+            elapsed = time.perf_counter() - start
+
+            with self._lock:
+                self.pending -= 1
+                self.hashes += 1
+                self.hash_seconds += elapsed
+                self.max_hash_seconds = max(self.max_hash_seconds, elapsed)
+
+            self._slots.release()
+
+            for listener in self.listeners:
+                listener(elapsed)
+
+    def generate(self, password):
+        """Return a bcrypt hash of `password` at the configured cost."""
+
+        return self._run(_hash_password, password, self.rounds)
+
+    def check(self, hashed, password):
+        """Does `password` match the bcrypt hash `hashed`?"""
+
+        return self._run(_check_password, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made with a different cost than the configured one?"""
+
+        return int(hashed.split('$')[2]) != self.rounds
+
+    def stats(self):
+        """Return a snapshot of queue depth and latency totals."""
+
+        with self._lock:
+            return {
+                'pending': self.pending,
+                'hashes': self.hashes,
+                'rejected': self.rejected,
+                'hash_seconds': self.hash_seconds,
+                'max_hash_seconds': self.max_hash_seconds,
+            }
@@ -0,0 +1,107 @@
+"""HTTP caching policies for Warbler's pages.
+
+Responses are `Cache-Control: no-store` unless their route opts in (see
+add_header in app.py). Routes opt in with @conditional, giving a cheap
+version stamp of everything the page shows: typically the `version`
+counters of the users involved, which go up on every change to the user's
+row, their counters included (see User.version). The stamp becomes the
+page's ETag, and a request whose If-None-Match matches it gets a 304
+without the page being rendered or its lists queried.
+
+Pages for logged-in users are private to the browser and revalidated on
+every use. Their ETags are weak, as the forms on them carry a fresh CSRF
+token each time they're rendered, and they change every half CSRF token
+lifetime, so a revalidated page never holds an expired token.
+"""
+
+import hashlib
+import os
+import time
+from functools import wraps
+
+from flask import current_app, g, make_response, request, session
+
+# Changes with each deploy, so pages rendered by old templates aren't reused
+DEPLOY_STAMP = os.environ.get('SOURCE_VERSION') or str(time.time())
+
+
+def make_etag(*parts):
+    """Return an ETag value for a version stamp of any repr-able parts."""
+
+    return hashlib.sha1(repr((DEPLOY_STAMP,) + parts).encode()).hexdigest()
+
+
+def csrf_stamp():
+    """Return a stamp that changes with the session's CSRF secret, and every
+    half CSRF token lifetime."""
+
+    time_limit = current_app.config.get('WTF_CSRF_TIME_LIMIT') or 3600
+
+    return (session.get('csrf_token'), int(time.time() // (time_limit / 2)))
+
+
+def conditional(version_of, public=False, max_age=0):
+    """Make a view answer matching If-None-Match requests with a 304.
+
+    `version_of` is called with the view's arguments and returns a tuple
+    that changes whenever the page would render differently, or None to
+    leave this request uncached (e.g. a logged out user being redirected).
+    The request's path, query string and preferred format (HTML or the JSON
+    of infinite scroll) are added to it.
+
+    Public pages can be stored by shared caches and get a strong ETag, so
+    must render the same for everyone. Others are private and get a weak
+    ETag that includes csrf_stamp(). Either can be reused without
+    revalidation for `max_age` seconds.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            # Flashed messages are shown once, so their page can't be reused
+            if session.get('_flashes'):
+                return view(**kwargs)
+
+            version = version_of(**kwargs)
+            if version is None:
+                return view(**kwargs)
+
+            etag = make_etag(
+                request.full_path,
+                request.accept_mimetypes.best_match(['text/html',
+                                                     'application/json']),
+                version if public else version + csrf_stamp())
+
+            if request.if_none_match.contains_weak(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(**kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag, weak=not public)
+            response.vary.add('Accept')
+
+            if public:
+                response.cache_control.public = True
+            else:
+                response.cache_control.private = True
+                response.vary.add('Cookie')
+
+            if max_age:
+                response.cache_control.max_age = max_age
+            else:
+                response.cache_control.no_cache = True
+
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def viewer_version():
+    """The parts of a version stamp for the logged in user, who is shown in
+    the navbar and whose likes and follows are marked on most pages."""
+
+    return (g.user.id, g.user.version)
@@ -0,0 +1,523 @@
+"""Per-request instrumentation for Warbler.
+
+For every request, records the route, total latency, number of SQL
+statements, time spent in the database, rendering templates and hashing
+passwords. Totals per route are exposed in the Prometheus text format (see
+the /metrics route), and slow requests are logged, with their slowest SQL
+statements, for a sample of them.
+
+It's cheap enough to leave on in production: a few timer reads per SQL
+statement and template, and a lock taken once per request.
+
+Totals are kept per process. With several web workers, a scrape lands on
+any one of them, so they pool their totals in a directory (see
+share_metrics, which gunicorn.conf.py calls): each writes its own to a file
+every SHARE_SECONDS, and /metrics adds up every file, the answering
+worker's brought up to date first. Files of workers that have exited are
+kept, so counters never go down while the server runs; their gauges are
+left out.
+"""
+
+import atexit
+import glob
+import json
+import logging
+import os
+import random
+import threading
+import time
+from bisect import bisect_left
+
+from flask import before_render_template, g, has_request_context, request
+from flask import template_rendered
+from sqlalchemy import event
+
+logger = logging.getLogger('warbler.slow_requests')
+
+# Database connection pool metrics: pooling.pool_stats() key, metric name,
+# type and description
+POOL_METRICS = [
+    ('size', 'warbler_db_pool_size', 'gauge',
+     "Connections the pool keeps open"),
+    ('checked_out', 'warbler_db_pool_checked_out', 'gauge',
+     "Connections in use"),
+    ('overflow', 'warbler_db_pool_overflow', 'gauge',
+     "Connections open beyond the pool size"),
+    ('checkouts', 'warbler_db_pool_checkouts_total', 'counter',
+     "Connections checked out"),
+    ('timeouts', 'warbler_db_pool_timeouts_total', 'counter',
+     "Checkouts that gave up waiting for a connection"),
+    ('wait_seconds', 'warbler_db_pool_wait_seconds_total', 'counter',
+     "Time spent checking out connections"),
+]
+
+# Keys of the gauges among the password hasher's stats and POOL_METRICS,
+# which only count for processes still running
+HASHER_GAUGES = {'pending'}
+POOL_GAUGES = {key for key, _, kind, _ in POOL_METRICS if kind == 'gauge'}
+
+# How often, in seconds, each process writes its totals for the others'
+# /metrics to add up (see share_metrics)
+SHARE_SECONDS = 5
+
+# Upper bounds, in seconds, of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Statements kept per request for the slow request log, and how many of the
+# slowest of them are logged
+MAX_STATEMENTS_KEPT = 200
+SLOW_STATEMENTS_LOGGED = 5
+
+# Per-request totals exported for each route, as
+# (name in RequestTimings, metric name, help)
+REQUEST_TOTALS = [
+    ('sql_statements', 'warbler_request_sql_statements',
+     "SQL statements executed per request"),
+    ('db_seconds', 'warbler_request_db_seconds',
+     "Time spent executing SQL per request"),
+    ('template_seconds', 'warbler_request_template_seconds',
+     "Time spent rendering templates per request"),
+    ('hash_seconds', 'warbler_request_password_hash_seconds',
+     "Time spent hashing and checking passwords per request"),
+]
+
+
+class RequestTimings:
+    """What one request has spent its time on so far."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.status = None
+        self.sql_statements = 0
+        self.db_seconds = 0.0
+        self.template_seconds = 0.0
+        self.hash_seconds = 0.0
+        self.statements = []
+        # Templates can be rendered while rendering another (see
+        # fragment_cache.py); only the outermost is timed
+        self.render_starts = []
+
+
+class RouteTotals:
+    """Running totals over every request to one route."""
+
+    def __init__(self):
+        self.statuses = {}
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.seconds = 0.0
+        self.totals = {name: 0 for name, _, _ in REQUEST_TOTALS}
+
+    def add(self, timings, elapsed):
+        self.statuses[timings.status] = self.statuses.get(timings.status,
+                                                          0) + 1
+        bucket = bisect_left(LATENCY_BUCKETS, elapsed)
+        if bucket < len(self.buckets):
+            self.buckets[bucket] += 1
+        self.count += 1
+        self.seconds += elapsed
+
+        for name in self.totals:
+            self.totals[name] += getattr(timings, name)
+
+    def to_dict(self):
+        return {
+            'statuses': list(self.statuses.items()),
+            'buckets': self.buckets,
+            'count': self.count,
+            'seconds': self.seconds,
+            'totals': self.totals,
+        }
+
+    def merge(self, data):
+        """Add in the totals of another process, from to_dict()."""
+
+        for status, count in data['statuses']:
+            self.statuses[status] = self.statuses.get(status, 0) + count
+        self.buckets = [mine + theirs for mine, theirs
+                        in zip(self.buckets, data['buckets'])]
+        self.count += data['count']
+        self.seconds += data['seconds']
+
+        for name in self.totals:
+            self.totals[name] += data['totals'].get(name, 0)
+
+
+def _add_stats(total, stats, gauges, running):
+    """Add the `stats` dict of one process to `total`, leaving out its
+    `gauges` unless it's `running`."""
+
+    if stats is None:
+        return total
+
+    total = dict(total or {key: 0 for key in stats})
+    for key, value in stats.items():
+        if running or key not in gauges:
+            total[key] = total.get(key, 0) + value
+
+    return total
+
+
+def _is_running(pid):
+    if pid == os.getpid():
+        return True
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def _current():
+    """Return the RequestTimings of the current request, if any."""
+
+    if has_request_context():
+        return g.get('_request_timings')
+
+
+class Instrumentation:
+    """Collects per-request timings for an app.
+
+    Configured from the app with SLOW_REQUEST_SECONDS (latency above which a
+    request is logged) and SLOW_REQUEST_SAMPLE_RATE (fraction of the slow
+    requests that are logged).
+    """
+
+    def __init__(self, slow_request_seconds=1.0, slow_request_sample_rate=1.0):
+        self.slow_request_seconds = slow_request_seconds
+        self.slow_request_sample_rate = slow_request_sample_rate
+
+        self.app = None
+
+        self._lock = threading.Lock()
+        self.routes = {}
+
+        # Set by share_metrics: the directory the processes pool their
+        # totals in, and what returns this process's hasher and pool stats.
+        # Each process starts writing on its first request.
+        self.metrics_dir = None
+        self.collect_stats = None
+        self._sharing_pid = None
+
+    def init_app(self, app, engine, hasher=None):
+        """Start timing `app`'s requests, and the SQL they run on `engine`
+        and password hashes they make with `hasher`."""
+
+        self.app = app
+        self.slow_request_seconds = app.config.get('SLOW_REQUEST_SECONDS',
+                                                   1.0)
+        self.slow_request_sample_rate = app.config.get(
+            'SLOW_REQUEST_SAMPLE_RATE', 1.0)
+
+        app.before_request(self._start_request)
+        app.after_request(self._record_status)
+        app.teardown_request(self._finish_request)
+
+        before_render_template.connect(self._start_render, app)
+        template_rendered.connect(self._finish_render, app)
+
+        self.watch_engine(engine)
+
+        if hasher is not None:
+            hasher.listeners.append(self._record_hash)
+
+    def watch_engine(self, engine):
+        """Count and time the SQL requests run on another engine, such as a
+        read replica's."""
+
+        event.listen(engine, 'before_cursor_execute', self._start_statement)
+        event.listen(engine, 'after_cursor_execute', self._finish_statement)
+        event.listen(engine, 'handle_error', self._discard_statement)
+
+    def share_metrics(self, directory, collect_stats):
+        """Pool the totals of this process and every one forked from it in
+        `directory`, emptied of any earlier ones, so /metrics in any of
+        them reports them all.
+
+        `collect_stats` returns the (hasher_stats, pool_stats) of the
+        process it's called in, as passed to render_metrics.
+        """
+
+        os.makedirs(directory, exist_ok=True)
+        for path in glob.glob(os.path.join(directory, '*.json')):
+            os.remove(path)
+
+        self.metrics_dir = directory
+        self.collect_stats = collect_stats
+
+    def _start_sharing(self):
+        with self._lock:
+            if self._sharing_pid == os.getpid():
+                return
+            self._sharing_pid = os.getpid()
+
+        threading.Thread(target=self._share, name='metrics-writer',
+                         daemon=True).start()
+        atexit.register(self._write_snapshot)
+
+    def _share(self):
+        while self.metrics_dir is not None:
+            time.sleep(SHARE_SECONDS)
+
+            try:
+                self._write_snapshot()
+            except Exception:
+                logger.exception("Failed to write metrics to %s",
+                                 self.metrics_dir)
+
+    def _write_snapshot(self, snapshot=None):
+        if self.metrics_dir is None:
+            return
+
+        if snapshot is None:
+            # Written from a thread of its own, or at exit
+            with self.app.app_context():
+                snapshot = self.snapshot(*self.collect_stats())
+
+        path = os.path.join(self.metrics_dir, f"{os.getpid()}.json")
+
+        # Replaced whole, so readers never see half of it
+        with open(f"{path}.tmp", 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(f"{path}.tmp", path)
+
+    def _read_snapshots(self):
+        snapshots = []
+
+        for path in glob.glob(os.path.join(self.metrics_dir, '*.json')):
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                logger.exception("Skipped unreadable metrics in %s", path)
+
+        return snapshots
+
+    ##########################################################################
+    # Hooks
+
+    def _start_request(self):
+        g._request_timings = RequestTimings()
+
+    def _record_status(self, response):
+        timings = _current()
+        if timings is not None:
+            timings.status = response.status_code
+        return response
+
+    def _finish_request(self, exc):
+        # Popped, as teardown can run twice for a request whose context was
+        # preserved (as by the test client)
+        timings = g.pop('_request_timings', None)
+        if timings is None:
+            return
+
+        elapsed = time.perf_counter() - timings.start
+        if timings.status is None:
+            timings.status = 500
+
+        rule = request.url_rule.rule if request.url_rule else '<unmatched>'
+        key = (request.method, rule)
+
+        with self._lock:
+            if key not in self.routes:
+                self.routes[key] = RouteTotals()
+            self.routes[key].add(timings, elapsed)
+
+        if self.metrics_dir is not None and self._sharing_pid != os.getpid():
+            self._start_sharing()
+
+        if (elapsed >= self.slow_request_seconds
+                and random.random() < self.slow_request_sample_rate):
+            self._log_slow_request(key, timings, elapsed)
+
+    def _start_render(self, app, template, context, **extra):
+        timings = _current()
+        if timings is not None:
+            timings.render_starts.append(time.perf_counter())
+
+    def _finish_render(self, app, template, context, **extra):
+        timings = _current()
+        if timings is not None and timings.render_starts:
+            start = timings.render_starts.pop()
+            if not timings.render_starts:
+                timings.template_seconds += time.perf_counter() - start
+
+    def _start_statement(self, conn, cursor, statement, parameters, context,
+                         executemany):
+        conn.info.setdefault('_statement_starts', []).append(
+            time.perf_counter())
+
+    def _finish_statement(self, conn, cursor, statement, parameters, context,
+                          executemany):
+        elapsed = time.perf_counter() - conn.info['_statement_starts'].pop()
+
+        timings = _current()
+        if timings is None:
+            return
+
+        timings.sql_statements += 1
+        timings.db_seconds += elapsed
+        if len(timings.statements) < MAX_STATEMENTS_KEPT:
+            timings.statements.append((elapsed, statement))
+
+    def _discard_statement(self, exception_context):
+        # A failed statement doesn't reach after_cursor_execute
+        conn = exception_context.connection
+        if conn is not None and conn.info.get('_statement_starts'):
+            conn.info['_statement_starts'].pop()
+
+    def _record_hash(self, elapsed):
+        timings = _current()
+        if timings is not None:
+            timings.hash_seconds += elapsed
+
+    ##########################################################################
+    # Output
+
+    def _log_slow_request(self, key, timings, elapsed):
+        method, rule = key
+        slowest = sorted(timings.statements, key=lambda s: s[0],
+                         reverse=True)[:SLOW_STATEMENTS_LOGGED]
+
+        logger.warning(
+            "Slow request: %s %s (%s) took %.0fms: %d SQL statements in "
+            "%.0fms, templates %.0fms, password hashing %.0fms%s",
+            method, request.path, rule, elapsed * 1000,
+            timings.sql_statements, timings.db_seconds * 1000,
+            timings.template_seconds * 1000, timings.hash_seconds * 1000,
+            ''.join(f"\n  {seconds * 1000:.1f}ms: {' '.join(sql.split())}"
+                    for seconds, sql in slowest))
+
+    def snapshot(self, hasher_stats=None, pool_stats=None):
+        """Return this process's totals, with `hasher_stats` and
+        `pool_stats` as for render_metrics, as a JSON-serializable dict."""
+
+        with self._lock:
+            routes = [[method, rule, totals.to_dict()]
+                      for (method, rule), totals in self.routes.items()]
+
+        return {
+            'pid': os.getpid(),
+            'routes': routes,
+            'hasher': hasher_stats,
+            'pools': {name: stats for name, stats
+                      in (pool_stats or {}).items() if stats is not None},
+        }
+
+    def render_metrics(self, hasher_stats=None, pool_stats=None):
+        """Return the totals in the Prometheus text exposition format, with
+        those of every process sharing metrics (see share_metrics).
+
+        `hasher_stats` and `pool_stats` are this process's: its
+        PasswordHasher.stats(), and a map from a name for each database
+        connection pool (e.g. "primary") to its pooling.pool_stats().
+        """
+
+        snapshot = self.snapshot(hasher_stats, pool_stats)
+        snapshots = [snapshot]
+
+        if self.metrics_dir is not None:
+            self._write_snapshot(snapshot)
+            snapshots = self._read_snapshots()
+
+        routes = {}
+        hasher_stats = None
+        pool_stats = {}
+
+        for snapshot in snapshots:
+            running = _is_running(snapshot['pid'])
+
+            for method, rule, data in snapshot['routes']:
+                routes.setdefault((method, rule), RouteTotals()).merge(data)
+
+            hasher_stats = _add_stats(hasher_stats, snapshot['hasher'],
+                                      HASHER_GAUGES, running)
+
+            for name, stats in snapshot['pools'].items():
+                pool_stats[name] = _add_stats(pool_stats.get(name), stats,
+                                              POOL_GAUGES, running)
+
+        routes = sorted(routes.items())
+
+        lines = [
+            "# HELP warbler_requests_total Requests handled",
+            "# TYPE warbler_requests_total counter",
+        ]
+        for (method, rule), totals in routes:
+            for status, count in sorted(totals.statuses.items()):
+                lines.append(
+                    f'warbler_requests_total{{method="{method}",'
+                    f'route="{rule}",status="{status}"}} {count}')
+
+        lines += [
+            "# HELP warbler_request_duration_seconds Request latency",
+            "# TYPE warbler_request_duration_seconds histogram",
+        ]
+        for (method, rule), totals in routes:
+            labels = f'method="{method}",route="{rule}"'
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, totals.buckets):
+                cumulative += count
+                lines.append(
+                    f'warbler_request_duration_seconds_bucket'
+                    f'{{{labels},le="{bound}"}} {cumulative}')
+            lines += [
+                f'warbler_request_duration_seconds_bucket'
+                f'{{{labels},le="+Inf"}} {totals.count}',
+                f'warbler_request_duration_seconds_sum{{{labels}}} '
+                f'{totals.seconds}',
+                f'warbler_request_duration_seconds_count{{{labels}}} '
+                f'{totals.count}',
+            ]
+
+        for name, metric, description in REQUEST_TOTALS:
+            lines += [
+                f"# HELP {metric} {description}",
+                f"# TYPE {metric} summary",
+            ]
+            for (method, rule), totals in routes:
+                labels = f'method="{method}",route="{rule}"'
+                lines += [
+                    f'{metric}_sum{{{labels}}} {totals.totals[name]}',
+                    f'{metric}_count{{{labels}}} {totals.count}',
+                ]
+
+        if hasher_stats is not None:
+            lines += [
+                "# HELP warbler_password_hashes_pending Password hashes "
+                "running or waiting",
+                "# TYPE warbler_password_hashes_pending gauge",
+                f"warbler_password_hashes_pending {hasher_stats['pending']}",
+                "# HELP warbler_password_hashes_total Password hashes and "
+                "checks run",
+                "# TYPE warbler_password_hashes_total counter",
+                f"warbler_password_hashes_total {hasher_stats['hashes']}",
+                "# HELP warbler_password_hashes_rejected_total Password "
+                "hashes refused with a full queue",
+                "# TYPE warbler_password_hashes_rejected_total counter",
+                f"warbler_password_hashes_rejected_total "
+                f"{hasher_stats['rejected']}",
+                "# HELP warbler_password_hash_seconds_total Time spent on "
+                "password hashes, including waiting",
+                "# TYPE warbler_password_hash_seconds_total counter",
+                f"warbler_password_hash_seconds_total "
+                f"{hasher_stats['hash_seconds']}",
+            ]
+
+        for key, metric, kind, description in POOL_METRICS:
+            if not pool_stats:
+                break
+
+            lines += [
+                f"# HELP {metric} {description}",
+                f"# TYPE {metric} {kind}",
+            ]
+            for name, stats in sorted(pool_stats.items()):
+                lines.append(f'{metric}{{pool="{name}"}} {stats[key]}')
+
+        return '\n'.join(lines) + '\n'
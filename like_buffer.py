@@ -0,0 +1,198 @@
+"""Write-behind buffer for likes.
+
+Liking or unliking a message through the API (PUT or DELETE
+/api/v1/messages/<id>/like) doesn't write anything in the request. It records
+the state the user wants for that like in LikeBuffer, and a background
+thread writes every recorded change in one transaction, at most
+LIKE_FLUSH_SECONDS later, or sooner once LIKE_BUFFER_SIZE changes are
+waiting. Bursts coalesce: the latest state asked for each like is the only
+one written, and a popular message's likes are inserted together instead of
+each request waiting on its own commit.
+
+Likes and the likes_count counters are eventually consistent: a change shows
+up in pages within LIKE_FLUSH_SECONDS. Changes still waiting when a worker
+shuts down cleanly are written on exit; a crashed worker loses them.
+
+Each worker process buffers and flushes on its own, so the latest change
+wins only among those made through the same worker. If a user's like and
+unlike of one message land on different workers within LIKE_FLUSH_SECONDS,
+whichever worker flushes last decides the outcome, even if its change came
+first. The next change of that like corrects it. Set LIKE_FLUSH_SECONDS to
+0 where that matters; each change is then written in its own request, in
+order.
+
+A batch the database rejects (say, a change that breaks a constraint) is
+written again one change at a time, and the changes that fail on their own
+are dropped, so one bad change can't hold up the rest. A batch that fails
+for any other reason, such as the database being down, is kept to retry,
+but at most LIKE_BUFFER_LIMIT changes wait: beyond that, requests to
+change a like fail with a 503 until writes succeed again.
+"""
+
+import atexit
+import logging
+import os
+import threading
+
+from sqlalchemy.exc import DataError, IntegrityError
+from werkzeug.exceptions import ServiceUnavailable
+
+from models import db, Like
+
+logger = logging.getLogger('warbler.likes')
+
+
+class LikeBufferFull(ServiceUnavailable):
+    """Too many like changes are already waiting to be written."""
+
+    description = "Likes can't be saved right now. Please try again."
+
+
+class LikeBuffer:
+    """Coalesce like and unlike requests, and write them in batches.
+
+    Configured from the app with LIKE_FLUSH_SECONDS (longest a change waits
+    to be written; 0 writes each change in its own request) and
+    LIKE_BUFFER_SIZE (changes waiting that trigger an early write) and
+    LIKE_BUFFER_LIMIT (most changes kept waiting while writes fail).
+
+    Changes are kept in order within a process only; see the module
+    docstring.
+    """
+
+    def __init__(self, flush_seconds=0.5, max_pending=1000, limit=10000):
+        self.flush_seconds = flush_seconds
+        self.max_pending = max_pending
+        self.limit = limit
+        self.app = None
+
+        self._lock = threading.Lock()
+        self._pending = {}
+
+        # Held while a batch is written, so flush() returns once everything
+        # recorded before it was called has been written
+        self._flush_lock = threading.Lock()
+
+        # The flushing thread is started on first use, so forked web
+        # workers each get their own
+        self._wake = threading.Event()
+        self._thread_pid = None
+
+    def init_app(self, app):
+        """Configure the buffer from `app.config`."""
+
+        self.app = app
+        self.flush_seconds = app.config.get('LIKE_FLUSH_SECONDS', 0.5)
+        self.max_pending = app.config.get('LIKE_BUFFER_SIZE', 1000)
+        self.limit = app.config.get('LIKE_BUFFER_LIMIT', 10000)
+
+        atexit.register(self.flush)
+
+    def set(self, user_id, message_id, liked):
+        """Have `user_id` like (or, if not `liked`, unlike) `message_id`."""
+
+        if not self.flush_seconds:
+            Like.set_liked({(user_id, message_id): liked})
+            db.session.commit()
+            return
+
+        with self._lock:
+            if (len(self._pending) >= self.limit
+                    and (user_id, message_id) not in self._pending):
+                raise LikeBufferFull()
+
+            self._pending[(user_id, message_id)] = liked
+            full = len(self._pending) >= self.max_pending
+
+            if self._thread_pid != os.getpid():
+                self._thread_pid = os.getpid()
+                threading.Thread(target=self._run, name='like-buffer',
+                                 daemon=True).start()
+
+        if full:
+            self._wake.set()
+
+    def flush(self):
+        """Write every change waiting, in one transaction.
+
+        Returns how many were written. If the database rejects the batch,
+        its changes are written one by one instead, dropping any it rejects
+        on their own. If the write fails otherwise, the changes are kept
+        (unless superseded since, and up to `limit`) to retry on the next
+        flush.
+        """
+
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+
+            if not batch:
+                return 0
+
+            try:
+                self._write(batch)
+
+            except (IntegrityError, DataError):
+                return self._write_each(batch)
+
+            except Exception:
+                logger.exception("Failed to write %d like change(s)",
+                                 len(batch))
+                self._requeue(batch)
+                return 0
+
+            return len(batch)
+
+    def _write(self, changes):
+        # A context of its own, so it has its own session
+        with self.app.app_context():
+            Like.set_liked(changes)
+            db.session.commit()
+
+    def _write_each(self, batch):
+        """Write each change of `batch` in its own transaction, dropping
+        those the database rejects. Returns how many were written."""
+
+        written = 0
+        changes = list(batch.items())
+
+        for i, (key, liked) in enumerate(changes):
+            try:
+                self._write({key: liked})
+            except (IntegrityError, DataError):
+                logger.exception("Dropped like change %r", {key: liked})
+            except Exception:
+                logger.exception("Failed to write %d like change(s)",
+                                 len(changes) - i)
+                self._requeue(dict(changes[i:]))
+                break
+            else:
+                written += 1
+
+        return written
+
+    def _requeue(self, batch):
+        """Put back changes of `batch` not superseded since, while fewer
+        than `limit` are waiting."""
+
+        with self._lock:
+            dropped = 0
+
+            for key, liked in batch.items():
+                if key in self._pending:
+                    continue
+
+                if len(self._pending) >= self.limit:
+                    dropped += 1
+                else:
+                    self._pending[key] = liked
+
+        if dropped:
+            logger.error("Dropped %d like change(s): %d already waiting",
+                         dropped, self.limit)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_seconds)
+            self._wake.clear()
+            self.flush()
@@ -0,0 +1,96 @@
+"""Apply schema migrations to an existing Warbler database.
+
+New databases get the full schema from db.create_all() (see seed.py); these
+migrations bring databases created before a schema change up to date.
+
+Migrations are the numbered .sql files in migrations/, applied in order,
+each in its own transaction. Applied ones are recorded in the
+schema_migrations table.
+
+    python migrate.py             # apply pending migrations
+    python migrate.py --status    # list migrations and whether applied
+    python migrate.py --baseline  # mark all applied (fresh create_all db)
+"""
+
+import os
+import sys
+
+from sqlalchemy import text
+
+from app import db
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), 'migrations')
+
+
+def migration_names():
+    """Return the names of all migrations, in the order they apply."""
+
+    return sorted(
+        name[:-len('.sql')]
+        for name in os.listdir(MIGRATIONS_DIR)
+        if name.endswith('.sql')
+    )
+
+
+def applied_names(conn):
+    """Return the set of migration names already applied."""
+
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "name VARCHAR(255) PRIMARY KEY, "
+        "applied_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now())"))
+
+    return set(conn.scalars(text("SELECT name FROM schema_migrations")))
+
+
+def mark_applied(conn, name):
+    conn.execute(text("INSERT INTO schema_migrations (name) VALUES (:name)"),
+                 {'name': name})
+
+
+def migrate():
+    """Apply each pending migration in its own transaction."""
+
+    with db.engine.begin() as conn:
+        applied = applied_names(conn)
+
+    for name in migration_names():
+        if name in applied:
+            continue
+
+        with open(os.path.join(MIGRATIONS_DIR, f"{name}.sql")) as sql_file:
+            sql = sql_file.read()
+
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql(sql)
+            mark_applied(conn, name)
+
+        print(f"Applied {name}")
+
+
+def mark_all_applied():
+    """Record every migration as applied, for a database made by create_all."""
+
+    with db.engine.begin() as conn:
+        applied = applied_names(conn)
+
+        for name in migration_names():
+            if name not in applied:
+                mark_applied(conn, name)
+
+
+def status():
+    with db.engine.begin() as conn:
+        applied = applied_names(conn)
+
+    for name in migration_names():
+        print(f"[{'x' if name in applied else ' '}] {name}")
+
+
+if __name__ == '__main__':
+    if '--status' in sys.argv:
+        status()
+    elif '--baseline' in sys.argv:
+        mark_all_applied()
+    else:
+        migrate()
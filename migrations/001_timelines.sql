@@ -0,0 +1,21 @@
+-- Materialized home timelines (fan out on write).
+
+CREATE TABLE timelines (
+    user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    message_id INTEGER NOT NULL REFERENCES messages (id) ON DELETE CASCADE,
+    timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    PRIMARY KEY (user_id, message_id)
+);
+
+CREATE INDEX ix_timelines_user_id_timestamp
+    ON timelines (user_id, timestamp, message_id);
+
+-- Fill every inbox with the owner's messages and those of who they follow
+INSERT INTO timelines (user_id, message_id, timestamp)
+    SELECT user_id, id, timestamp FROM messages;
+
+INSERT INTO timelines (user_id, message_id, timestamp)
+    SELECT follows.user_following_id, messages.id, messages.timestamp
+    FROM follows
+    JOIN messages ON messages.user_id = follows.user_being_followed_id
+    WHERE follows.user_following_id != follows.user_being_followed_id;
@@ -0,0 +1,17 @@
+-- Denormalized follower/following/message/like counters on users.
+
+ALTER TABLE users
+    ADD COLUMN messages_count INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN following_count INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN followers_count INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN likes_count INTEGER NOT NULL DEFAULT 0;
+
+UPDATE users SET
+    messages_count = (SELECT count(*) FROM messages
+                      WHERE messages.user_id = users.id),
+    following_count = (SELECT count(*) FROM follows
+                       WHERE follows.user_following_id = users.id),
+    followers_count = (SELECT count(*) FROM follows
+                       WHERE follows.user_being_followed_id = users.id),
+    likes_count = (SELECT count(*) FROM likes
+                   WHERE likes.user_id = users.id);
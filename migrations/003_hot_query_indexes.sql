@@ -0,0 +1,30 @@
+-- Secondary indexes for the hot query shapes.
+--
+-- messages: a user's messages newest first (show_user, follow backfill,
+--   fan out on read, delete_user). Includes id so keyset pagination on
+--   (timestamp, id) is answered from the index.
+-- likes: a user's likes (show_likes, like state, delete_user). The primary
+--   key (message_id, user_id) already covers a message's likes and the
+--   toggle_like lookup.
+-- follows: who a user follows (following page, follow state, timelines).
+--   The primary key (user_being_followed_id, user_following_id) already
+--   covers a user's followers.
+-- timelines: a message's inbox rows (delete_message, and the ON DELETE
+--   CASCADE check for every deleted message).
+
+CREATE INDEX IF NOT EXISTS ix_messages_user_id_timestamp
+    ON messages (user_id, timestamp, id);
+
+CREATE INDEX IF NOT EXISTS ix_likes_user_id
+    ON likes (user_id, message_id);
+
+CREATE INDEX IF NOT EXISTS ix_follows_user_following_id
+    ON follows (user_following_id, user_being_followed_id);
+
+CREATE INDEX IF NOT EXISTS ix_timelines_message_id
+    ON timelines (message_id);
+
+ANALYZE messages;
+ANALYZE likes;
+ANALYZE follows;
+ANALYZE timelines;
@@ -0,0 +1,14 @@
+-- Full-text user search (see search.py). The indexed expression must match
+-- search.user_document exactly for the planner to use it.
+
+CREATE INDEX IF NOT EXISTS ix_users_search ON users USING gin ((
+    (setweight(to_tsvector('simple'::regconfig, username), 'A') ||
+     setweight(to_tsvector('simple'::regconfig, location), 'B')) ||
+    setweight(to_tsvector('simple'::regconfig, bio), 'C')));
+
+-- Username autocomplete: prefix LIKE on lower(username), whatever the
+-- database collation
+CREATE INDEX IF NOT EXISTS ix_users_username_lower
+    ON users (lower(username) text_pattern_ops);
+
+ANALYZE users;
@@ -0,0 +1,12 @@
+-- Full-text message search (see search.py). The indexed expression must
+-- match search.message_document exactly for the planner to use it.
+
+CREATE INDEX IF NOT EXISTS ix_messages_search
+    ON messages USING gin (to_tsvector('simple'::regconfig, text));
+
+-- Newest messages first, so searches for common words can stop after a page
+-- of matches instead of sorting every match
+CREATE INDEX IF NOT EXISTS ix_messages_timestamp
+    ON messages (timestamp, id);
+
+ANALYZE messages;
@@ -0,0 +1,19 @@
+-- Set-based account deletion: deleting a user or message now removes its
+-- likes by ON DELETE CASCADE, like follows, messages and timelines already.
+
+ALTER TABLE likes
+    DROP CONSTRAINT likes_message_id_fkey,
+    ADD CONSTRAINT likes_message_id_fkey FOREIGN KEY (message_id)
+        REFERENCES messages (id) ON DELETE CASCADE;
+
+ALTER TABLE likes
+    DROP CONSTRAINT likes_user_id_fkey,
+    ADD CONSTRAINT likes_user_id_fkey FOREIGN KEY (user_id)
+        REFERENCES users (id) ON DELETE CASCADE;
+
+-- Tombstones for large accounts waiting on `flask purge-deleted-users`
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP WITHOUT TIME ZONE;
+
+CREATE INDEX IF NOT EXISTS ix_users_deleted_at
+    ON users (deleted_at) WHERE deleted_at IS NOT NULL;
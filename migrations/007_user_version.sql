@@ -0,0 +1,4 @@
+-- A version counter on users, bumped by every UPDATE of the row, used as a
+-- cheap stamp for the ETags of pages showing them
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;
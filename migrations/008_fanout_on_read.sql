@@ -0,0 +1,10 @@
+-- Authors fanned out on read are flagged, so they switch back to fan out on
+-- write only well below the limit, by `flask backfill-timelines`
+
+ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS fanout_on_read BOOLEAN NOT NULL DEFAULT false;
+
+UPDATE users SET fanout_on_read = true WHERE followers_count >= 10000;
+
+CREATE INDEX IF NOT EXISTS ix_users_fanout_on_read
+    ON users (followers_count) WHERE fanout_on_read;
@@ -1,17 +1,33 @@
 """SQLAlchemy models for Warbler."""
 
+from collections import Counter, namedtuple
 from datetime import datetime
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import case, column, delete, func, or_, select, tuple_, update
+from sqlalchemy import values, Integer
+from sqlalchemy.dialects.postgresql import insert
+
+from hashing import PasswordHasher
+from replicas import RoutingSession
 
 bcrypt = Bcrypt()
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+hasher = PasswordHasher()
 
 DEFAULT_IMAGE_URL = (
     "https://icon-library.com/images/default-user-icon/" +
     "default-user-icon-28.jpg")
 
+# Key in session.info collecting ids of users changed in the current
+# transaction (used to invalidate cached copies of them on commit)
+CHANGED_USER_IDS = 'changed_user_ids'
+
+# The likes of a page of messages, as seen by one user (see
+# Like.like_state_among)
+LikeState = namedtuple('LikeState', ['liked_ids', 'counts'])
+
 DEFAULT_HEADER_IMAGE_URL = (
     "https://images.unsplash.com/photo-1519751138087-5bf79df62d5b?ixlib=" +
     "rb-4.0.3&ixid=MnwxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8&auto=for" +
@@ -35,6 +51,20 @@ class Follow(db.Model):
         primary_key=True,
     )
 
+    # The primary key covers "who follows X"; this covers "who does X follow"
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
+    @classmethod
+    def followed_among(cls, user_id, user_ids):
+        """Select the ids in (non-empty) `user_ids` followed by `user_id`."""
+
+        return (select(cls.user_being_followed_id)
+                .where(cls.user_following_id == user_id,
+                       cls.user_being_followed_id.in_(user_ids)))
+
 
 class User(db.Model):
     """User in the system."""
@@ -87,7 +117,65 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message', backref="user")
+    # Denormalized counters, kept in step by the routes that change them
+    # (see adjust_counts) and repaired by reconcile_counts.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    # Goes up on every UPDATE of the row, counters included, so it's a cheap
+    # stamp of everything shown about the user (see http_cache.py)
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default="1",
+        onupdate=db.text("version + 1"),
+    )
+
+    # Set once followed by FANOUT_FOLLOWER_LIMIT users: their messages are
+    # then merged into timelines on read, until backfill-timelines switches
+    # them back (see timeline.py)
+    fanout_on_read = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default="false",
+    )
+
+    # Set when the account is deleted but its rows are left for the
+    # purge-deleted-users command to remove (see tombstone)
+    deleted_at = db.Column(
+        db.DateTime,
+        nullable=True,
+    )
+
+    messages = db.relationship('Message', backref="user", passive_deletes=True)
 
     followers = db.relationship(
         "User",
@@ -97,6 +185,15 @@ class User(db.Model):
         backref="following",
     )
 
+    # Tombstoned accounts waiting to be purged, and authors fanned out on
+    # read waiting to be switched back
+    __table_args__ = (
+        db.Index('ix_users_deleted_at', 'deleted_at',
+                 postgresql_where=db.text('deleted_at IS NOT NULL')),
+        db.Index('ix_users_fanout_on_read', 'followers_count',
+                 postgresql_where=db.text('fanout_on_read')),
+    )
+
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
@@ -107,7 +204,7 @@ class User(db.Model):
         Hashes password and adds user to session.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.generate(password)
 
         user = User(
             username=username,
@@ -129,30 +226,219 @@ class User(db.Model):
 
         If this can't find matching user (or if password is wrong), returns
         False.
+
+        If the stored hash was made with an old cost factor it is replaced
+        with one at the current cost (the caller commits).
         """
 
-        user = cls.query.filter_by(username=username).one_or_none()
+        user = (cls
+                .query
+                .filter_by(username=username, deleted_at=None)
+                .one_or_none())
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = hasher.check(user.password, password)
             if is_auth:
+                if hasher.needs_rehash(user.password):
+                    user.password = hasher.generate(password)
                 return user
 
         return False
 
+    @classmethod
+    def adjust_counts(cls, user_ids, **deltas):
+        """Atomically add `deltas` to the counters of `user_ids`.
+
+        `user_ids` can be a list of ids or a select of ids, e.g.
+        User.adjust_counts([user.id], followers_count=-1).
+        """
+
+        values = {
+            name: getattr(cls, name) + delta
+            for name, delta in deltas.items()
+        }
+
+        # Counter updates don't depend on pending changes, so don't flush
+        # them early; they'll be written in the same transaction on commit.
+        with db.session.no_autoflush:
+            mark_users_changed(db.session.scalars(
+                update(cls)
+                .where(cls.id.in_(user_ids))
+                .values(**values)
+                .returning(cls.id)))
+
+    @classmethod
+    def reconcile_counts(cls, user_ids=None):
+        """Recompute counters from the underlying tables, repairing drift.
+
+        Only rows whose counters are wrong are updated. Returns the number of
+        users that were repaired.
+        """
+
+        actual = {
+            'messages_count': (select(func.count())
+                               .where(Message.user_id == cls.id)),
+            'following_count': (select(func.count())
+                                .where(Follow.user_following_id == cls.id)),
+            'followers_count': (select(func.count())
+                                .where(Follow.user_being_followed_id == cls.id)),
+            'likes_count': (select(func.count())
+                            .where(Like.user_id == cls.id)),
+        }
+        actual = {
+            name: query.scalar_subquery()
+            for name, query in actual.items()
+        }
+
+        stmt = (update(cls)
+                .where(or_(*[
+                    getattr(cls, name) != count
+                    for name, count in actual.items()
+                ]))
+                .values(**actual)
+                .returning(cls.id)
+                .execution_options(synchronize_session=False))
+
+        if user_ids is not None:
+            stmt = stmt.where(cls.id.in_(user_ids))
+
+        repaired = db.session.scalars(stmt).all()
+        mark_users_changed(repaired)
+
+        return len(repaired)
+
+    def release_counts(self):
+        """Take this user out of other users' counters, ahead of deletion.
+
+        Users they followed lose a follower, their followers follow one fewer
+        user, and users who liked their messages lose those likes.
+        """
+
+        User.adjust_counts(
+            select(Follow.user_being_followed_id)
+            .where(Follow.user_following_id == self.id),
+            followers_count=-1)
+
+        User.adjust_counts(
+            select(Follow.user_following_id)
+            .where(Follow.user_being_followed_id == self.id),
+            following_count=-1)
+
+        User.release_likes_of(
+            select(Message.id).where(Message.user_id == self.id))
+
+    @classmethod
+    def release_likes_of(cls, message_ids):
+        """Take likes of `message_ids` out of their likers' counters.
+
+        Call ahead of deleting the messages. `message_ids` can be a list of
+        ids or a select of ids.
+        """
+
+        likes_of_them = (select(func.count())
+                         .select_from(Like)
+                         .where(Like.user_id == cls.id,
+                                Like.message_id.in_(message_ids))
+                         .scalar_subquery())
+
+        likers = select(Like.user_id).where(Like.message_id.in_(message_ids))
+
+        mark_users_changed(db.session.scalars(
+            update(cls)
+            .where(cls.id.in_(likers))
+            .values(likes_count=cls.likes_count - likes_of_them)
+            .returning(cls.id)
+            .execution_options(synchronize_session='fetch')))
+
+    def delete_account(self):
+        """Delete this user and everything that's theirs.
+
+        A few set-based statements, however much they've posted: their
+        follows, messages, likes and inbox, and other inboxes' copies of
+        their messages, all go by ON DELETE CASCADE.
+        """
+
+        self.release_counts()
+
+        db.session.execute(
+            delete(User)
+            .where(User.id == self.id)
+            .execution_options(synchronize_session=False))
+        mark_users_changed([self.id])
+
+        db.session.expunge(self)
+
+    def tombstone(self):
+        """Mark this account deleted, leaving the rows to purge later.
+
+        A tombstoned user can't log in and is hidden from user lists and
+        profiles, but their messages stay up until they're purged.
+        """
+
+        self.deleted_at = datetime.utcnow()
+
+    def purge_messages(self, batch_size):
+        """Delete up to `batch_size` of this user's messages.
+
+        Returns how many were deleted, so a purge can work through a large
+        account in short transactions.
+        """
+
+        batch = db.session.scalars(
+            select(Message.id)
+            .where(Message.user_id == self.id)
+            .order_by(Message.id)
+            .limit(batch_size)).all()
+
+        if not batch:
+            return 0
+
+        User.release_likes_of(batch)
+
+        db.session.execute(
+            delete(Message)
+            .where(Message.id.in_(batch))
+            .execution_options(synchronize_session=False))
+
+        return len(batch)
+
+    def follow(self, other_user):
+        """Start following `other_user`."""
+
+        self.following.append(other_user)
+        User.adjust_counts([self.id], following_count=1)
+        User.adjust_counts([other_user.id], followers_count=1)
+
+    def unfollow(self, other_user):
+        """Stop following `other_user`."""
+
+        self.following.remove(other_user)
+        User.adjust_counts([self.id], following_count=-1)
+        User.adjust_counts([other_user.id], followers_count=-1)
+
+    def following_ids_among(self, user_ids):
+        """Return the set of ids in `user_ids` that this user follows.
+
+        One indexed query however many candidates there are, so a page of
+        user cards can look up every follow button at once.
+        """
+
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+
+        return set(db.session.scalars(
+            Follow.followed_among(self.id, user_ids)))
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [
-            user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return self.id in other_user.following_ids_among([self.id])
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [
-            user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.id in self.following_ids_among([other_user.id])
 
 
 class Message(db.Model):
@@ -184,6 +470,47 @@ class Message(db.Model):
 
     users_like = db.relationship('User', secondary="likes", backref="liked_messages")
 
+    # A user's messages newest first: profiles, backfill and fan out on read
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp',
+                 'user_id', 'timestamp', 'id'),
+    )
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into a user's home timeline ("inbox").
+
+    Rows are written when a message is posted (fan out on write), so the
+    homepage can be read with a single range scan on (user_id, timestamp).
+    """
+
+    __tablename__ = 'timelines'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    # Copied from the message so the inbox can be sorted without a join
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timelines_user_id_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
+        # Removing a deleted message from every inbox
+        db.Index('ix_timelines_message_id', 'message_id'),
+    )
+
 
 
 class Like(db.Model):
@@ -193,33 +520,165 @@ class Like(db.Model):
 
     message_id = db.Column(
         db.Integer,
-        db.ForeignKey('messages.id'),
+        db.ForeignKey('messages.id', ondelete='cascade'),
         primary_key=True
     )
 
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id'),
+        db.ForeignKey('users.id', ondelete='cascade'),
         primary_key=True
     )
 
+    # The primary key covers a message's likes; this covers a user's likes
+    __table_args__ = (
+        db.Index('ix_likes_user_id', 'user_id', 'message_id'),
+    )
+
     @classmethod
     def create_like(cls, user_id, message_id):
         """Create liked message for user"""
 
         like = cls(user_id=user_id, message_id=message_id)
         db.session.add(like)
+        User.adjust_counts([user_id], likes_count=1)
 
         return like
 
+    @classmethod
+    def like_state_among(cls, user_id, message_ids):
+        """Return the LikeState of `message_ids` for `user_id`: the set of
+        those they've liked, and how many likes each has.
+
+        One grouped query over just those messages' likes, on the primary
+        key, so a page costs the same whatever the user's like history.
+        Messages without likes are left out of the counts.
+        """
+
+        message_ids = list(message_ids)
+        if not message_ids:
+            return LikeState(set(), {})
+
+        rows = db.session.execute(
+            select(cls.message_id,
+                   func.count(),
+                   func.max(case((cls.user_id == user_id, 1), else_=0)))
+            .where(cls.message_id.in_(message_ids))
+            .group_by(cls.message_id))
+
+        liked_ids = set()
+        counts = {}
+        for message_id, count, liked in rows:
+            counts[message_id] = count
+            if liked:
+                liked_ids.add(message_id)
+
+        return LikeState(liked_ids, counts)
+
+    @classmethod
+    def liked_among(cls, user_id, message_ids):
+        """Select the ids in (non-empty) `message_ids` liked by `user_id`."""
+
+        return (select(cls.message_id)
+                .where(cls.user_id == user_id,
+                       cls.message_id.in_(message_ids)))
+
+    @classmethod
+    def remove_like(cls, like):
+        """Remove a like from a message"""
+
+        db.session.delete(like)
+        User.adjust_counts([like.user_id], likes_count=-1)
+
+    @classmethod
+    def set_liked(cls, changes):
+        """Make each (user_id, message_id) in `changes` liked or not.
+
+        `changes` maps (user_id, message_id) to True (like) or False
+        (unlike). Idempotent: liking a liked message or unliking one that
+        isn't does nothing, rather than failing, so concurrent requests for
+        the same like can't conflict. Likes of messages that no longer exist,
+        or by users who've since deleted their account, are skipped. A couple of statements however many changes there are,
+        and counters move only for rows actually inserted or deleted.
+        """
+
+        liked = [pair for pair, state in changes.items() if state]
+        unliked = [pair for pair, state in changes.items() if not state]
+        deltas = Counter()
+
+        if liked:
+            wanted = (values(column('user_id', Integer),
+                             column('message_id', Integer),
+                             name='wanted')
+                      .data(liked))
+            inserted = db.session.scalars(
+                insert(cls)
+                .from_select(
+                    ['user_id', 'message_id'],
+                    select(wanted.c.user_id, wanted.c.message_id)
+                    .join(Message, Message.id == wanted.c.message_id)
+                    .join(User, (User.id == wanted.c.user_id)
+                          & User.deleted_at.is_(None)))
+                .on_conflict_do_nothing()
+                .returning(cls.user_id))
+            deltas.update(inserted)
+
+        if unliked:
+            deleted = db.session.scalars(
+                delete(cls)
+                .where(tuple_(cls.user_id, cls.message_id).in_(unliked))
+                .returning(cls.user_id)
+                .execution_options(synchronize_session=False))
+            deltas.subtract(deleted)
+
+        by_delta = {}
+        for user_id, delta in deltas.items():
+            if delta:
+                by_delta.setdefault(delta, []).append(user_id)
+
+        for delta, user_ids in by_delta.items():
+            User.adjust_counts(user_ids, likes_count=delta)
+
+
+
+def mark_users_changed(user_ids):
+    """Record `user_ids` as changed by the current transaction, so cached
+    copies of them are dropped once it commits (see user_cache.py)."""
+
+    db.session.info.setdefault(CHANGED_USER_IDS, set()).update(user_ids)
 
 
 def connect_db(app):
     """Connect this database to provided Flask app.
 
     You should call this in your Flask app.
+
+    Pushes an app context, so scripts and tests can use the database as soon
+    as they've imported the app. Web workers should pop it with
+    release_import_context() before serving requests.
     """
 
-    app.app_context().push()
+    global _import_context
+
+    _import_context = app.app_context()
+    _import_context.push()
     db.app = app
     db.init_app(app)
+
+
+_import_context = None
+
+
+def release_import_context():
+    """Pop the app context connect_db() pushed.
+
+    Requests handled in the thread that pushed it would otherwise all share
+    it: one `g`, and one database session, holding its connection between
+    requests and never torn down. Without it, each request gets its own.
+    """
+
+    global _import_context
+
+    if _import_context is not None:
+        _import_context.pop()
+        _import_context = None
@@ -0,0 +1,124 @@
+"""Keyset (cursor) pagination for Warbler's lists.
+
+Rather than OFFSET, each page is fetched with a `WHERE (keys) < (cursor)`
+clause on the columns it is sorted by, so reading page 500 costs the same
+indexed range scan as reading page 1.
+
+A cursor is the sort key values of the last row on a page, as url-safe
+base64 encoded JSON.
+"""
+
+import base64
+import json
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import DateTime, Float, tuple_
+
+Page = namedtuple('Page', ['items', 'next_cursor'])
+
+
+def encode_cursor(values):
+    """Encode a sequence of sort key values as an opaque cursor string."""
+
+    raw = json.dumps([
+        value.isoformat() if isinstance(value, datetime) else value
+        for value in values
+    ])
+
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, keys):
+    """Decode `cursor` into values for the columns in `keys`.
+
+    Returns None if there is no cursor or it is malformed, so a bad cursor
+    just restarts from the first page.
+    """
+
+    if not cursor:
+        return None
+
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+
+        if not isinstance(values, list) or len(values) != len(keys):
+            return None
+
+        return tuple(
+            _decode_value(key, value)
+            for key, value in zip(keys, values)
+        )
+
+    except (ValueError, TypeError):
+        return None
+
+
+def _decode_value(key, value):
+    if isinstance(key.type, DateTime):
+        return datetime.fromisoformat(value)
+
+    if isinstance(key.type, Float):
+        return float(value)
+
+    return int(value)
+
+
+def after_cursor(keys, values, descending=True):
+    """Return a filter clause selecting rows past `values` in `keys` order."""
+
+    row = tuple_(*keys)
+    bound = tuple_(*values)
+
+    return row < bound if descending else row > bound
+
+
+def page_query(query, keys, cursor=None, per_page=50, descending=True):
+    """Narrow `query` (a Query or a select()) to the page after `cursor`.
+
+    Orders it by `keys`, and fetches one row more than `per_page` so that
+    page_of() can tell whether there's a next page.
+    """
+
+    values = decode_cursor(cursor, keys)
+
+    if values is not None:
+        query = query.filter(after_cursor(keys, values, descending))
+
+    order = [key.desc() if descending else key.asc() for key in keys]
+    return query.order_by(*order).limit(per_page + 1)
+
+
+def page_of(items, keys, per_page=50, cursor_for=None):
+    """Return the Page of `items`, the results of a page_query().
+
+    `cursor_for` maps a result to its key values; by default the attributes
+    named like `keys` are read off it.
+    """
+
+    if len(items) <= per_page:
+        return Page(items, None)
+
+    items = items[:per_page]
+    last = items[-1]
+
+    if cursor_for:
+        last_values = cursor_for(last)
+    else:
+        last_values = [getattr(last, key.key) for key in keys]
+
+    return Page(items, encode_cursor(last_values))
+
+
+def paginate(query, keys, cursor=None, per_page=50, descending=True,
+             cursor_for=None):
+    """Return a Page of `query` results ordered by `keys`, after `cursor`.
+
+    `keys` must be unique together (e.g. timestamp then id). See page_of()
+    for `cursor_for`.
+    """
+
+    items = page_query(query, keys, cursor, per_page, descending).all()
+
+    return page_of(items, keys, per_page, cursor_for)
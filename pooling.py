@@ -0,0 +1,178 @@
+"""Database connection pool settings for Warbler's web workers.
+
+Each gunicorn worker process has its own engine and pool, so the number of
+connections a deploy can hold is the pool size times the number of workers.
+engine_options() sizes each worker's pool from the connection budget it
+shares with the others:
+
+- DB_MAX_CONNECTIONS: connections all of a host's workers may hold at once,
+  per database (default 20)
+- WEB_CONCURRENCY: worker processes (set by Heroku; default 1)
+- GUNICORN_THREADS: request threads per worker (default 1)
+- DB_POOL_TIMEOUT: seconds a request waits for a connection before failing
+  (default 10)
+- DB_POOL_RECYCLE: seconds after which a connection is replaced, before
+  a server or proxy idle timeout closes it under us (default 1800)
+
+Each worker keeps a connection per request thread, plus one for background
+work such as the like buffer, and can open more for bursts up to its share
+of the budget. Connections are checked with a ping before use, so ones
+dropped by a database restart fail over to new ones instead of erroring.
+
+Served as ASGI (WEB_ASYNC=1, see asgi.py), a worker has a second, async
+engine for its async routes, and the share is split evenly between the two:
+async_engine_options() sizes the other half.
+
+Behind a transaction-pooling proxy such as PgBouncer, set
+DB_TRANSACTION_POOLING=1: the proxy does the pooling, so workers open a
+connection to it per checkout and hold nothing between requests. The app
+keeps no session state on connections (SET, LISTEN, advisory locks), so
+transactions can run on any server connection. The async driver's prepared
+statements are the exception, so they're given unique names and not reused.
+
+TimedQueuePool records how long checkouts wait, for /metrics.
+"""
+
+import os
+import threading
+import time
+from uuid import uuid4
+
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import NullPool, QueuePool
+
+
+class PoolStats:
+    """Running totals of a pool's checkouts."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+
+    def record(self, seconds, timed_out=False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_seconds += seconds
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout takes, waiting for a
+    free connection, connecting and pinging included."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def recreate(self):
+        # Disposing an engine replaces its pool; keep counting from where
+        # the old one left off
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+    def connect(self):
+        start = time.perf_counter()
+
+        try:
+            connection = super().connect()
+        except TimeoutError:
+            self.stats.record(time.perf_counter() - start, timed_out=True)
+            raise
+
+        self.stats.record(time.perf_counter() - start)
+        return connection
+
+
+def flag(environ, name):
+    return environ.get(name, '').lower() in ('1', 'true')
+
+
+def serves_async(environ=os.environ):
+    """Is the app served as ASGI (WEB_ASYNC=1)?"""
+
+    return flag(environ, 'WEB_ASYNC')
+
+
+def connection_share(environ):
+    """Return how many connections each worker may hold."""
+
+    workers = max(1, int(environ.get('WEB_CONCURRENCY', 1)))
+    budget = int(environ.get('DB_MAX_CONNECTIONS', 20))
+
+    return max(1, budget // workers)
+
+
+def engine_options(environ=os.environ):
+    """Return SQLALCHEMY_ENGINE_OPTIONS for this worker, from `environ`."""
+
+    if flag(environ, 'DB_TRANSACTION_POOLING'):
+        return {'poolclass': NullPool}
+
+    threads = max(1, int(environ.get('GUNICORN_THREADS', 1)))
+
+    share = connection_share(environ)
+    if serves_async(environ):
+        share = max(1, share // 2)
+
+    pool_size = min(threads + 1, share)
+
+    return {
+        'poolclass': TimedQueuePool,
+        'pool_size': pool_size,
+        'max_overflow': share - pool_size,
+        'pool_timeout': float(environ.get('DB_POOL_TIMEOUT', 10)),
+        'pool_recycle': int(environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': True,
+    }
+
+
+def async_engine_options(environ=os.environ):
+    """Return create_async_engine() options for asgi.py, from `environ`.
+
+    Its pool is the half of the worker's share engine_options() leaves, all
+    kept open: requests in flight don't each have a thread, so there's no
+    thread count to size it by, and it's what limits how many wait on the
+    database at once.
+    """
+
+    if flag(environ, 'DB_TRANSACTION_POOLING'):
+        return {'poolclass': NullPool, 'connect_args': {
+            'prepared_statement_cache_size': 0,
+            'statement_cache_size': 0,
+            'prepared_statement_name_func': lambda: f"__asyncpg_{uuid4()}__",
+        }}
+
+    share = connection_share(environ)
+
+    return {
+        'pool_size': max(1, share - share // 2),
+        'max_overflow': 0,
+        'pool_timeout': float(environ.get('DB_POOL_TIMEOUT', 10)),
+        'pool_recycle': int(environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': True,
+    }
+
+
+def pool_stats(engine):
+    """Return a snapshot of `engine`'s pool usage, or None if its pool
+    isn't a TimedQueuePool."""
+
+    pool = engine.pool
+    if not isinstance(pool, TimedQueuePool):
+        return None
+
+    stats = pool.stats
+    with stats._lock:
+        return {
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'overflow': max(0, pool.overflow()),
+            'checkouts': stats.checkouts,
+            'timeouts': stats.timeouts,
+            'wait_seconds': stats.wait_seconds,
+        }
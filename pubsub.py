@@ -0,0 +1,238 @@
+"""Publish new messages to the people whose home timelines they're on.
+
+add_message() publishes each new message through the MessageHub, and once
+its transaction commits, the configured broker hands it to the hub of every
+worker. Each hub passes it on to the subscriptions of those following its
+author (and the author's own), which stream it to the browser as a
+server-sent event (see /timeline/events in app.py and asgi.py).
+
+Only ASGI workers (asgi.py, WEB_ASYNC=1) subscribe, and so stream messages
+as they're published. Sync workers can't hold a stream open for each
+browser, so their /timeline/events polls instead: each request queries the
+inbox for messages since the last one seen and closes, so a message reaches
+the browser up to SSE_POLL_SECONDS after it's posted, and every open home
+timeline costs a query per poll. Serve asgi.py for push.
+
+PUBSUB_BROKER chooses the broker (by default, see default_broker):
+
+- 'none' delivers nothing, for sync workers, where nothing subscribes.
+- 'local' only reaches subscribers in the same process, so suits a single
+  worker.
+- 'postgres' sends each message with NOTIFY, and every worker LISTENs on a
+  connection of its own, so it reaches every worker using the database.
+  Transaction-pooling proxies can't LISTEN, so behind PgBouncer point
+  PUBSUB_DATABASE_URL directly at the database.
+
+Delivery is best effort: a message published while a browser is
+reconnecting is caught up from the database instead (see
+timeline.timeline_ids_after).
+"""
+
+import logging
+import os
+import select
+import threading
+import time
+from collections import defaultdict
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.pool import NullPool
+
+from pooling import serves_async
+
+logger = logging.getLogger('warbler.pubsub')
+
+# Key in session.info collecting (author_id, message_id) of messages
+# published in the current transaction, for LocalBroker
+PUBLISHED_MESSAGES = 'published_messages'
+
+# Postgres NOTIFY channel PostgresBroker sends messages on
+CHANNEL = 'warbler_messages'
+
+NOTIFY_QUERY = text("SELECT pg_notify(:channel, :payload)")
+
+
+class Subscription:
+    """Someone waiting for new messages by any of `author_ids`.
+
+    `put` is called with the id of each, from whichever thread delivers it.
+    """
+
+    def __init__(self, author_ids, put):
+        self.author_ids = frozenset(author_ids)
+        self.put = put
+
+
+class NullBroker:
+    """Delivers nothing, where nothing subscribes."""
+
+    def __init__(self, app, session):
+        pass
+
+    def publish(self, session, author_id, message_id):
+        pass
+
+    def listen(self, deliver):
+        pass
+
+
+class LocalBroker:
+    """Delivers messages to subscribers in this process."""
+
+    def __init__(self, app, session):
+        self.deliver = None
+
+        @event.listens_for(session, 'after_commit')
+        def deliver_published(session):
+            published = session.info.pop(PUBLISHED_MESSAGES, ())
+
+            if self.deliver is not None:
+                for author_id, message_id in published:
+                    self.deliver(author_id, message_id)
+
+        @event.listens_for(session, 'after_rollback')
+        def forget_published(session):
+            session.info.pop(PUBLISHED_MESSAGES, None)
+
+    def publish(self, session, author_id, message_id):
+        session.info.setdefault(PUBLISHED_MESSAGES, []).append(
+            (author_id, message_id))
+
+    def listen(self, deliver):
+        self.deliver = deliver
+
+
+class PostgresBroker:
+    """Delivers messages to subscribers in every process, through Postgres
+    NOTIFY and LISTEN."""
+
+    # Seconds to wait before listening again after losing the connection
+    RECONNECT_SECONDS = 1
+
+    def __init__(self, app, session):
+        self.url = (app.config.get('PUBSUB_DATABASE_URL')
+                    or app.config['SQLALCHEMY_DATABASE_URI'])
+
+    def publish(self, session, author_id, message_id):
+        # Postgres sends it when (and only if) the transaction commits
+        session.execute(NOTIFY_QUERY, {'channel': CHANNEL,
+                                       'payload': f"{author_id} {message_id}"})
+
+    def listen(self, deliver):
+        threading.Thread(target=self._run, args=(deliver,),
+                         name='pubsub-listener', daemon=True).start()
+
+    def _run(self, deliver):
+        engine = create_engine(self.url, poolclass=NullPool)
+
+        while True:
+            try:
+                self._listen(engine, deliver)
+            except Exception:
+                logger.exception("Lost the connection listening for "
+                                 "messages; reconnecting")
+                time.sleep(self.RECONNECT_SECONDS)
+
+    def _listen(self, engine, deliver):
+        connection = engine.raw_connection()
+
+        try:
+            conn = connection.driver_connection
+            conn.autocommit = True
+            conn.cursor().execute(f"LISTEN {CHANNEL}")
+
+            while True:
+                select.select([conn], [], [], 60)
+                conn.poll()
+
+                while conn.notifies:
+                    payload = conn.notifies.pop(0).payload
+                    author_id, message_id = map(int, payload.split())
+                    deliver(author_id, message_id)
+        finally:
+            connection.close()
+
+
+BROKERS = {
+    'none': NullBroker,
+    'local': LocalBroker,
+    'postgres': PostgresBroker,
+}
+
+
+def default_broker(environ=os.environ):
+    """Return the name of the broker to use unless PUBSUB_BROKER says
+    otherwise: 'none' for sync workers, which don't subscribe; for ASGI
+    workers, 'local' for a single worker, 'postgres' for several
+    (WEB_CONCURRENCY), so a message reaches subscribers on every worker."""
+
+    if not serves_async(environ):
+        return 'none'
+
+    if int(environ.get('WEB_CONCURRENCY', 1)) > 1:
+        return 'postgres'
+
+    return 'local'
+
+
+class MessageHub:
+    """Passes published messages on to the subscriptions interested.
+
+    Configured from the app with PUBSUB_BROKER (see BROKERS) and, for the
+    postgres broker, PUBSUB_DATABASE_URL.
+    """
+
+    def __init__(self):
+        self.broker = None
+
+        self._lock = threading.Lock()
+        self._by_author = defaultdict(set)
+
+        # The broker starts listening on first use, so forked web workers
+        # each listen for themselves
+        self._listening_pid = None
+
+    def init_app(self, app, session):
+        """Publish messages committed on `session`."""
+
+        self.broker = BROKERS[app.config.get('PUBSUB_BROKER', 'local')](
+            app, session)
+
+    def publish(self, session, msg):
+        """Have `msg` (flushed) delivered if `session` commits it."""
+
+        self.broker.publish(session, msg.user_id, msg.id)
+
+    def subscribe(self, author_ids, put):
+        """Call `put` with the id of every message published by any of
+        `author_ids` from now until unsubscribe()."""
+
+        subscription = Subscription(author_ids, put)
+
+        with self._lock:
+            if self._listening_pid != os.getpid():
+                self._listening_pid = os.getpid()
+                self.broker.listen(self.deliver)
+
+            for author_id in subscription.author_ids:
+                self._by_author[author_id].add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for author_id in subscription.author_ids:
+                subscribers = self._by_author[author_id]
+                subscribers.discard(subscription)
+
+                if not subscribers:
+                    del self._by_author[author_id]
+
+    def deliver(self, author_id, message_id):
+        """Pass a published message on to its author's subscribers."""
+
+        with self._lock:
+            subscribers = list(self._by_author.get(author_id, ()))
+
+        for subscription in subscribers:
+            subscription.put(message_id)
@@ -0,0 +1,173 @@
+"""Send read-only views' queries to read replicas.
+
+With DATABASE_REPLICA_URLS set, views decorated with
+@replicas.reads_from_replica run their SELECTs on one of the replicas,
+chosen at random per request, while anything that writes still goes to the
+primary. Each replica's replication lag is measured every
+REPLICA_LAG_CHECK_SECONDS, and replicas further behind than
+REPLICA_MAX_LAG_SECONDS, or that can't be reached, are left out until they
+catch up; with none left, reads go to the primary.
+
+So that people see their own changes, a browser that has just made a
+non-GET request reads from the primary for as long as a replica could still
+be missing it: the maximum lag, plus the time since it was last measured.
+"""
+
+import logging
+import random
+import time
+from functools import wraps
+
+from flask import request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.sql.dml import UpdateBase
+
+logger = logging.getLogger('warbler.replicas')
+
+# Key in session.info holding the engine of the replica the current view
+# reads from
+REPLICA = 'replica'
+
+# Key in the Flask session holding the time until which its reads must go to
+# the primary
+PRIMARY_UNTIL = '_primary_until'
+
+# Seconds a replica is behind the primary. An idle primary sends nothing to
+# replay, so a replica that has replayed all it's received is up to date.
+LAG_QUERY = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+""")
+
+
+class RoutingSession(Session):
+    """Session that reads from the replica in session.info, if there is one.
+
+    Flushes and INSERT/UPDATE/DELETE statements always go to the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        replica = self.info.get(REPLICA)
+
+        if (replica is not None and bind is None and not self._flushing
+                and not isinstance(clause, UpdateBase)):
+            return replica
+
+        return super().get_bind(mapper, clause=clause, bind=bind, **kwargs)
+
+
+class Replica:
+    """A replica's engine, and its lag when last measured (None if it
+    couldn't be reached)."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.lag = None
+        self.checked_at = None
+
+
+class ReplicaRouter:
+    """Chooses the replica, if any, each read-only view reads from.
+
+    Configured from the app with DATABASE_REPLICA_URLS (a list of database
+    URLs), REPLICA_MAX_LAG_SECONDS and REPLICA_LAG_CHECK_SECONDS.
+    """
+
+    def __init__(self):
+        self.db = None
+        self.replicas = []
+        self.max_lag = 5.0
+        self.lag_check_seconds = 5.0
+
+    def init_app(self, app, db):
+        """Connect to the replicas of `db` configured for `app`."""
+
+        self.db = db
+        self.max_lag = app.config.get('REPLICA_MAX_LAG_SECONDS', 5.0)
+        self.lag_check_seconds = app.config.get('REPLICA_LAG_CHECK_SECONDS',
+                                                5.0)
+
+        options = app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {})
+        self.replicas = [
+            Replica(create_engine(url, **options))
+            for url in app.config.get('DATABASE_REPLICA_URLS') or []
+        ]
+
+        app.after_request(self._pin_to_primary)
+
+    @property
+    def engines(self):
+        return [replica.engine for replica in self.replicas]
+
+    @property
+    def pin_seconds(self):
+        """How long a replica could still be missing a write."""
+
+        return self.max_lag + self.lag_check_seconds
+
+    def _pin_to_primary(self, response):
+        if self.replicas and request.method not in ('GET', 'HEAD', 'OPTIONS'):
+            session[PRIMARY_UNTIL] = time.time() + self.pin_seconds
+
+        return response
+
+    def lag_of(self, replica):
+        """Return `replica`'s lag in seconds, measuring it if it's due."""
+
+        now = time.monotonic()
+
+        if (replica.checked_at is None
+                or now - replica.checked_at >= self.lag_check_seconds):
+            # Marked first, so concurrent requests don't all measure it
+            replica.checked_at = now
+
+            try:
+                with replica.engine.connect() as conn:
+                    replica.lag = float(conn.execute(LAG_QUERY).scalar())
+            except SQLAlchemyError:
+                logger.warning("Can't reach replica %s", replica.engine.url,
+                               exc_info=True)
+                replica.lag = None
+
+        return replica.lag
+
+    def choose(self):
+        """Return the engine this request should read from, or None for the
+        primary."""
+
+        if not self.replicas:
+            return None
+
+        if session.get(PRIMARY_UNTIL, 0) > time.time():
+            return None
+
+        fresh = []
+        for replica in self.replicas:
+            lag = self.lag_of(replica)
+            if lag is not None and lag <= self.max_lag:
+                fresh.append(replica)
+
+        return random.choice(fresh).engine if fresh else None
+
+    def reads_from_replica(self, view):
+        """Have a read-only view run its queries on a replica when it can."""
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            replica = self.choose()
+
+            if replica is None:
+                return view(*args, **kwargs)
+
+            self.db.session.info[REPLICA] = replica
+            try:
+                return view(*args, **kwargs)
+            finally:
+                self.db.session.info.pop(REPLICA, None)
+
+        return wrapper
@@ -0,0 +1,272 @@
+"""User and message search for Warbler.
+
+On PostgreSQL, searches use full-text search backed by GIN expression
+indexes: users over a weighted document of username (A), location (B) and
+bio (C), ranked with ts_rank; messages over their text, newest first. The
+indexes are updated by the database in the same transaction as the insert,
+update or delete of the row, so results are never stale.
+
+On SQLite (handy for running locally without a database server) the same
+searches run against FTS5 tables kept in step by triggers, and users are
+ranked with bm25.
+
+Autocomplete is a plain prefix match on lower(username), backed by a btree
+index on that expression.
+"""
+
+import re
+
+from sqlalchemy import (
+    DDL, Float, cast, column, event, func, literal_column, select, table)
+from sqlalchemy.dialects.postgresql import to_tsquery, to_tsvector
+from sqlalchemy.orm import joinedload
+
+from models import db, Follow, Message, User
+from pagination import Page, paginate
+
+# Number of usernames to suggest while typing
+AUTOCOMPLETE_LIMIT = 10
+
+# Text search configuration: no stemming or stop words, matching the SQLite
+# tokenizer, and as names, places and short messages aren't reliably English
+TS_CONFIG = literal_column("'simple'::regconfig")
+
+# Relative weights of the username, location and bio columns on SQLite
+# (matching ts_rank's default weights for A, B and C on PostgreSQL)
+FTS_WEIGHTS = (1.0, 0.4, 0.2)
+
+
+def search_terms(q):
+    """Split a search string into lowercase terms of letters and digits.
+
+    Everything else (punctuation, underscores, search syntax) separates
+    terms, so user input can't form an invalid query.
+    """
+
+    return re.findall(r'[^\W_]+', (q or '').lower())
+
+
+def parse_message_query(q):
+    """Parse a message search string into a list of phrases to match.
+
+    Each phrase is a list of (term, is_prefix) pairs that must appear in
+    order. "Quoted words" form one phrase, and a word ending in * matches as
+    a prefix, so '"big jo*" cats' is [[('big', False), ('jo', True)],
+    [('cats', False)]].
+    """
+
+    phrases = []
+
+    for quoted, bare in re.findall(r'"([^"]*)"?|(\S+)', q or ''):
+        phrase = [
+            (term, prefix == '*')
+            for term, prefix in re.findall(r'([^\W_]+)(\*?)',
+                                           (quoted or bare).lower())
+        ]
+
+        if phrase:
+            phrases.append(phrase)
+
+    return phrases
+
+
+def _tsquery(phrases):
+    """Return a PostgreSQL tsquery matching all of `phrases`."""
+
+    return to_tsquery(TS_CONFIG, ' & '.join(
+        '(' + ' <-> '.join(
+            f"{term}:*" if prefix else term for term, prefix in phrase
+        ) + ')'
+        for phrase in phrases
+    ))
+
+
+def _fts_query(phrases):
+    """Return an SQLite FTS5 query string matching all of `phrases`."""
+
+    return ' '.join(
+        ' + '.join(
+            f'"{term}" *' if prefix else f'"{term}"' for term, prefix in phrase
+        )
+        for phrase in phrases
+    )
+
+
+def _dialect():
+    return db.session.get_bind().dialect.name
+
+
+##############################################################################
+# Users
+
+
+def _weighted(column, weight):
+    return func.setweight(to_tsvector(TS_CONFIG, column), weight)
+
+
+user_document = (_weighted(User.username, 'A')
+                 .op('||')(_weighted(User.location, 'B'))
+                 .op('||')(_weighted(User.bio, 'C')))
+
+users_fts = table('users_fts', column('rowid'))
+
+
+def search_users(q, cursor=None, per_page=60):
+    """Return a Page of users matching search string `q`, best first.
+
+    Every term must match the start of a word in the user's username,
+    location or bio.
+    """
+
+    phrases = [[(term, True)] for term in search_terms(q)]
+    if not phrases:
+        return Page([], None)
+
+    if _dialect() == 'sqlite':
+        # bm25 is lower for better matches
+        rank = cast(-func.bm25(literal_column('users_fts'), *FTS_WEIGHTS),
+                    Float)
+        query = (db.session.query(User, rank.label('rank'))
+                 .join(users_fts, users_fts.c.rowid == User.id)
+                 .filter(literal_column('users_fts')
+                         .op('MATCH')(_fts_query(phrases))))
+    else:
+        tsquery = _tsquery(phrases)
+        rank = cast(func.ts_rank(user_document, tsquery), Float)
+        query = (db.session.query(User, rank.label('rank'))
+                 .filter(user_document.op('@@')(tsquery)))
+
+    query = query.filter(User.deleted_at.is_(None))
+
+    page = paginate(query, (rank, User.id), cursor, per_page,
+                    cursor_for=lambda row: (row.rank, row.User.id))
+
+    return Page([row.User for row in page.items], page.next_cursor)
+
+
+def autocomplete_users(prefix, limit=AUTOCOMPLETE_LIMIT):
+    """Return up to `limit` users whose username starts with `prefix`.
+
+    Most followed first, as they're the likeliest to be looked for.
+    """
+
+    prefix = (prefix or '').strip().lower()
+    if not prefix:
+        return []
+
+    escaped = re.sub(r'([\\%_])', r'\\\1', prefix)
+
+    return (User
+            .query
+            .filter(func.lower(User.username).like(f"{escaped}%", escape='\\'))
+            .filter(User.deleted_at.is_(None))
+            .order_by(User.followers_count.desc(), User.username)
+            .limit(limit)
+            .all())
+
+
+##############################################################################
+# Messages
+
+
+message_document = to_tsvector(TS_CONFIG, Message.text)
+
+messages_fts = table('messages_fts', column('rowid'))
+
+
+def search_messages(q, cursor=None, per_page=50, following=None):
+    """Return a Page of messages matching search string `q`, newest first.
+
+    See parse_message_query for the syntax. If `following` is a user, only
+    messages by users they follow are searched.
+    """
+
+    phrases = parse_message_query(q)
+    if not phrases:
+        return Page([], None)
+
+    messages = Message.query.options(joinedload(Message.user))
+
+    if _dialect() == 'sqlite':
+        messages = (messages
+                    .join(messages_fts, messages_fts.c.rowid == Message.id)
+                    .filter(literal_column('messages_fts')
+                            .op('MATCH')(_fts_query(phrases))))
+    else:
+        messages = messages.filter(
+            message_document.op('@@')(_tsquery(phrases)))
+
+    if following is not None:
+        messages = messages.filter(Message.user_id.in_(
+            select(Follow.user_being_followed_id)
+            .where(Follow.user_following_id == following.id)))
+
+    return paginate(messages, (Message.timestamp, Message.id), cursor,
+                    per_page)
+
+
+##############################################################################
+# Indexes
+
+
+User.__table__.append_constraint(
+    db.Index('ix_users_search', user_document,
+             postgresql_using='gin').ddl_if(dialect='postgresql'))
+
+User.__table__.append_constraint(
+    db.Index('ix_users_username_lower',
+             func.lower(User.username).label('username_lower'),
+             postgresql_ops={'username_lower': 'text_pattern_ops'}))
+
+Message.__table__.append_constraint(
+    db.Index('ix_messages_search', message_document,
+             postgresql_using='gin').ddl_if(dialect='postgresql'))
+
+# Lets searches for common words walk messages newest first, checking each
+# against the query, rather than sorting every match from the GIN index
+Message.__table__.append_constraint(
+    db.Index('ix_messages_timestamp', Message.timestamp, Message.id))
+
+# The FTS5 tables only store the index; rows are read from the real tables.
+# Messages are never edited, so only inserts and deletes are mirrored.
+SQLITE_FTS_DDL = {
+    User.__table__: [
+        """CREATE VIRTUAL TABLE users_fts USING fts5(
+            username, location, bio, content='users', content_rowid='id')""",
+        """CREATE TRIGGER users_fts_insert AFTER INSERT ON users BEGIN
+            INSERT INTO users_fts (rowid, username, location, bio)
+            VALUES (new.id, new.username, new.location, new.bio);
+        END""",
+        """CREATE TRIGGER users_fts_delete AFTER DELETE ON users BEGIN
+            INSERT INTO users_fts (users_fts, rowid, username, location, bio)
+            VALUES ('delete', old.id, old.username, old.location, old.bio);
+        END""",
+        """CREATE TRIGGER users_fts_update
+        AFTER UPDATE OF username, location, bio ON users BEGIN
+            INSERT INTO users_fts (users_fts, rowid, username, location, bio)
+            VALUES ('delete', old.id, old.username, old.location, old.bio);
+            INSERT INTO users_fts (rowid, username, location, bio)
+            VALUES (new.id, new.username, new.location, new.bio);
+        END""",
+    ],
+    Message.__table__: [
+        """CREATE VIRTUAL TABLE messages_fts USING fts5(
+            text, content='messages', content_rowid='id')""",
+        """CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+        END""",
+        """CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, text)
+            VALUES ('delete', old.id, old.text);
+        END""",
+    ],
+}
+
+for fts_table, statements in SQLITE_FTS_DDL.items():
+    for statement in statements:
+        event.listen(fts_table, 'after_create',
+                     DDL(statement).execute_if(dialect='sqlite'))
+
+    event.listen(fts_table, 'before_drop',
+                 DDL(f"DROP TABLE IF EXISTS {fts_table.name}_fts")
+                 .execute_if(dialect='sqlite'))
@@ -1,25 +1,182 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
+
+Each CSV is streamed into its table in chunks: through PostgreSQL's COPY,
+or batched INSERTs on other databases. Secondary indexes and foreign keys
+are dropped for the load and rebuilt afterwards, which is much faster than
+maintaining them row by row.
+
+    python seed.py                                 # the CSVs in generator/
+    python seed.py --dir /data/big --chunk-size 100000
+"""
+
+import argparse
+import csv
+import io
+import os
+import time
+from datetime import datetime
+
+from sqlalchemy import DateTime, inspect
+from sqlalchemy.schema import AddConstraint, DropIndex
 
-from csv import DictReader
 from app import db
 from models import User, Message, Follow, Like
+from timeline import rebuild_timelines
+from migrate import mark_all_applied
+
+# Tables to load, in foreign key order, from <name>.csv. The CSV headers
+# name the columns.
+TABLES = [User.__table__, Message.__table__, Follow.__table__, Like.__table__]
+
+
+def read_chunks(path, chunk_size):
+    """Yield (header, rows) for `path`, `chunk_size` rows at a time."""
+
+    with open(path, newline='') as csv_file:
+        reader = csv.reader(csv_file)
+        header = next(reader)
+
+        chunk = []
+        for row in reader:
+            chunk.append(row)
+
+            if len(chunk) == chunk_size:
+                yield header, chunk
+                chunk = []
+
+        if chunk:
+            yield header, chunk
+
+
+def copy_chunk(conn, table, header, rows):
+    """Load rows with PostgreSQL's COPY."""
+
+    # Quote everything: COPY reads an unquoted empty field as NULL
+    buffer = io.StringIO()
+    csv.writer(buffer, quoting=csv.QUOTE_ALL).writerows(rows)
+    buffer.seek(0)
+
+    cursor = conn.connection.dbapi_connection.cursor()
+    cursor.copy_expert(
+        f"COPY {table.name} ({', '.join(header)}) FROM STDIN WITH CSV",
+        buffer)
+
+
+def insert_chunk(conn, table, header, rows):
+    """Load rows with a batched INSERT (executemany)."""
+
+    columns = [table.c[name] for name in header]
+
+    conn.execute(table.insert(), [
+        {
+            column.key: (datetime.fromisoformat(value)
+                         if isinstance(column.type, DateTime) else value)
+            for column, value in zip(columns, row)
+        }
+        for row in rows
+    ])
+
+
+def load_csv(conn, table, path, chunk_size):
+    """Stream the CSV at `path` into `table`, reporting progress."""
+
+    load_chunk = (copy_chunk if conn.dialect.name == 'postgresql'
+                  else insert_chunk)
+
+    start = time.perf_counter()
+    loaded = 0
+
+    for header, rows in read_chunks(path, chunk_size):
+        load_chunk(conn, table, header, rows)
+        conn.commit()
+
+        loaded += len(rows)
+        elapsed = time.perf_counter() - start
+        print(f"\r{table.name}: {loaded:,} rows, "
+              f"{loaded / elapsed:,.0f} rows/s", end='', flush=True)
+
+    print()
+
+
+def drop_deferred(conn):
+    """Drop secondary indexes and foreign keys ahead of a bulk load.
+
+    Returns what was dropped, for restore_deferred. Foreign keys are only
+    dropped on PostgreSQL (SQLite can't alter constraints, nor enforces
+    them by default).
+    """
+
+    indexes = [index for table in TABLES for index in table.indexes]
+    for index in indexes:
+        conn.execute(DropIndex(index, if_exists=True))
+
+    foreign_keys = []
+    if conn.dialect.name == 'postgresql':
+        for table in TABLES:
+            for fk in inspect(conn).get_foreign_keys(table.name):
+                conn.exec_driver_sql(
+                    f"ALTER TABLE {table.name} DROP CONSTRAINT {fk['name']}")
+            foreign_keys.extend(table.foreign_key_constraints)
+
+    conn.commit()
+    return indexes, foreign_keys
+
+
+def restore_deferred(conn, indexes, foreign_keys):
+    """Recreate what drop_deferred dropped, now the data is in."""
+
+    # Index.create skips indexes meant for other databases (see ddl_if)
+    for index in indexes:
+        index.create(conn)
+
+    for fk in foreign_keys:
+        conn.execute(AddConstraint(fk))
+
+    conn.commit()
+
+
+def seed(directory, chunk_size):
+    db.drop_all()
+    db.create_all()
+
+    # The migrations are PostgreSQL SQL
+    if db.engine.dialect.name == 'postgresql':
+        mark_all_applied()
+
+    start = time.perf_counter()
+
+    with db.engine.connect() as conn:
+        deferred = drop_deferred(conn)
+
+        for table in TABLES:
+            load_csv(conn, table, os.path.join(directory, f"{table.name}.csv"),
+                     chunk_size)
 
-db.drop_all()
-db.create_all()
+        step = time.perf_counter()
+        restore_deferred(conn, *deferred)
+        print(f"Built indexes and foreign keys in "
+              f"{time.perf_counter() - step:.1f}s")
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+    step = time.perf_counter()
+    User.reconcile_counts()
+    rebuild_timelines()
+    db.session.commit()
+    print(f"Computed counters and timelines in "
+          f"{time.perf_counter() - step:.1f}s")
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+    if db.engine.dialect.name == 'postgresql':
+        with db.engine.connect() as conn:
+            conn.exec_driver_sql("ANALYZE")
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follow, DictReader(follows))
+    print(f"Seeded in {time.perf_counter() - start:.1f}s")
 
-db.session.commit()
 
-like1 = Like.create_like(1, 322) #political red message by rgeorge
-like2 = Like.create_like(2, 322) #politcal red message
-like3 = Like.create_like(2, 200) #former hospital message by john05
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Seed the Warbler database.")
+    parser.add_argument('--dir', default='generator',
+                        help="directory of users/messages/follows/likes CSVs")
+    parser.add_argument('--chunk-size', type=int, default=50000,
+                        help="rows per COPY or INSERT batch")
+    args = parser.parse_args()
 
-db.session.commit()
+    seed(args.dir, args.chunk_size)
@@ -1,44 +1,153 @@
 "use strict";
 
-let submit
-
-//https://stackoverflow.com/questions/60510765/flask-ajax-bad-request-the-csrf-token-is-missing
-
-// var csrf_token = "{{ csrf_token() }}";
-
-// $.ajaxSetup({
-//     beforeSend: function(xhr, settings) {
-//         if (!/^(GET|HEAD|OPTIONS|TRACE)$/i.test(settings.type) && !this.crossDomain) {
-//             xhr.setRequestHeader("X-CSRFToken", csrf_token);
-//         }
-//     }
-// });
+// Like buttons ask for the state they show the opposite of (PUT to like,
+// DELETE to unlike) rather than a toggle, so a double click can't undo
+// itself, and show the state the server answers with, moving the like
+// count beside them to match.
 
 async function toggleLike(evt) {
   evt.preventDefault();
-  submit = evt;
 
-  //TODO: csrf validation is tricky, leaving it for now.
-  const url = evt.target.action
+  const $form = $(evt.target);
+  const $icon = $form.find('.bi');
+  const liked = $icon.hasClass('bi-star-fill');
+  const messageId = $form.data('message-id');
 
-  let resp = await fetch(url, {
-    method: "POST",
+  let resp = await fetch(`/api/v1/messages/${messageId}/like`, {
+    method: liked ? "DELETE" : "PUT",
     headers: {"Accept": "application/json"}
   });
+  if (!resp.ok) return;
+
   let server_response = await resp.json();
-  let $icon = $(evt.target).find('.bi');
+  const nowLiked = server_response.data.liked;
 
-  handleToggle(server_response, $icon);
+  showLike($icon, nowLiked);
+  if (nowLiked !== liked) {
+    addToLikeCount($form, nowLiked ? 1 : -1);
+  }
+}
 
+function showLike($icon, liked) {
+  $icon.toggleClass('bi-star-fill', liked);
+  $icon.toggleClass('bi-star', !liked);
 }
 
-function handleToggle(server_response, icon){
-  if (server_response["status"] === "ok"){
-    icon.toggleClass('bi-star-fill');
-    icon.toggleClass('bi-star');
+// The count is only shown when there are likes, as the template does.
+function addToLikeCount($form, delta) {
+  let $count = $form.siblings('.like-count');
+  if (!$count.length) {
+    $count = $('<small class="text-muted like-count">0</small>')
+      .insertAfter($form);
+  }
+
+  const count = parseInt($count.text(), 10) + delta;
+  if (count > 0) {
+    $count.text(count);
+  } else {
+    $count.remove();
   }
 }
 
 const $message = $('#messages')
 
-$message.on("submit", toggleLike)
\ No newline at end of file
+$message.on("submit", toggleLike)
+
+// Infinite scroll: lists rendered with a data-next-cursor attribute fetch
+// their next page as JSON when the user nears the bottom of the page.
+
+const $pagedList = $('#messages, #users').filter('[data-next-cursor]');
+let loadingPage = false;
+
+async function loadNextPage() {
+  const cursor = $pagedList.attr('data-next-cursor');
+  if (loadingPage || !cursor) return;
+
+  loadingPage = true;
+
+  const params = new URLSearchParams(window.location.search);
+  params.set('cursor', cursor);
+
+  let resp = await fetch(`${window.location.pathname}?${params}`, {
+    headers: {"Accept": "application/json"}
+  });
+  let page = await resp.json();
+
+  $pagedList.append(page.html);
+
+  if (page.next_cursor) {
+    $pagedList.attr('data-next-cursor', page.next_cursor);
+  } else {
+    $pagedList.removeAttr('data-next-cursor');
+  }
+
+  loadingPage = false;
+}
+
+function handleScroll() {
+  const distanceToBottom =
+    $(document).height() - ($(window).scrollTop() + $(window).height());
+
+  if (distanceToBottom < 600) {
+    loadNextPage();
+  }
+}
+
+$(window).on("scroll", handleScroll)
+
+// Live timeline: the home timeline listens for the ids of new messages on
+// it (see /timeline/events), and adds them to the top, a few at a time.
+
+const $liveList = $('#messages[data-events]');
+let newMessageIds = [];
+let addTimer;
+
+async function addNewMessages() {
+  const ids = newMessageIds.filter(
+    id => !$liveList.find(`[data-message-id="${id}"]`).length);
+  newMessageIds = [];
+  if (!ids.length) return;
+
+  let resp = await fetch(
+    `/messages/items?${new URLSearchParams({ids: ids.join(',')})}`);
+  if (!resp.ok) return;
+
+  $liveList.prepend(await resp.text());
+}
+
+if ($liveList.length) {
+  const after = new URLSearchParams({after: $liveList.data('after')});
+  const events = new EventSource(`${$liveList.data('events')}?${after}`);
+
+  events.onmessage = function (evt) {
+    newMessageIds.push(evt.data);
+    clearTimeout(addTimer);
+    addTimer = setTimeout(addNewMessages, 200);
+  };
+}
+
+// Search box autocomplete: suggest usernames as the user types.
+
+const $search = $('#search');
+const $suggestions = $('#search-suggestions');
+let suggestTimer;
+
+async function suggestUsers() {
+  const q = $search.val().trim();
+  if (!q) return $suggestions.empty();
+
+  let resp = await fetch(`/users/autocomplete?${new URLSearchParams({q})}`);
+  if (!resp.ok) return;
+
+  let users = await resp.json();
+
+  $suggestions.empty();
+  for (let user of users) {
+    $suggestions.append($('<option>').val(user.username));
+  }
+}
+
+$search.on("input", function () {
+  clearTimeout(suggestTimer);
+  suggestTimer = setTimeout(suggestUsers, 150);
+});
@@ -0,0 +1,240 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_api.py
+
+
+import os
+from unittest import TestCase
+
+from flask import Flask
+
+from models import db, Message, User, Like
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from api import like_buffer
+from like_buffer import LikeBuffer, LikeBufferFull
+from timeline import rebuild_timelines
+
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.drop_all()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class APITestCase(TestCase):
+    def setUp(self):
+        Like.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+
+        u1.follow(u2)
+        db.session.add_all([
+            Message(text=f"u2 message {i}", user_id=u2.id) for i in range(3)
+        ])
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.message_ids = sorted(msg.id for msg in Message.query.all())
+
+        Like.create_like(user_id=self.u1_id, message_id=self.message_ids[0])
+        rebuild_timelines()
+        db.session.commit()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_requires_login(self):
+        """Logged out requests get a JSON 401"""
+        resp = app.test_client().get("/api/v1/timeline")
+
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(resp.json['error']['code'], 401)
+
+    def test_timeline(self):
+        """The timeline lists followed users' messages, newest first"""
+        resp = self.client.get("/api/v1/timeline")
+        messages = resp.json['data']
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([msg['id'] for msg in messages],
+                         sorted(self.message_ids, reverse=True))
+        self.assertEqual(messages[0]['user'],
+                         {'id': self.u2_id, 'username': "u2",
+                          'image_url': messages[0]['user']['image_url']})
+        self.assertEqual([msg['liked'] for msg in messages],
+                         [False, False, True])
+        self.assertIsNone(resp.json['next_cursor'])
+
+    def test_pagination(self):
+        """limit and cursor page through a list"""
+        resp = self.client.get(f"/api/v1/users/{self.u2_id}/messages?limit=2")
+        self.assertEqual(len(resp.json['data']), 2)
+
+        resp = self.client.get(f"/api/v1/users/{self.u2_id}/messages",
+                               query_string={
+                                   'limit': 2,
+                                   'cursor': resp.json['next_cursor']})
+        self.assertEqual([msg['id'] for msg in resp.json['data']],
+                         [self.message_ids[0]])
+        self.assertIsNone(resp.json['next_cursor'])
+
+    def test_field_selection(self):
+        """fields limits the fields returned, and rejects unknown ones"""
+        resp = self.client.get(f"/api/v1/users/{self.u2_id}?fields=id,username")
+        self.assertEqual(resp.json['data'],
+                         {'id': self.u2_id, 'username': "u2"})
+
+        resp = self.client.get(f"/api/v1/users/{self.u2_id}?fields=id,email")
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn("email", resp.json['error']['message'])
+
+    def test_follows_and_likes(self):
+        """Followers, following and likes list users and messages"""
+        resp = self.client.get(f"/api/v1/users/{self.u2_id}/followers")
+        self.assertEqual([user['username'] for user in resp.json['data']],
+                         ["u1"])
+
+        resp = self.client.get(f"/api/v1/users/{self.u1_id}/following")
+        self.assertEqual(resp.json['data'][0]['is_following'], True)
+
+        resp = self.client.get(f"/api/v1/users/{self.u1_id}/likes")
+        self.assertEqual([msg['id'] for msg in resp.json['data']],
+                         [self.message_ids[0]])
+
+    def test_message(self):
+        """A single message, or a JSON 404"""
+        resp = self.client.get(f"/api/v1/messages/{self.message_ids[1]}")
+        self.assertEqual(resp.json['data']['text'], "u2 message 1")
+
+        resp = self.client.get("/api/v1/messages/0")
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(resp.json['error']['code'], 404)
+
+    def test_conditional_get(self):
+        """A matching If-None-Match gets an empty 304"""
+        resp = self.client.get("/api/v1/timeline")
+        etag = resp.headers['ETag']
+
+        self.assertIn('no-cache', resp.headers['Cache-Control'])
+
+        resp = self.client.get("/api/v1/timeline",
+                               headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, b"")
+
+        Like.query.delete()
+        db.session.commit()
+
+        resp = self.client.get("/api/v1/timeline",
+                               headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_set_like(self):
+        """PUT and DELETE set a like idempotently, written on flush"""
+        url = f"/api/v1/messages/{self.message_ids[1]}/like"
+
+        for method, liked in [('put', True), ('put', True), ('delete', False),
+                              ('put', True)]:
+            resp = getattr(self.client, method)(url)
+            self.assertEqual(resp.json['data'],
+                             {'message_id': self.message_ids[1],
+                              'liked': liked})
+
+        like_buffer.flush()
+        db.session.expire_all()
+
+        self.assertIsNotNone(Like.query.get((self.message_ids[1], self.u1_id)))
+        self.assertEqual(User.query.get(self.u1_id).likes_count, 2)
+
+        self.client.delete(url)
+        self.client.delete(url)
+        like_buffer.flush()
+        db.session.expire_all()
+
+        self.assertEqual(User.query.get(self.u1_id).likes_count, 1)
+        self.assertEqual(self.client.put("/api/v1/messages/0/like").status_code,
+                         404)
+
+    def test_like_buffer_coalesces(self):
+        """Changes to one like are written once, in their latest state"""
+        buffer = LikeBuffer(flush_seconds=60)
+        buffer.app = app
+
+        for liked in (False, True, False):
+            buffer.set(self.u1_id, self.message_ids[0], liked)
+        buffer.set(self.u1_id, self.message_ids[2], True)
+
+        self.assertEqual(buffer.flush(), 2)
+        self.assertEqual(buffer.flush(), 0)
+
+        db.session.expire_all()
+        self.assertEqual({like.message_id for like in
+                          Like.query.filter_by(user_id=self.u1_id)},
+                         {self.message_ids[2]})
+        self.assertEqual(User.query.get(self.u1_id).likes_count, 1)
+
+    def test_like_buffer_deleted_liker(self):
+        """Likes by users who deleted their account since are skipped"""
+        buffer = LikeBuffer(flush_seconds=60)
+        buffer.app = app
+
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        u4 = User.signup("u4", "u4@email.com", "password", None)
+        db.session.commit()
+
+        for user_id in (u3.id, u4.id, self.u1_id):
+            buffer.set(user_id, self.message_ids[2], True)
+
+        u3.delete_account()
+        u4.tombstone()
+        db.session.commit()
+
+        buffer.flush()
+
+        self.assertEqual(buffer._pending, {})
+        self.assertEqual([like.user_id for like in
+                          Like.query.filter_by(message_id=self.message_ids[2])],
+                         [self.u1_id])
+
+    def test_like_buffer_limit(self):
+        """Changes that fail to write are kept, up to LIKE_BUFFER_LIMIT"""
+        down = Flask(__name__)
+        down.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler_missing"
+        db.init_app(down)
+
+        buffer = LikeBuffer(flush_seconds=60, limit=2)
+        buffer.app = down
+
+        buffer.set(self.u1_id, self.message_ids[1], True)
+        buffer.set(self.u1_id, self.message_ids[2], True)
+
+        self.assertEqual(buffer.flush(), 0)
+        self.assertEqual(len(buffer._pending), 2)
+
+        buffer.set(self.u1_id, self.message_ids[1], False)
+
+        with self.assertRaises(LikeBufferFull):
+            buffer.set(self.u1_id, self.message_ids[0], False)
@@ -0,0 +1,165 @@
+"""ASGI app tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_asgi.py
+
+
+import os
+import time
+from unittest import TestCase
+
+from starlette.testclient import TestClient
+
+from models import db, Message, User, Like
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app as flask_app, replicas, CURR_USER_KEY
+from api import like_buffer
+from asgi import app
+from replicas import PRIMARY_UNTIL, Replica
+from timeline import rebuild_timelines
+
+flask_app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+flask_app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.drop_all()
+db.create_all()
+
+flask_app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ASGITestCase(TestCase):
+    def setUp(self):
+        Like.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+
+        u1.follow(u2)
+        db.session.add_all([
+            Message(text=f"u2 message {i}", user_id=u2.id) for i in range(3)
+        ])
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.message_ids = sorted(msg.id for msg in Message.query.all())
+
+        Like.create_like(user_id=self.u1_id, message_id=self.message_ids[0])
+        rebuild_timelines()
+        db.session.commit()
+
+        self.flask_client = flask_app.test_client()
+        with self.flask_client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+        serializer = flask_app.session_interface.get_signing_serializer(
+            flask_app)
+
+        self.client = TestClient(app)
+        self.client.__enter__()
+        self.client.cookies.set(flask_app.config['SESSION_COOKIE_NAME'],
+                                serializer.dumps({CURR_USER_KEY: self.u1_id}))
+
+    def tearDown(self):
+        self.client.__exit__(None, None, None)
+        db.session.rollback()
+
+    def test_same_as_flask(self):
+        """The async routes answer exactly as the Flask ones"""
+        for path in ["/api/v1/timeline",
+                     "/api/v1/timeline?limit=2",
+                     f"/api/v1/users/{self.u2_id}",
+                     f"/api/v1/users/{self.u2_id}?fields=id,is_following",
+                     f"/api/v1/users/{self.u2_id}/messages?limit=2",
+                     f"/api/v1/messages/{self.message_ids[0]}"]:
+            resp = self.client.get(path)
+            expected = self.flask_client.get(path)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json(), expected.json)
+            self.assertEqual(resp.headers['ETag'], expected.headers['ETag'])
+
+    def test_errors(self):
+        """Errors are JSON, as from the Flask API"""
+        resp = TestClient(app).get("/api/v1/timeline")
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(resp.json()['error']['code'], 401)
+
+        self.assertEqual(self.client.get("/api/v1/messages/0").status_code,
+                         404)
+
+        resp = self.client.get(f"/api/v1/users/{self.u2_id}?fields=email")
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn("email", resp.json()['error']['message'])
+
+    def test_conditional_get(self):
+        """A matching If-None-Match gets an empty 304"""
+        etag = self.client.get("/api/v1/timeline").headers['ETag']
+
+        resp = self.client.get("/api/v1/timeline",
+                               headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.content, b"")
+
+    def test_set_like(self):
+        """PUT and DELETE set likes through the like buffer"""
+        url = f"/api/v1/messages/{self.message_ids[1]}/like"
+
+        resp = self.client.put(url)
+        self.assertEqual(resp.json()['data'],
+                         {'message_id': self.message_ids[1], 'liked': True})
+        self.client.delete(f"/api/v1/messages/{self.message_ids[0]}/like")
+
+        like_buffer.flush()
+        db.session.expire_all()
+
+        self.assertEqual({like.message_id for like in
+                          Like.query.filter_by(user_id=self.u1_id)},
+                         {self.message_ids[1]})
+        self.assertEqual(self.client.put("/api/v1/messages/0/like")
+                         .status_code, 404)
+
+    def test_like_pins_to_primary(self):
+        """Setting a like has the browser read from the primary, as Flask
+        writes do, while replicas could be missing it"""
+        url = f"/api/v1/messages/{self.message_ids[1]}/like"
+        name = flask_app.config['SESSION_COOKIE_NAME']
+        serializer = flask_app.session_interface.get_signing_serializer(
+            flask_app)
+
+        self.assertNotIn(name, self.client.put(url).cookies)
+
+        saved = replicas.replicas
+        replicas.replicas = [Replica(db.engine)]
+
+        try:
+            resp = self.client.put(url)
+        finally:
+            replicas.replicas = saved
+
+        session = serializer.loads(resp.cookies[name])
+        self.assertEqual(session[CURR_USER_KEY], self.u1_id)
+        self.assertGreater(session[PRIMARY_UNTIL], time.time())
+
+    def test_flask_views(self):
+        """Everything else is served by the Flask app"""
+        resp = self.client.get(f"/users/{self.u2_id}")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("@u2", resp.text)
+
+        resp = self.client.get(f"/api/v1/users/{self.u2_id}/followers")
+        self.assertEqual([user['username'] for user in resp.json()['data']],
+                         ["u1"])
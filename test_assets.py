@@ -0,0 +1,99 @@
+"""Static asset pipeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from build_assets import build
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, assets
+
+CSS = b'body { background: url("/static/images/bg.png"); }\n' * 20
+
+
+class AssetsTestCase(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.static = os.path.join(self.tmp, 'static')
+        os.makedirs(os.path.join(self.static, 'images'))
+
+        with open(os.path.join(self.static, 'images', 'bg.png'), 'wb') as f:
+            f.write(b'\x89PNG not really')
+        with open(os.path.join(self.static, 'style.css'), 'wb') as f:
+            f.write(CSS)
+
+        self.out = os.path.join(self.tmp, 'dist')
+        self.manifest = build(self.static, self.out)
+
+        self.original_dir = assets.directory
+        assets.load(self.out)
+
+    def tearDown(self):
+        assets.load(self.original_dir)
+        shutil.rmtree(self.tmp)
+
+    def read(self, path):
+        with open(os.path.join(self.out, path), 'rb') as f:
+            return f.read()
+
+    def test_build(self):
+        """Files are fingerprinted, and stylesheets point at the copies"""
+        self.assertRegex(self.manifest['style.css'],
+                         r'^style\.[0-9a-f]{12}\.css$')
+
+        css = self.read(self.manifest['style.css'])
+        self.assertIn(f'url("/assets/{self.manifest["images/bg.png"]}")'
+                      .encode(), css)
+
+        self.assertEqual(
+            gzip.decompress(self.read(self.manifest['style.css'] + '.gz')),
+            css)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.out, self.manifest['images/bg.png'] + '.gz')))
+
+    def test_serve(self):
+        """Built files are immutable, and gzipped for clients accepting it"""
+        url = f"/assets/{self.manifest['style.css']}"
+
+        with app.test_client() as c:
+            resp = c.get(url, headers={'Accept-Encoding': 'gzip, deflate'})
+            self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(resp.mimetype, 'text/css')
+            self.assertIn('immutable', resp.headers['Cache-Control'])
+            self.assertIn('max-age=31536000', resp.headers['Cache-Control'])
+            self.assertEqual(resp.headers['Vary'], 'Accept-Encoding')
+            self.assertNotIn('Set-Cookie', resp.headers)
+            resp.close()
+
+            resp = c.get(url)
+            self.assertNotIn('Content-Encoding', resp.headers)
+            self.assertEqual(resp.get_data(),
+                             self.read(self.manifest['style.css']))
+            resp.close()
+
+            self.assertEqual(c.get("/assets/style.css").status_code, 404)
+
+    def test_asset_url(self):
+        """asset_url links to the built file, or the static one without it"""
+        with app.test_request_context():
+            self.assertEqual(assets.url('style.css'),
+                             f"/assets/{self.manifest['style.css']}")
+
+            assets.load(os.path.join(self.tmp, 'unbuilt'))
+            self.assertEqual(assets.url('style.css'), "/static/style.css")
@@ -0,0 +1,129 @@
+"""Fragment cache tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_fragment_cache.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, Message, User, Like
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, fragment_cache, CURR_USER_KEY
+
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.drop_all()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class FragmentCacheTestCase(TestCase):
+    def setUp(self):
+        Like.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+
+        msg = Message(text="hello <b>", user_id=u2.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        Like.create_like(user_id=u1.id, message_id=msg.id)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.msg_id = msg.id
+
+        fragment_cache.clear()
+        fragment_cache.hits = fragment_cache.misses = 0
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def get(self, url, user_id):
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            return c.get(url).get_data(as_text=True)
+
+    def test_reuses_fragments(self):
+        """A message is rendered once, then reused on other pages"""
+        first = self.get(f"/users/{self.u2_id}", self.u1_id)
+        second = self.get(f"/users/{self.u1_id}/likes", self.u1_id)
+
+        self.assertEqual((fragment_cache.hits, fragment_cache.misses), (1, 1))
+        self.assertIn("hello &lt;b&gt;", first)
+        self.assertIn("hello &lt;b&gt;", second)
+
+    def test_overlay_per_viewer(self):
+        """Each viewer sees their own like star on a shared fragment"""
+        liker = self.get(f"/users/{self.u2_id}", self.u1_id)
+        author = self.get(f"/users/{self.u2_id}", self.u2_id)
+
+        self.assertEqual(fragment_cache.hits, 1)
+        self.assertIn("bi-star-fill", liker)
+        self.assertNotIn("bi-star", author)
+
+    def test_follow_button_overlay(self):
+        """User cards show the viewer's follow button"""
+        self.get("/users", self.u1_id)
+        page = self.get("/users", self.u2_id)
+
+        self.assertEqual(fragment_cache.hits, 2)
+        self.assertIn(f'action="/users/follow/{self.u1_id}"', page)
+        self.assertNotIn(f'action="/users/stop-following/{self.u1_id}"', page)
+
+    def test_author_change(self):
+        """Fragments are rendered again after their author changes"""
+        self.get(f"/users/{self.u2_id}", self.u1_id)
+
+        user = db.session.get(User, self.u2_id)
+        user.username = "renamed"
+        db.session.commit()
+
+        page = self.get(f"/users/{self.u2_id}", self.u1_id)
+
+        self.assertEqual(fragment_cache.misses, 2)
+        self.assertIn("@renamed", page)
+
+    def test_counter_change(self):
+        """Counter updates leave fragments, which don't show them, cached"""
+        self.get(f"/users/{self.u2_id}", self.u1_id)
+
+        User.adjust_counts([self.u2_id], followers_count=1)
+        db.session.commit()
+
+        self.get(f"/users/{self.u2_id}", self.u1_id)
+
+        self.assertEqual((fragment_cache.hits, fragment_cache.misses), (1, 1))
+
+    def test_delete_message(self):
+        """Deleting a message drops its fragment"""
+        self.get(f"/users/{self.u2_id}", self.u1_id)
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            c.post(f"/messages/{self.msg_id}/delete")
+
+        self.assertIsNone(fragment_cache.fragments.get(('message',
+                                                        self.msg_id)))
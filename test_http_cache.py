@@ -0,0 +1,150 @@
+"""HTTP caching tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_http_cache.py
+
+
+import os
+from unittest import TestCase
+
+from flask import template_rendered
+
+from models import db, Message, User, Like
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.drop_all()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class HTTPCacheTestCase(TestCase):
+    def setUp(self):
+        Like.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+
+        msg = Message(text="hello", user_id=u2.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.msg_id = msg.id
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+        self.rendered = []
+        template_rendered.connect(self.record_render, app)
+
+    def tearDown(self):
+        template_rendered.disconnect(self.record_render, app)
+        db.session.rollback()
+
+    def record_render(self, sender, template, context, **extra):
+        self.rendered.append(template.name)
+
+    def revalidate(self, url, etag):
+        return self.client.get(url, headers={'If-None-Match': etag})
+
+    def test_profile_revalidates(self):
+        """A profile gets a 304, without rendering, until it changes"""
+        url = f"/users/{self.u2_id}"
+        resp = self.client.get(url)
+        etag = resp.headers['ETag']
+
+        self.assertTrue(etag.startswith('W/'))
+        self.assertIn('private', resp.headers['Cache-Control'])
+        self.assertIn('no-cache', resp.headers['Cache-Control'])
+
+        self.rendered.clear()
+        resp = self.revalidate(url, etag)
+
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, b"")
+        self.assertEqual(self.rendered, [])
+
+        User.adjust_counts([self.u2_id], messages_count=1)
+        db.session.commit()
+
+        self.assertEqual(self.revalidate(url, etag).status_code, 200)
+
+    def test_viewer_changes(self):
+        """A page changes when the viewer likes or follows something"""
+        url = f"/messages/{self.msg_id}"
+        etag = self.client.get(url).headers['ETag']
+
+        self.assertEqual(self.revalidate(url, etag).status_code, 304)
+
+        self.client.post(f"/messages/{self.msg_id}/toggle-like")
+
+        self.assertEqual(self.revalidate(url, etag).status_code, 200)
+
+    def test_like_counts_change(self):
+        """Pages showing like counts change when someone else likes"""
+        urls = [f"/users/{self.u2_id}", f"/messages/{self.msg_id}"]
+        etags = [self.client.get(url).headers['ETag'] for url in urls]
+
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.flush()
+        Like.create_like(user_id=u3.id, message_id=self.msg_id)
+        db.session.commit()
+
+        for url, etag in zip(urls, etags):
+            resp = self.revalidate(url, etag)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b'like-count">1</small>', resp.data)
+
+    def test_anonymous_homepage(self):
+        """The logged out homepage is public, with a strong ETag"""
+        client = app.test_client()
+        resp = client.get("/")
+        etag = resp.headers['ETag']
+
+        self.assertFalse(etag.startswith('W/'))
+        self.assertIn('public', resp.headers['Cache-Control'])
+        self.assertIn('max-age=300', resp.headers['Cache-Control'])
+
+        resp = client.get("/", headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+
+    def test_flashes_not_cached(self):
+        """A page showing flashed messages isn't cached"""
+        with self.client.session_transaction() as sess:
+            sess['_flashes'] = [('success', "Hello!")]
+
+        resp = self.client.get(f"/users/{self.u2_id}")
+
+        self.assertIn(b"Hello!", resp.data)
+        self.assertNotIn('ETag', resp.headers)
+        self.assertIn('no-store', resp.headers['Cache-Control'])
+
+    def test_other_pages(self):
+        """404s are briefly cacheable; pages without a policy aren't"""
+        resp = self.client.get("/users/0")
+        self.assertEqual(resp.status_code, 404)
+        self.assertIn('max-age=60', resp.headers['Cache-Control'])
+
+        resp = self.client.get("/users")
+        self.assertNotIn('ETag', resp.headers)
+        self.assertIn('no-store', resp.headers['Cache-Control'])
@@ -0,0 +1,176 @@
+"""Request instrumentation tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_instrumentation.py
+
+
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from models import db, hasher, User, Message, Like
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, instrumentation, metric_stats, CURR_USER_KEY
+
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.drop_all()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class InstrumentationTestCase(TestCase):
+    def setUp(self):
+        Like.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.rounds = hasher.rounds
+        hasher.rounds = 4
+
+        self.user = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.user_id = self.user.id
+
+        instrumentation.routes.clear()
+        self.slow_request_seconds = instrumentation.slow_request_seconds
+
+    def tearDown(self):
+        db.session.rollback()
+        hasher.rounds = self.rounds
+        instrumentation.slow_request_seconds = self.slow_request_seconds
+        app.config['METRICS_TOKEN'] = None
+
+    def totals(self, method, rule):
+        return instrumentation.routes[(method, rule)]
+
+    def test_records_request(self):
+        """Requests are counted by route and status, with SQL and templates"""
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            c.get(f"/users/{self.user_id}")
+            c.get(f"/users/{self.user_id}")
+            c.get("/users/0")
+
+        totals = self.totals('GET', '/users/<int:user_id>')
+        self.assertEqual(totals.count, 3)
+        self.assertEqual(totals.statuses, {200: 2, 404: 1})
+        self.assertGreater(totals.totals['sql_statements'], 0)
+        self.assertGreater(totals.totals['template_seconds'], 0)
+        self.assertEqual(totals.totals['hash_seconds'], 0)
+
+    def test_records_password_hashing(self):
+        """Time spent checking passwords is attributed to the request"""
+        with app.test_client() as c:
+            resp = c.post("/login", data={"username": "u1",
+                                          "password": "password"})
+            self.assertEqual(resp.status_code, 302)
+
+        self.assertGreater(
+            self.totals('POST', '/login').totals['hash_seconds'], 0)
+
+    def test_metrics(self):
+        """/metrics renders the totals in the Prometheus text format"""
+        app.config['METRICS_TOKEN'] = "secret"
+
+        with app.test_client() as c:
+            c.get("/login")
+            resp = c.get("/metrics",
+                         headers={'Authorization': "Bearer secret"})
+
+        text = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('warbler_requests_total{method="GET",route="/login",'
+                      'status="200"} 1', text)
+        self.assertIn('warbler_request_duration_seconds_count{method="GET",'
+                      'route="/login"} 1', text)
+        self.assertIn('warbler_request_sql_statements_sum{method="GET",'
+                      'route="/login"}', text)
+        self.assertIn('warbler_password_hashes_total', text)
+        self.assertIn('warbler_db_pool_checkouts_total{pool="primary"}', text)
+
+    def test_shared_metrics(self):
+        """/metrics adds up the totals of every process sharing them,
+        leaving out the gauges of those that have exited"""
+        app.config['METRICS_TOKEN'] = "secret"
+        directory = tempfile.mkdtemp()
+        instrumentation.share_metrics(directory, metric_stats)
+
+        # A worker that has since exited
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        try:
+            with app.test_client() as c:
+                c.get("/login")
+
+                hasher_stats, pools = metric_stats()
+                hasher_stats['pending'] = 5
+                hasher_stats['hashes'] += 3
+                exited = instrumentation.snapshot(hasher_stats, pools)
+                exited['pid'] = pid
+
+                with open(os.path.join(directory, f"{pid}.json"), 'w') as f:
+                    json.dump(exited, f)
+
+                text = c.get("/metrics",
+                             headers={'Authorization': "Bearer secret"}).text
+        finally:
+            instrumentation.metrics_dir = None
+            shutil.rmtree(directory)
+
+        hashes = hasher.stats()['hashes']
+
+        self.assertIn('warbler_requests_total{method="GET",route="/login",'
+                      'status="200"} 2', text)
+        self.assertIn(f"warbler_password_hashes_total {2 * hashes + 3}\n",
+                      text)
+        self.assertIn("warbler_password_hashes_pending 0\n", text)
+
+    def test_metrics_token(self):
+        """/metrics requires METRICS_TOKEN, and is off without one"""
+        with app.test_client() as c:
+            self.assertEqual(c.get("/metrics").status_code, 404)
+
+        app.config['METRICS_TOKEN'] = "secret"
+
+        with app.test_client() as c:
+            self.assertEqual(c.get("/metrics").status_code, 401)
+            self.assertEqual(
+                c.get("/metrics",
+                      headers={'Authorization': "Bearer secret"}).status_code,
+                200)
+
+    def test_slow_request_log(self):
+        """Slow requests are logged with their slowest SQL statements"""
+        instrumentation.slow_request_seconds = 0
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            with self.assertLogs('warbler.slow_requests') as logs:
+                c.get(f"/users/{self.user_id}")
+
+        self.assertIn(f"Slow request: GET /users/{self.user_id}",
+                      logs.output[0])
+        self.assertIn("SELECT", logs.output[0])
@@ -110,3 +110,36 @@ class MessageModelTestCase(TestCase):
 
 
 
+
+    def test_set_liked(self):
+        """Test set_liked is idempotent, and only counts real changes"""
+        Like.set_liked({(self.u2_id, self.m1_id): True,
+                        (self.u1_id, self.m1_id): True})
+        Like.set_liked({(self.u1_id, self.m1_id): True})
+        db.session.commit()
+
+        self.assertEqual(User.query.get(self.u1_id).likes_count, 1)
+        self.assertEqual(User.query.get(self.u2_id).likes_count, 1)
+
+        Like.set_liked({(self.u2_id, self.m1_id): False})
+        Like.set_liked({(self.u2_id, self.m1_id): False})
+        db.session.commit()
+
+        self.assertEqual(len(Message.query.get(self.m1_id).users_like), 1)
+        self.assertEqual(User.query.get(self.u2_id).likes_count, 0)
+
+    def test_like_state_among(self):
+        """Like state covers only the messages asked about, with counts"""
+        Like.create_like(user_id=self.u1_id, message_id=self.m1_id)
+        Like.create_like(user_id=self.u2_id, message_id=self.m2_id)
+        db.session.commit()
+
+        state = Like.like_state_among(self.u2_id, [self.m1_id])
+        self.assertEqual(state.liked_ids, {self.m1_id})
+        self.assertEqual(state.counts, {self.m1_id: 2})
+
+        state = Like.like_state_among(self.u1_id, [self.m1_id, self.m2_id])
+        self.assertEqual(state.liked_ids, {self.m1_id})
+        self.assertEqual(state.counts, {self.m1_id: 2, self.m2_id: 1})
+
+        self.assertEqual(Like.like_state_among(self.u1_id, []), (set(), {}))
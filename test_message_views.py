@@ -8,7 +8,7 @@
 import os
 from unittest import TestCase
 
-from models import db, Message, User, Like
+from models import db, Message, User, Like, TimelineEntry
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -20,6 +20,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+import timeline
 
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
@@ -218,3 +219,214 @@ class LikeViewTestCase(MessageBaseViewTestCase):
 
         message = Message.query.get(self.m1_id)
         self.assertEqual(len(message.users_like), 0)
+
+
+    def test_like_counters(self):
+        """Test liking, and deleting a liked message, update like counters"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            c.post(f'/messages/{self.m2_id}/toggle-like')
+            self.assertEqual(User.query.get(self.u2_id).likes_count, 2)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f'/messages/{self.m1_id}/delete')
+            self.assertEqual(User.query.get(self.u2_id).likes_count, 1)
+
+    def test_like_state_on_page(self):
+        """Pages show whether each message is liked, and its like count"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.get(f'/users/{self.u1_id}')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(html.count('bi-star-fill'), 1)
+            self.assertIn('like-count">1</small>', html)
+
+class TimelineViewTestCase(MessageBaseViewTestCase):
+    def test_new_message_fans_out_to_followers(self):
+        """A posted message shows up on a follower's homepage"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            c.post(f'/users/follow/{self.u1_id}')
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post("/messages/new", data={"text": "fanned-out-text"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.get('/')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("fanned-out-text", html)
+
+    def test_unfollow_removes_messages(self):
+        """Unfollowing an author removes their messages from the homepage"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            c.post(f'/users/follow/{self.u1_id}')
+
+            resp = c.get('/')
+            self.assertIn("m1-text", resp.get_data(as_text=True))
+
+            c.post(f'/users/stop-following/{self.u1_id}')
+
+            resp = c.get('/')
+            self.assertNotIn("m1-text", resp.get_data(as_text=True))
+
+    def test_high_fanout_author_read_on_demand(self):
+        """Messages from very popular authors are merged in at read time"""
+        limit = timeline.FANOUT_FOLLOWER_LIMIT
+        timeline.FANOUT_FOLLOWER_LIMIT = 1
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u2_id
+
+                c.post(f'/users/follow/{self.u1_id}')
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1_id
+
+                c.post("/messages/new", data={"text": "pulled-text"})
+
+                self.assertEqual(
+                    TimelineEntry.query.filter_by(user_id=self.u2_id).count(), 0)
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u2_id
+
+                resp = c.get('/')
+                self.assertIn("pulled-text", resp.get_data(as_text=True))
+        finally:
+            timeline.FANOUT_FOLLOWER_LIMIT = limit
+
+    def test_dropped_author_backfilled(self):
+        """Messages posted while fanned out on read stay on followers'
+        homepages once the author drops well below the limit"""
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.commit()
+        u3_id = u3.id
+
+        limits = timeline.FANOUT_FOLLOWER_LIMIT, timeline.FANOUT_RESUME_LIMIT
+        timeline.FANOUT_FOLLOWER_LIMIT = 2
+        timeline.FANOUT_RESUME_LIMIT = 1
+
+        def backfill():
+            result = app.test_cli_runner().invoke(args=['backfill-timelines'])
+            db.session.expire_all()
+            return result.output
+
+        try:
+            with self.client as c:
+                for user_id in (self.u2_id, u3_id):
+                    with c.session_transaction() as sess:
+                        sess[CURR_USER_KEY] = user_id
+
+                    c.post(f'/users/follow/{self.u1_id}')
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1_id
+
+                c.post("/messages/new", data={"text": "pulled-text"})
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = u3_id
+
+                c.post(f'/users/stop-following/{self.u1_id}')
+
+                # Below the limit, but not yet below the resume limit
+                self.assertIn("Switched 0 author(s)", backfill())
+                self.assertTrue(User.query.get(self.u1_id).fanout_on_read)
+                self.assertEqual(
+                    TimelineEntry.query.filter_by(user_id=self.u2_id).count(),
+                    2)
+
+                timeline.FANOUT_RESUME_LIMIT = 2
+
+                self.assertIn("Switched 1 author(s)", backfill())
+                self.assertFalse(User.query.get(self.u1_id).fanout_on_read)
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u2_id
+
+                resp = c.get('/')
+                self.assertIn("pulled-text", resp.get_data(as_text=True))
+                self.assertEqual(
+                    TimelineEntry.query.filter_by(user_id=self.u2_id).count(),
+                    3)
+        finally:
+            timeline.FANOUT_FOLLOWER_LIMIT, timeline.FANOUT_RESUME_LIMIT = limits
+
+
+class MessageSearchViewTestCase(MessageBaseViewTestCase):
+    def test_search_new_and_deleted_messages(self):
+        """Posted messages are searchable at once, deleted ones vanish"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post("/messages/new", data={"text": "Purple giraffes dance"})
+
+            resp = c.get('/messages/search?q=giraffe*')
+            self.assertIn("Purple giraffes dance", resp.get_data(as_text=True))
+
+            msg = Message.query.filter_by(text="Purple giraffes dance").one()
+            c.post(f'/messages/{msg.id}/delete')
+
+            resp = c.get('/messages/search?q=giraffe*')
+            html = resp.get_data(as_text=True)
+            self.assertNotIn("Purple giraffes dance", html)
+            self.assertIn("Sorry, no warbles found", html)
+
+    def test_search_phrase(self):
+        """Quoted words must appear together and in order"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get('/messages/search?q="test text3"')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("test_text3", html)
+            self.assertNotIn("test_text2", html)
+
+            resp = c.get('/messages/search?q="text3 test"')
+            self.assertNotIn("test_text3", resp.get_data(as_text=True))
+
+    def test_search_following_only(self):
+        """Searches can be limited to users we follow"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.get('/messages/search?q=test&following=1')
+            self.assertNotIn("test_text2", resp.get_data(as_text=True))
+
+            c.post(f'/users/follow/{self.u1_id}')
+
+            resp = c.get('/messages/search?q=test&following=1')
+            html = resp.get_data(as_text=True)
+            self.assertIn("test_text2", html)
+            self.assertNotIn("test_text3", html)
+
+    def test_search_logged_out(self):
+        with self.client as c:
+            resp = c.get('/messages/search?q=test', follow_redirects=True)
+
+            self.assertIn("Access unauthorized", resp.get_data(as_text=True))
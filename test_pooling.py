@@ -0,0 +1,102 @@
+"""Connection pool tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_pooling.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import NullPool
+
+from pooling import TimedQueuePool, async_engine_options, engine_options
+from pooling import pool_stats
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+
+class EngineOptionsTestCase(TestCase):
+    def test_pool_sizing(self):
+        """Each worker gets a pool for its threads, within its share"""
+        options = engine_options({'WEB_CONCURRENCY': '4',
+                                  'GUNICORN_THREADS': '2',
+                                  'DB_MAX_CONNECTIONS': '20'})
+
+        self.assertEqual(options['poolclass'], TimedQueuePool)
+        self.assertEqual(options['pool_size'], 3)
+        self.assertEqual(options['max_overflow'], 2)
+        self.assertTrue(options['pool_pre_ping'])
+
+        options = engine_options({'WEB_CONCURRENCY': '8',
+                                  'GUNICORN_THREADS': '4',
+                                  'DB_MAX_CONNECTIONS': '16'})
+
+        self.assertEqual((options['pool_size'], options['max_overflow']),
+                         (2, 0))
+
+    def test_async_split(self):
+        """Served as ASGI, a worker's share is split between its engines"""
+        environ = {'WEB_CONCURRENCY': '2', 'DB_MAX_CONNECTIONS': '20',
+                   'WEB_ASYNC': '1'}
+
+        options = engine_options(environ)
+        self.assertEqual(options['pool_size'] + options['max_overflow'], 5)
+
+        options = async_engine_options(environ)
+        self.assertEqual((options['pool_size'], options['max_overflow']),
+                         (5, 0))
+
+    def test_transaction_pooling(self):
+        """Behind a transaction-pooling proxy, connections aren't pooled"""
+        options = engine_options({'DB_TRANSACTION_POOLING': '1'})
+
+        self.assertEqual(options, {'poolclass': NullPool})
+
+        options = async_engine_options({'DB_TRANSACTION_POOLING': '1'})
+        self.assertEqual(options['poolclass'], NullPool)
+        self.assertEqual(options['connect_args']['statement_cache_size'], 0)
+
+
+class TimedQueuePoolTestCase(TestCase):
+    def setUp(self):
+        self.engine = create_engine(
+            os.environ['DATABASE_URL'], poolclass=TimedQueuePool,
+            pool_size=1, max_overflow=0, pool_timeout=0.05)
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_records_checkouts(self):
+        """Checkouts, and those that time out, are counted and timed"""
+        with self.engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+
+            with self.assertRaises(TimeoutError):
+                self.engine.connect()
+
+            stats = pool_stats(self.engine)
+
+        self.assertEqual(stats['checkouts'], 1)
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(stats['checked_out'], 1)
+        self.assertGreaterEqual(stats['wait_seconds'], 0.05)
+
+    def test_dispose_keeps_stats(self):
+        """Stats carry over when an engine is disposed, e.g. after a fork"""
+        with self.engine.connect():
+            pass
+
+        self.engine.dispose(close=False)
+
+        with self.engine.connect():
+            pass
+
+        self.assertEqual(pool_stats(self.engine)['checkouts'], 2)
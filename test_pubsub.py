@@ -0,0 +1,184 @@
+"""Live timeline tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_pubsub.py
+
+
+import os
+import threading
+from unittest import TestCase
+
+from starlette.testclient import TestClient
+
+from models import db, Message, User, Like
+from pubsub import LocalBroker, MessageHub, PostgresBroker, default_broker
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, message_hub, CURR_USER_KEY
+from asgi import app as asgi_app
+from timeline import rebuild_timelines
+
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.drop_all()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class LiveTimelineTestCase(TestCase):
+    def setUp(self):
+        Like.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.commit()
+
+        u1.follow(u2)
+        db.session.add(Message(text="old", user_id=u2.id))
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.u3_id = u3.id
+        self.old_id = Message.query.one().id
+
+        rebuild_timelines()
+        db.session.commit()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u2_id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def post(self, text):
+        """Post a message as u2; return its id."""
+        self.client.post("/messages/new", data={"text": text})
+        return Message.query.filter_by(text=text).one().id
+
+    def test_publish_on_commit(self):
+        """Followers' subscriptions get new messages once committed"""
+        hub = MessageHub()
+        hub.broker = LocalBroker(app, db.session)
+
+        received, others = [], []
+        follower = hub.subscribe([self.u1_id, self.u2_id], received.append)
+        other = hub.subscribe([self.u3_id], others.append)
+
+        try:
+            for text in ("new", "rolled back"):
+                msg = Message(text=text, user_id=self.u2_id)
+                db.session.add(msg)
+                db.session.flush()
+                hub.publish(db.session, msg)
+
+                if text == "new":
+                    message_id = msg.id
+                    db.session.commit()
+
+            db.session.rollback()
+        finally:
+            hub.unsubscribe(follower)
+            hub.unsubscribe(other)
+
+        self.assertEqual(received, [message_id])
+        self.assertEqual(others, [])
+
+    def test_postgres_broker(self):
+        """The postgres broker delivers through NOTIFY, after commit"""
+        hub = MessageHub()
+        hub.broker = PostgresBroker(app, db.session)
+
+        received = threading.Event()
+        subscription = hub.subscribe([self.u2_id],
+                                     lambda id: received.set())
+        try:
+            # Give the listener time to connect
+            received.wait(0.5)
+
+            msg = Message(text="hello", user_id=self.u2_id)
+            db.session.add(msg)
+            db.session.flush()
+            hub.publish(db.session, msg)
+            self.assertFalse(received.wait(0.2))
+
+            db.session.commit()
+            self.assertTrue(received.wait(5))
+        finally:
+            hub.unsubscribe(subscription)
+
+    def test_default_broker(self):
+        """Several ASGI workers default to the broker reaching them all;
+        sync workers, which poll, to none"""
+        self.assertEqual(default_broker({}), 'none')
+        self.assertEqual(default_broker({'WEB_CONCURRENCY': '4'}), 'none')
+        self.assertEqual(default_broker({'WEB_ASYNC': '1'}), 'local')
+        self.assertEqual(default_broker({'WEB_ASYNC': '1',
+                                         'WEB_CONCURRENCY': '4'}), 'postgres')
+
+    def test_polled_events(self):
+        """Sync workers send the messages since the last event, and close"""
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+        message_id = self.post("new")
+
+        resp = self.client.get(f"/timeline/events?after={self.old_id}")
+        self.assertEqual(resp.mimetype, "text/event-stream")
+        self.assertIn("retry: ", resp.text)
+        self.assertIn(f"id: {message_id}\ndata: {message_id}\n\n", resp.text)
+        self.assertNotIn(f"id: {self.old_id}\n", resp.text)
+
+        resp = self.client.get("/timeline/events",
+                               headers={'Last-Event-ID': str(message_id)})
+        self.assertNotIn("id: ", resp.text)
+
+    def test_message_items(self):
+        """New messages are rendered as timeline items"""
+        message_id = self.post("new")
+
+        resp = self.client.get(f"/messages/items?ids={message_id},x")
+        self.assertIn(f'data-message-id="{message_id}"', resp.text)
+        self.assertIn("new", resp.text)
+
+    def test_streamed_events(self):
+        """ASGI workers stream messages as they're published"""
+        serializer = app.session_interface.get_signing_serializer(app)
+        message_id = self.post("new")
+
+        # The test client reads the whole response, so the stream must end
+        saved = app.config['SSE_STREAM_SECONDS']
+        app.config['SSE_STREAM_SECONDS'] = 1
+        publish = threading.Timer(0.5, message_hub.deliver,
+                                  (self.u2_id, 12345))
+
+        try:
+            with TestClient(asgi_app) as client:
+                client.cookies.set(
+                    app.config['SESSION_COOKIE_NAME'],
+                    serializer.dumps({CURR_USER_KEY: self.u1_id}))
+
+                publish.start()
+                resp = client.get(f"/timeline/events?after={self.old_id}")
+        finally:
+            app.config['SSE_STREAM_SECONDS'] = saved
+            publish.cancel()
+
+        self.assertEqual(resp.text,
+                         f"id: {message_id}\ndata: {message_id}\n\n"
+                         "id: 12345\ndata: 12345\n\n")
@@ -0,0 +1,157 @@
+"""SQL statement count tests.
+
+These guard against N+1 queries creeping back into the pages: each page
+should issue a fixed number of statements however many authors it shows.
+"""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_query_counts.py
+
+
+import os
+from contextlib import contextmanager
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, Message, User, Like
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from timeline import rebuild_timelines
+
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.drop_all()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+NUM_AUTHORS = 10
+
+
+@contextmanager
+def count_queries():
+    """Count the SQL statements executed inside the block."""
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+
+
+class QueryCountTestCase(TestCase):
+    def setUp(self):
+        Like.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        viewer = User.signup("viewer", "viewer@email.com", "password", None)
+        authors = [
+            User.signup(f"author{i}", f"author{i}@email.com", "password", None)
+            for i in range(NUM_AUTHORS)
+        ]
+        db.session.commit()
+
+        viewer.following.extend(authors)
+        db.session.add_all([
+            Message(text=f"author{i}-text", user_id=author.id)
+            for i, author in enumerate(authors)
+        ])
+        db.session.commit()
+
+        for message in Message.query.all():
+            Like.create_like(user_id=viewer.id, message_id=message.id)
+
+        User.reconcile_counts()
+        rebuild_timelines()
+        db.session.commit()
+
+        self.viewer_id = viewer.id
+        self.message_id = message.id
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def assertMaxQueries(self, url, max_queries, expected_text):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.viewer_id
+
+            # Make sure nothing is left loaded from setting up or a
+            # previous request
+            db.session.expire_all()
+
+            with count_queries() as statements:
+                resp = c.get(url)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(expected_text, resp.get_data(as_text=True))
+            self.assertLessEqual(len(statements), max_queries,
+                                 "\n\n".join(statements))
+
+    def test_homepage(self):
+        """Homepage query count doesn't grow with the number of authors"""
+        self.assertMaxQueries('/', 4, f"author{NUM_AUTHORS - 1}-text")
+
+    def test_likes(self):
+        """Likes page query count doesn't grow with the number of authors"""
+        self.assertMaxQueries(f'/users/{self.viewer_id}/likes', 4,
+                              f"author{NUM_AUTHORS - 1}-text")
+
+    def test_following(self):
+        """Following page query count doesn't grow with the number shown"""
+        self.assertMaxQueries(f'/users/{self.viewer_id}/following', 3,
+                              f"@author{NUM_AUTHORS - 1}")
+
+    def test_message(self):
+        """Message page loads its author with the message"""
+        self.assertMaxQueries(f'/messages/{self.message_id}', 4,
+                              "-text")
+
+    def test_delete_user(self):
+        """Deleting an account doesn't run statements per message or like"""
+        author = User.query.filter_by(username="author0").one()
+        messages = [
+            Message(text=f"extra-{i}", user_id=author.id) for i in range(20)
+        ]
+        db.session.add_all(messages)
+        db.session.commit()
+
+        for message in messages:
+            Like.create_like(user_id=self.viewer_id, message_id=message.id)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = author.id
+
+            db.session.expire_all()
+
+            with count_queries() as statements:
+                resp = c.post('/users/delete')
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertLessEqual(len(statements), 8, "\n\n".join(statements))
+
+        self.assertEqual(Message.query.filter_by(user_id=author.id).count(), 0)
+        self.assertEqual(User.reconcile_counts(), 0)
@@ -0,0 +1,123 @@
+"""Read replica routing tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_replicas.py
+#
+# They use a second database as the replica, which must exist:
+#
+#    createdb warbler_test_replica
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import create_engine, insert
+
+from models import db, Message, User, Like
+from replicas import Replica
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, replicas, fragment_cache, CURR_USER_KEY
+
+REPLICA_URL = "postgresql:///warbler_test_replica"
+
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.drop_all()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+replica_engine = create_engine(REPLICA_URL)
+db.metadata.drop_all(replica_engine)
+db.metadata.create_all(replica_engine)
+
+
+class ReplicaTestCase(TestCase):
+    def setUp(self):
+        Like.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        # The "replica" has u2 under another name, to tell reads apart
+        with replica_engine.begin() as conn:
+            conn.execute(User.__table__.delete())
+            conn.execute(insert(User.__table__), [
+                {'id': self.u1_id, 'email': "u1@email.com", 'username': "u1",
+                 'password': u1.password},
+                {'id': self.u2_id, 'email': "u2@email.com",
+                 'username': "replica-u2", 'password': u2.password},
+            ])
+
+        db.session.close()
+        fragment_cache.clear()
+
+        self.saved = replicas.replicas, replicas.max_lag
+        replicas.replicas = [Replica(replica_engine)]
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+    def tearDown(self):
+        replicas.replicas, replicas.max_lag = self.saved
+        db.session.rollback()
+
+    def profile(self):
+        return self.client.get(f"/users/{self.u2_id}").get_data(as_text=True)
+
+    def test_reads_from_replica(self):
+        """Read-only views read from the replica"""
+        self.assertIn("@replica-u2", self.profile())
+
+    def test_writes_go_to_primary(self):
+        """Flushes go to the primary, even while reading from a replica"""
+        db.session.info['replica'] = replica_engine
+        try:
+            self.assertEqual(db.session.get(User, self.u2_id).username,
+                             "replica-u2")
+
+            db.session.add(Message(text="hello", user_id=self.u2_id))
+            db.session.commit()
+        finally:
+            db.session.info.pop('replica')
+
+        with replica_engine.connect() as conn:
+            self.assertEqual(
+                conn.execute(Message.__table__.select()).all(), [])
+        self.assertEqual(Message.query.one().text, "hello")
+
+    def test_read_your_writes(self):
+        """After a POST, the browser reads from the primary for a while"""
+        self.client.post("/messages/new", data={"text": "hello"})
+
+        self.assertIn("@u2", self.profile())
+        self.assertNotIn("@replica-u2", self.profile())
+
+    def test_lagging_replica(self):
+        """Replicas too far behind, or unreachable, aren't read from"""
+        replicas.max_lag = -1
+        self.assertIn("@u2", self.profile())
+
+        replicas.max_lag = 5
+        replicas.replicas = [
+            Replica(create_engine("postgresql:///warbler_no_such_db"))]
+        with self.assertLogs('warbler.replicas'):
+            self.assertIn("@u2", self.profile())
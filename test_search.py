@@ -0,0 +1,206 @@
+"""User and message search tests.
+
+The same tests run against PostgreSQL full-text search and the SQLite FTS5
+fallback.
+"""
+
+# run these tests like:
+#
+#    python -m unittest test_search.py
+
+
+import os
+from datetime import datetime
+from unittest import TestCase
+
+from flask import Flask
+
+from models import db, Message, User, Like
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app
+from search import (
+    search_terms, search_users, autocomplete_users, parse_message_query,
+    search_messages)
+
+db.drop_all()
+db.create_all()
+
+sqlite_app = Flask('warbler_sqlite')
+sqlite_app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite://"
+db.init_app(sqlite_app)
+
+with sqlite_app.app_context():
+    db.create_all()
+
+
+class SearchTermsTestCase(TestCase):
+    def test_search_terms(self):
+        """Search strings are split into lowercase letter and digit runs"""
+        self.assertEqual(search_terms("John_Smith, 'Boston'*"),
+                         ["john", "smith", "boston"])
+        self.assertEqual(search_terms(" & | ! "), [])
+        self.assertEqual(search_terms(None), [])
+
+    def test_parse_message_query(self):
+        """Quotes make phrases and a trailing * makes a prefix"""
+        self.assertEqual(parse_message_query('"Big jo*" cats don\'t'), [
+            [('big', False), ('jo', True)],
+            [('cats', False)],
+            [('don', False), ('t', False)],
+        ])
+        self.assertEqual(parse_message_query('"unclosed phrase'),
+                         [[('unclosed', False), ('phrase', False)]])
+        self.assertEqual(parse_message_query('"" * &'), [])
+
+
+class SearchTests:
+    """Tests run inside the app context of `self.app`."""
+
+    app = None
+
+    def setUp(self):
+        self.context = self.app.app_context()
+        self.context.push()
+
+        Like.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        db.session.add_all([
+            User(username="john_smith", email="js@email.com", password="x",
+                 location="Boston", bio="I like cats"),
+            User(username="alice", email="a@email.com", password="x",
+                 location="Johnstown", bio=""),
+            User(username="bob", email="b@email.com", password="x",
+                 location="Paris", bio="Big John fan"),
+            User(username="Johanna", email="jo@email.com", password="x",
+                 location="", bio="", followers_count=5),
+        ])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.context.pop()
+
+    def usernames(self, users):
+        return [user.username for user in users]
+
+    def test_ranked(self):
+        """Username matches rank above location, then bio matches"""
+        page = search_users("john")
+
+        self.assertEqual(self.usernames(page.items),
+                         ["john_smith", "alice", "bob"])
+        self.assertIsNone(page.next_cursor)
+
+    def test_prefix_terms(self):
+        """Every term must match, as a case-insensitive prefix"""
+        self.assertEqual(self.usernames(search_users("JO sm").items),
+                         ["john_smith"])
+        self.assertEqual(self.usernames(search_users("par").items),
+                         ["bob"])
+        self.assertEqual(search_users("john paris nobody").items, [])
+
+    def test_no_terms(self):
+        """A search with nothing searchable finds nobody"""
+        self.assertEqual(search_users("%*").items, [])
+
+    def test_index_follows_updates(self):
+        """Edited and deleted users are reflected in results"""
+        bob = User.query.filter_by(username="bob").one()
+        bob.bio = "no fan of anyone"
+        db.session.delete(User.query.filter_by(username="alice").one())
+        db.session.commit()
+
+        self.assertEqual(self.usernames(search_users("john").items),
+                         ["john_smith"])
+
+    def test_pagination(self):
+        """Cursors page through ranked results without gaps or repeats"""
+        db.session.add_all([
+            User(username=f"zed{i}", email=f"zed{i}@email.com", password="x",
+                 bio="zed" * (i % 3 + 1))
+            for i in range(7)
+        ])
+        db.session.commit()
+
+        found = []
+        page = search_users("zed", per_page=3)
+        found.extend(page.items)
+
+        while page.next_cursor:
+            page = search_users("zed", page.next_cursor, per_page=3)
+            found.extend(page.items)
+
+        self.assertEqual(sorted(self.usernames(found)),
+                         [f"zed{i}" for i in range(7)])
+
+    def test_autocomplete(self):
+        """Usernames starting with the prefix, most followed first"""
+        self.assertEqual(self.usernames(autocomplete_users("JO")),
+                         ["Johanna", "john_smith"])
+        self.assertEqual(autocomplete_users("%"), [])
+        self.assertEqual(autocomplete_users(""), [])
+
+    def test_search_messages(self):
+        """Messages match words, phrases and prefixes, newest first"""
+        john = User.query.filter_by(username="john_smith").one()
+        bob = User.query.filter_by(username="bob").one()
+        db.session.add_all([
+            Message(text="The big cat sat", user_id=john.id,
+                    timestamp=datetime(2023, 1, 1)),
+            Message(text="A cat, big and fat", user_id=bob.id,
+                    timestamp=datetime(2023, 1, 2)),
+            Message(text="Bigger cats", user_id=bob.id,
+                    timestamp=datetime(2023, 1, 3)),
+        ])
+        db.session.commit()
+
+        def texts(q, **kwargs):
+            return [msg.text for msg in search_messages(q, **kwargs).items]
+
+        self.assertEqual(texts("big cat"),
+                         ["A cat, big and fat", "The big cat sat"])
+        self.assertEqual(texts('"big cat"'), ["The big cat sat"])
+        self.assertEqual(texts('"big* cat*"'),
+                         ["Bigger cats", "The big cat sat"])
+        self.assertEqual(texts("dog"), [])
+
+        alice = User.query.filter_by(username="alice").one()
+        alice.following.append(bob)
+        db.session.commit()
+
+        self.assertEqual(texts("cat*", following=alice),
+                         ["Bigger cats", "A cat, big and fat"])
+
+    def test_message_pagination(self):
+        """Cursors page through message results"""
+        john = User.query.filter_by(username="john_smith").one()
+        db.session.add_all([
+            Message(text=f"hello {i}", user_id=john.id) for i in range(5)
+        ])
+        db.session.commit()
+
+        page = search_messages("hello", per_page=3)
+        self.assertEqual(len(page.items), 3)
+
+        page = search_messages("hello", page.next_cursor, per_page=3)
+        self.assertEqual(len(page.items), 2)
+        self.assertIsNone(page.next_cursor)
+
+
+class PostgresSearchTestCase(SearchTests, TestCase):
+    app = app
+
+
+class SQLiteSearchTestCase(SearchTests, TestCase):
+    app = sqlite_app
@@ -0,0 +1,144 @@
+"""User cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_user_cache.py
+
+
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from sqlalchemy import select
+
+from models import db, User, Message, Like
+from user_cache import LRUCache, FileCache
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, user_cache
+
+db.drop_all()
+db.create_all()
+
+
+class CacheBackendTestCase(TestCase):
+    def test_lru_eviction(self):
+        """Least recently used entries are evicted past max_size"""
+        cache = LRUCache(max_size=2, ttl=60)
+        cache.set(1, 'one')
+        cache.set(2, 'two')
+        cache.get(1)
+        cache.set(3, 'three')
+
+        self.assertEqual(cache.get(1), 'one')
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(3), 'three')
+
+    def test_lru_ttl(self):
+        """Entries expire after the TTL"""
+        cache = LRUCache(ttl=0)
+        cache.set(1, 'one')
+        time.sleep(0.01)
+
+        self.assertIsNone(cache.get(1))
+
+    def test_file_cache(self):
+        """File backed entries are shared, deletable and expire"""
+        with tempfile.TemporaryDirectory() as directory:
+            cache = FileCache(directory, ttl=60)
+            cache.set(1, {'username': 'u1'})
+
+            self.assertEqual(FileCache(directory).get(1), {'username': 'u1'})
+
+            cache.delete(1)
+            self.assertIsNone(cache.get(1))
+
+            FileCache(directory, ttl=-1).set(2, 'expired')
+            self.assertIsNone(cache.get(2))
+
+
+class UserCacheTestCase(TestCase):
+    def setUp(self):
+        Like.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+
+        user_cache.local.clear()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_load_from_cache(self):
+        """A cached user is rebuilt without querying the database"""
+        user_cache.load(self.u1_id)
+        db.session.expunge_all()
+
+        user = user_cache.load(self.u1_id)
+
+        self.assertEqual(user.username, "u1")
+        self.assertIn(user, db.session)
+
+    def test_password_not_cached(self):
+        """Cached rows leave out the password hash, loaded when used"""
+        user_cache.load(self.u1_id)
+        self.assertNotIn('password', user_cache.get_row(self.u1_id))
+
+        db.session.expunge_all()
+        user = user_cache.load(self.u1_id)
+
+        self.assertTrue(user.password.startswith("$2b$"))
+
+    def test_commit_invalidates(self):
+        """Committing a change to a user drops their cached row"""
+        user = user_cache.load(self.u1_id)
+        self.assertIsNotNone(user_cache.get_row(self.u1_id))
+
+        user.bio = "changed"
+        db.session.commit()
+
+        self.assertIsNone(user_cache.get_row(self.u1_id))
+
+    def test_counter_update_invalidates(self):
+        """Bumping a user's counters drops their cached row"""
+        user_cache.load(self.u1_id)
+
+        User.adjust_counts([self.u1_id], messages_count=1)
+        db.session.commit()
+
+        self.assertIsNone(user_cache.get_row(self.u1_id))
+
+    def test_selected_counter_update_invalidates(self):
+        """Counters bumped for a select of users drop those users' rows"""
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+        msg = Message(text="hello", user_id=u2.id)
+        db.session.add(msg)
+        db.session.flush()
+        Like.create_like(user_id=self.u1_id, message_id=msg.id)
+        db.session.commit()
+
+        user_cache.load(self.u1_id)
+
+        User.release_likes_of([msg.id])
+        db.session.commit()
+        self.assertIsNone(user_cache.get_row(self.u1_id))
+
+        user_cache.load(self.u1_id)
+
+        User.adjust_counts(select(User.id).where(User.username == "u1"),
+                           messages_count=1)
+        db.session.commit()
+        self.assertIsNone(user_cache.get_row(self.u1_id))
@@ -5,9 +5,13 @@
 
 
 import os
+import subprocess
+import sys
+import textwrap
 from unittest import TestCase
 
-from models import db, bcrypt, User, Message, Follow, Like
+from models import db, bcrypt, hasher, User, Message, Follow, Like
+from hashing import HashQueueFull, PasswordHasher
 from sqlalchemy.exc import IntegrityError
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -82,6 +86,20 @@ class UserModelTestCase(TestCase):
 
         self.assertEqual(u1.is_followed_by(u2), True)
 
+    def test_following_ids_among(self):
+        """Test batched follow lookups return only followed candidates"""
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+
+        self.assertEqual(u1.following_ids_among([self.u2_id]), set())
+        u1.following.append(u2)
+        db.session.commit()
+
+        self.assertEqual(
+            u1.following_ids_among([self.u1_id, self.u2_id, 0]),
+            {self.u2_id})
+        self.assertEqual(u1.following_ids_among([]), set())
+
     def test_user_signup(self):
         """Test whether we can successfully make a new user with valid credentials"""
 
@@ -115,4 +133,116 @@ class UserModelTestCase(TestCase):
         self.assertFalse(login_attempt)
 
         login_attempt = User.authenticate(u1.username, "bad_password")
-        self.assertFalse(login_attempt)
\ No newline at end of file
+        self.assertFalse(login_attempt)
+
+    def test_reconcile_counts(self):
+        """Test reconcile_counts repairs drifted counters"""
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+
+        u1.following.append(u2)
+        db.session.add(Message(text="uncounted", user_id=self.u1_id))
+        db.session.commit()
+
+        self.assertEqual(User.reconcile_counts(), 2)
+        db.session.commit()
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+        self.assertEqual(u1.following_count, 1)
+        self.assertEqual(u1.messages_count, 1)
+        self.assertEqual(u2.followers_count, 1)
+
+        self.assertEqual(User.reconcile_counts(), 0)
+
+    def test_authenticate_rehashes(self):
+        """Test logging in upgrades hashes made with an old cost factor"""
+        rounds = hasher.rounds
+        hasher.rounds = 4
+
+        try:
+            user = User.authenticate("u1", "password")
+            db.session.commit()
+
+            self.assertTrue(user.password.startswith("$2b$04$"))
+            self.assertEqual(User.authenticate("u1", "password"), user)
+        finally:
+            hasher.rounds = rounds
+
+
+class PasswordHasherTestCase(TestCase):
+    def test_inline_hashing(self):
+        """Test hashing and checking without a process pool"""
+        inline = PasswordHasher(rounds=4, workers=0)
+        hashed = inline.generate("password")
+
+        self.assertTrue(inline.check(hashed, "password"))
+        self.assertFalse(inline.check(hashed, "bad_password"))
+        self.assertEqual(inline.stats()['hashes'], 3)
+        self.assertFalse(inline.needs_rehash(hashed))
+
+    def test_queue_full(self):
+        """Test hashing fails fast once the queue is full"""
+        full = PasswordHasher(rounds=4, workers=0, max_pending=1,
+                              queue_timeout=0)
+        full._slots.acquire()
+
+        self.assertRaises(HashQueueFull, full.generate, "password")
+        self.assertEqual(full.stats()['rejected'], 1)
+
+    def test_shared_pool(self):
+        """Test processes forked after share_pool hash on its pool"""
+        shared = PasswordHasher(rounds=4, workers=1)
+        shared.share_pool()
+
+        try:
+            read_fd, write_fd = os.pipe()
+            pid = os.fork()
+
+            if pid == 0:
+                # The child hashes through the pool, and reports the result
+                try:
+                    os.write(write_fd, shared.generate("password").encode())
+                finally:
+                    os._exit(0)
+
+            os.close(write_fd)
+            os.waitpid(pid, 0)
+            with os.fdopen(read_fd) as pipe:
+                hashed = pipe.read()
+
+            self.assertTrue(shared.check(hashed, "password"))
+            self.assertIsNot(shared._pool, None)
+        finally:
+            shared.stop_pool()
+
+    def test_shared_pool_exits(self):
+        """Test processes that used the shared pool exit once it's stopped,
+        including ones that outlive it"""
+        script = textwrap.dedent("""
+            import os, sys
+            from hashing import PasswordHasher
+
+            hasher = PasswordHasher(rounds=4, workers=1)
+            hasher.share_pool()
+            hasher.check(hasher.generate("password"), "password")
+
+            read_fd, write_fd = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(write_fd)
+                hasher.generate("password")
+                os.read(read_fd, 1)
+                sys.exit(0)
+
+            os.close(read_fd)
+            hasher.stop_pool()
+            os.close(write_fd)
+            os.waitpid(pid, 0)
+        """)
+
+        result = subprocess.run([sys.executable, "-c", script],
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                timeout=60)
+
+        self.assertEqual(result.returncode, 0)
@@ -19,7 +19,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, MESSAGES_PER_PAGE
 
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
@@ -217,6 +217,41 @@ class UserInfoViewTestCase(UserBaseViewTestCase):
             self.assertIn("@u1", html)
             self.assertIn("@u2", html)
 
+    def test_search_users(self):
+        """Test searching the list of users."""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get('/users?q=U1')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("@u1", html)
+            self.assertNotIn("@u2", html)
+
+            resp = c.get('/users?q=nobody')
+            self.assertIn("Sorry, no users found", resp.get_data(as_text=True))
+
+    def test_autocomplete_users(self):
+        """Test username suggestions as JSON."""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get('/users/autocomplete?q=u')
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(
+                sorted(user['username'] for user in resp.json), ['u1', 'u2'])
+
+    def test_autocomplete_logged_out(self):
+        """Test username suggestions need a login."""
+        with self.client as c:
+            resp = c.get('/users/autocomplete?q=u')
+
+            self.assertEqual(resp.status_code, 401)
+
     def test_show_users_logged_out(self):
         """Test showing users if logged out"""
         with self.client as c:
@@ -239,6 +274,46 @@ class UserInfoViewTestCase(UserBaseViewTestCase):
             self.assertIn('Edit Profile', html)
             self.assertIn('Delete Profile', html)
 
+    def test_user_profile_pagination(self):
+        """Test profile messages are paged with a cursor"""
+        db.session.add_all([
+            Message(text=f"paged-{i}", user_id=self.u1_id)
+            for i in range(MESSAGES_PER_PAGE)
+        ])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f'/users/{self.u1_id}')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(html.count('class="list-group-item"'),
+                             MESSAGES_PER_PAGE)
+            self.assertIn('data-next-cursor', html)
+
+            cursor = html.split('data-next-cursor="')[1].split('"')[0]
+            resp = c.get(f'/users/{self.u1_id}?cursor={cursor}',
+                         headers={'Accept': 'application/json'})
+            data = resp.get_json()
+
+            self.assertEqual(data['html'].count('class="list-group-item"'), 2)
+            self.assertIsNone(data['next_cursor'])
+
+    def test_user_profile_bad_cursor(self):
+        """Test a malformed cursor starts again from the first page"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f'/users/{self.u1_id}?cursor=not-a-cursor')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("m1-text", html)
+
     def test_logged_out_profile(self):
         """Test profile redirect when user is logged out"""
         with self.client as c:
@@ -320,6 +395,25 @@ class UserInfoViewTestCase(UserBaseViewTestCase):
             self.assertIn('@u2', html)
             self.assertIn('Follow', html)
 
+    def test_follow_lists_hide_deleted(self):
+        """Tombstoned users are left out of following and followers lists"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            u1 = User.query.get(self.u1_id)
+            u2 = User.query.get(self.u2_id)
+            u1.following.append(u2)
+            u1.followers.append(u2)
+            u2.tombstone()
+            db.session.commit()
+
+            for url in (f'/users/{self.u1_id}/following',
+                        f'/users/{self.u1_id}/followers'):
+                resp = c.get(url)
+                self.assertEqual(resp.status_code, 200)
+                self.assertNotIn('@u2', resp.get_data(as_text=True))
+
     def test_logged_out_followers(self):
         """Test followers page redirect when user is logged out"""
         with self.client as c:
@@ -344,6 +438,26 @@ class UserInfoViewTestCase(UserBaseViewTestCase):
             self.assertIn('@u2', html)
             self.assertIn('Unfollow', html)
 
+    def test_follow_counters(self):
+        """Test following and unfollowing keep the follow counters in step"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f'/users/follow/{self.u2_id}')
+
+            u1 = User.query.get(self.u1_id)
+            u2 = User.query.get(self.u2_id)
+            self.assertEqual(u1.following_count, 1)
+            self.assertEqual(u2.followers_count, 1)
+
+            c.post(f'/users/stop-following/{self.u2_id}')
+
+            u1 = User.query.get(self.u1_id)
+            u2 = User.query.get(self.u2_id)
+            self.assertEqual(u1.following_count, 0)
+            self.assertEqual(u2.followers_count, 0)
+
     def test_follow_logged_out(self):
         """Test add follower post request when user is logged out"""
         with self.client as c:
@@ -478,6 +592,53 @@ class UserInfoViewTestCase(UserBaseViewTestCase):
             self.assertEqual(len(Message.query.all()), 0)
             self.assertEqual(len(Like.query.all()), 0)
 
+            # u2's like of u1's message is taken out of their counter
+            self.assertEqual(User.query.get(self.u2_id).likes_count, 0)
+
+    def test_delete_large_user_in_background(self):
+        """Test large accounts are tombstoned, then purged by a command"""
+        threshold = app.config['PURGE_IN_BACKGROUND_MESSAGES']
+        batch_size = app.config['PURGE_BATCH_SIZE']
+        app.config['PURGE_IN_BACKGROUND_MESSAGES'] = 0
+        app.config['PURGE_BATCH_SIZE'] = 1
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1_id
+
+                c.post('/users/delete')
+
+                self.assertIsNotNone(User.query.get(self.u1_id).deleted_at)
+                self.assertEqual(len(Message.query.all()), 2)
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u2_id
+
+                resp = c.get(f'/users/{self.u1_id}')
+                self.assertEqual(resp.status_code, 404)
+
+                resp = c.get('/users')
+                self.assertNotIn("@u1", resp.get_data(as_text=True))
+
+                with c.session_transaction() as sess:
+                    del sess[CURR_USER_KEY]
+
+                resp = c.post('/login', data={
+                    'username': 'u1', 'password': 'password'})
+                self.assertIn("Invalid credentials", resp.get_data(as_text=True))
+
+            result = app.test_cli_runner().invoke(args=['purge-deleted-users'])
+            self.assertIn("Purged 1 deleted user(s).", result.output)
+
+            self.assertIsNone(User.query.get(self.u1_id))
+            self.assertEqual(len(Message.query.all()), 0)
+            self.assertEqual(len(Like.query.all()), 0)
+            self.assertEqual(User.query.get(self.u2_id).likes_count, 0)
+        finally:
+            app.config['PURGE_IN_BACKGROUND_MESSAGES'] = threshold
+            app.config['PURGE_BATCH_SIZE'] = batch_size
+
     def test_delete_user_logged_out(self):
         """Test a failed user delete request (when there is noone logged in)"""
         with self.client as c:
@@ -0,0 +1,297 @@
+"""Materialized home timelines ("inboxes") for Warbler.
+
+When a message is posted it is fanned out on write: a row is added to the
+`timelines` table for the author and for each of their followers, so the
+homepage is a single indexed range read over the viewer's inbox.
+
+Authors with a very large following are not fanned out (one post would mean
+writing a row per follower). Their messages are merged into the timeline when
+it is read instead (fan out on read). An author switches to fan out on read
+once followed by FANOUT_FOLLOWER_LIMIT users, and back only once fewer than
+FANOUT_RESUME_LIMIT follow them, well below it, so an author whose following
+hovers around the limit doesn't switch back and forth.
+
+Switching back means copying the author's recent messages into every
+follower's inbox, as those posted meanwhile are in none: far too many rows
+to write in a request, so it's left to `flask backfill-timelines` (see
+backfill_dropped_author), run periodically. Until then the author stays
+fanned out on read.
+"""
+
+from sqlalchemy import delete, desc, literal, select, true, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import joinedload
+
+from models import db, Follow, Message, TimelineEntry, User
+from pagination import after_cursor, decode_cursor, page_of, page_query
+
+# Authors with at least this many followers are fanned out on read
+FANOUT_FOLLOWER_LIMIT = 10000
+
+# Authors fanned out on read go back to fan out on write once they have
+# fewer than this many followers
+FANOUT_RESUME_LIMIT = 9000
+
+# How many of an author's recent messages to copy in on a new follow
+BACKFILL_LIMIT = 100
+
+# Most messages sent to a browser catching up on its home timeline
+CATCH_UP_LIMIT = 50
+
+# The home timeline's order. Inbox entries copy their message's timestamp,
+# so these are also the inbox's (timestamp, message_id).
+TIMELINE_KEYS = (Message.timestamp, Message.id)
+
+
+def high_fanout_ids(user_ids):
+    """Return the ids in `user_ids` whose messages are fanned out on read."""
+
+    return (select(User.id)
+            .where(User.id.in_(user_ids), User.fanout_on_read))
+
+
+def is_high_fanout(user_id):
+    """Is `user_id` followed by enough users to skip fan out on write?"""
+
+    return db.session.execute(high_fanout_ids([user_id])).first() is not None
+
+
+def mark_high_fanout(author_id):
+    """Switch `author_id` to fan out on read if they've reached the limit.
+
+    Call after their followers_count has been adjusted for a new follower.
+    """
+
+    db.session.execute(
+        update(User)
+        .where(User.id == author_id,
+               User.followers_count >= FANOUT_FOLLOWER_LIMIT,
+               User.fanout_on_read.is_(False))
+        .values(fanout_on_read=True)
+        .execution_options(synchronize_session=False))
+
+
+def fan_out_message(msg):
+    """Add a newly posted (and flushed) message to the relevant inboxes."""
+
+    db.session.execute(insert(TimelineEntry).values(
+        user_id=msg.user_id,
+        message_id=msg.id,
+        timestamp=msg.timestamp,
+    ))
+
+    if is_high_fanout(msg.user_id):
+        return
+
+    followers = (select(Follow.user_following_id,
+                        literal(msg.id),
+                        literal(msg.timestamp))
+                 .where(Follow.user_being_followed_id == msg.user_id,
+                        Follow.user_following_id != msg.user_id))
+
+    db.session.execute(
+        insert(TimelineEntry)
+        .from_select(['user_id', 'message_id', 'timestamp'], followers))
+
+
+def backfill_author(user_id, author_id):
+    """Copy recent messages of a newly followed author into an inbox."""
+
+    # A user's own messages are always in their inbox already
+    if user_id == author_id or is_high_fanout(author_id):
+        return
+
+    recent = (select(literal(user_id), Message.id, Message.timestamp)
+              .where(Message.user_id == author_id)
+              .order_by(Message.timestamp.desc())
+              .limit(BACKFILL_LIMIT))
+
+    db.session.execute(
+        insert(TimelineEntry)
+        .from_select(['user_id', 'message_id', 'timestamp'], recent))
+
+
+def dropped_author_ids():
+    """Select the ids of authors fanned out on read who are now followed by
+    fewer than FANOUT_RESUME_LIMIT users."""
+
+    return (select(User.id)
+            .where(User.fanout_on_read,
+                   User.followers_count < FANOUT_RESUME_LIMIT))
+
+
+def backfill_dropped_author(author_id):
+    """Switch `author_id` from fan out on read back to fan out on write,
+    copying their recent messages into their followers' inboxes.
+
+    Returns whether they were switched: not if they've since gained
+    followers again. Locks the author's row until the transaction ends;
+    posting a message updates it before fanning out, so each new message
+    is either copied here or fanned out as it's posted.
+    """
+
+    dropped = db.session.execute(
+        dropped_author_ids()
+        .where(User.id == author_id)
+        .with_for_update()).first()
+
+    if dropped is None:
+        return False
+
+    recent = (select(Message.id, Message.timestamp)
+              .where(Message.user_id == author_id)
+              .order_by(Message.timestamp.desc())
+              .limit(BACKFILL_LIMIT)
+              .subquery())
+
+    followers = (select(Follow.user_following_id,
+                        recent.c.id,
+                        recent.c.timestamp)
+                 .join(recent, true())
+                 .where(Follow.user_being_followed_id == author_id,
+                        Follow.user_following_id != author_id))
+
+    # Messages posted before the author was fanned out on read are already
+    # in their followers' inboxes
+    db.session.execute(
+        insert(TimelineEntry)
+        .from_select(['user_id', 'message_id', 'timestamp'], followers)
+        .on_conflict_do_nothing())
+
+    db.session.execute(
+        update(User)
+        .where(User.id == author_id)
+        .values(fanout_on_read=False)
+        .execution_options(synchronize_session=False))
+
+    return True
+
+
+def remove_author(user_id, author_id):
+    """Remove an unfollowed author's messages from an inbox."""
+
+    authored = select(Message.id).where(Message.user_id == author_id)
+
+    db.session.execute(
+        delete(TimelineEntry)
+        .where(TimelineEntry.user_id == user_id,
+               TimelineEntry.message_id.in_(authored)))
+
+
+def remove_message(message_id):
+    """Remove a deleted message from every inbox."""
+
+    db.session.execute(
+        delete(TimelineEntry)
+        .where(TimelineEntry.message_id == message_id))
+
+
+def followed_ids(user_id):
+    """Select the ids of the authors `user_id` follows."""
+
+    return (select(Follow.user_being_followed_id)
+            .where(Follow.user_following_id == user_id))
+
+
+def pulled_author_ids(user_id):
+    """Select the ids of authors `user_id` follows who are fanned out on
+    read."""
+
+    return high_fanout_ids(followed_ids(user_id))
+
+
+def home_timeline_query(user_id, pulled_ids, cursor=None, per_page=50):
+    """Select a page of messages on `user_id`'s home timeline, with their
+    authors, for page_of(results, TIMELINE_KEYS, per_page).
+
+    Reads the materialized inbox, merging in messages from the followed
+    authors in `pulled_ids` (see pulled_author_ids()).
+    """
+
+    inbox_keys = (TimelineEntry.timestamp, TimelineEntry.message_id)
+
+    if not pulled_ids:
+        inbox = (select(Message)
+                 .options(joinedload(Message.user))
+                 .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+                 .where(TimelineEntry.user_id == user_id))
+
+        return page_query(inbox, inbox_keys, cursor, per_page)
+
+    inbox_ids = (select(TimelineEntry.message_id)
+                 .where(TimelineEntry.user_id == user_id))
+
+    values = decode_cursor(cursor, inbox_keys)
+    if values is not None:
+        inbox_ids = inbox_ids.where(after_cursor(inbox_keys, values))
+
+    inbox_ids = (inbox_ids
+                 .order_by(TimelineEntry.timestamp.desc(),
+                           TimelineEntry.message_id.desc())
+                 .limit(per_page + 1))
+
+    merged = (select(Message)
+              .options(joinedload(Message.user))
+              .where((Message.id.in_(inbox_ids)) |
+                     (Message.user_id.in_(pulled_ids))))
+
+    return page_query(merged, TIMELINE_KEYS, cursor, per_page)
+
+
+def timeline_ids_after(user_id, pulled_ids, message_id,
+                       limit=CATCH_UP_LIMIT):
+    """Select the ids of the newest `limit` messages on `user_id`'s home
+    timeline posted after `message_id`, newest first.
+
+    For catching up on messages missed while not subscribed to new ones
+    (see pubsub.py). `pulled_ids` are as for home_timeline_query().
+    """
+
+    ids = (select(TimelineEntry.message_id.label('id'))
+           .where(TimelineEntry.user_id == user_id,
+                  TimelineEntry.message_id > message_id))
+
+    if pulled_ids:
+        ids = ids.union_all(
+            select(Message.id)
+            .where(Message.user_id.in_(pulled_ids),
+                   Message.id > message_id))
+
+    return ids.order_by(desc('id')).limit(limit)
+
+
+def home_timeline(user, cursor=None, per_page=50):
+    """Return a Page of messages on `user`'s home timeline, newest first."""
+
+    pulled_ids = db.session.scalars(pulled_author_ids(user.id)).all()
+    query = home_timeline_query(user.id, pulled_ids, cursor, per_page)
+
+    return page_of(db.session.scalars(query).all(), TIMELINE_KEYS, per_page)
+
+
+def rebuild_timelines():
+    """Rebuild every inbox from scratch (e.g. after bulk seeding), fanning
+    out on read exactly the authors at or over FANOUT_FOLLOWER_LIMIT."""
+
+    high_fanout = User.followers_count >= FANOUT_FOLLOWER_LIMIT
+
+    db.session.execute(
+        update(User)
+        .where(User.fanout_on_read != high_fanout)
+        .values(fanout_on_read=high_fanout)
+        .execution_options(synchronize_session=False))
+
+    db.session.execute(delete(TimelineEntry))
+
+    own = select(Message.user_id, Message.id, Message.timestamp)
+
+    followed = (select(Follow.user_following_id, Message.id, Message.timestamp)
+                .join(Message, Message.user_id == Follow.user_being_followed_id)
+                .where(Follow.user_following_id != Message.user_id,
+                       Message.user_id.not_in(
+                    high_fanout_ids(select(User.id)))))
+
+    for rows in (own, followed):
+        db.session.execute(
+            insert(TimelineEntry)
+            .from_select(['user_id', 'message_id', 'timestamp'], rows))
@@ -0,0 +1,242 @@
+"""Cache of logged-in users' rows, so requests can skip loading g.user.
+
+Every request loads the current user from the session cookie. UserCache
+keeps each user's column values in an in-process LRU, optionally backed by a
+store shared by all worker processes on the host (FileCache), and rebuilds
+the User from them without a round trip to the database.
+
+Rows leave out the password hash, which only logging in and a few forms
+need; a cached user loads it from the database if it's used.
+
+Entries expire after a TTL and are invalidated whenever a commit changes the
+user: rows flushed as dirty or deleted, and counters bumped with
+User.adjust_counts. A process only sees its own invalidations in its LRU, so
+with several workers the TTL bounds how stale another worker's copy can be;
+use a shared backend and a short TTL there.
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from itertools import chain
+
+from sqlalchemy import event
+from sqlalchemy.orm import make_transient_to_detached
+
+from models import db, User, CHANGED_USER_IDS
+
+# The columns cached of each user: all but the password hash, which is kept
+# out of every cache level (FileCache writes rows to disk)
+CACHED_COLUMNS = [column.key for column in User.__table__.columns
+                  if column.key != 'password']
+
+
+def row_of(user):
+    """Return the column values of `user` to cache."""
+
+    return {key: getattr(user, key) for key in CACHED_COLUMNS}
+
+
+class LRUCache:
+    """Thread-safe in-process LRU cache with a per-entry TTL."""
+
+    def __init__(self, max_size=10000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the value cached for `key`, or None if missing/expired."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                return None
+
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Cache `value` for `key`, evicting the least recently used entry."""
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Drop `key` from the cache, if present."""
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Drop every entry."""
+
+        with self._lock:
+            self._entries.clear()
+
+
+class FileCache:
+    """Cache shared between processes on one host, as JSON files in a directory.
+
+    Writes go to a temporary file that is atomically renamed into place, so
+    readers never see a partial entry.
+    """
+
+    def __init__(self, directory, ttl=60):
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        """Return the value cached for `key`, or None if missing/expired."""
+
+        try:
+            with open(self._path(key)) as entry_file:
+                entry = json.load(entry_file)
+        except (OSError, ValueError):
+            return None
+
+        if entry['expires'] < time.time():
+            self.delete(key)
+            return None
+
+        return entry['value']
+
+    def set(self, key, value):
+        """Cache `value` (which must be JSON serializable) for `key`."""
+
+        entry = {'expires': time.time() + self.ttl, 'value': value}
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'w') as tmp_file:
+            json.dump(entry, tmp_file)
+
+        os.replace(tmp_path, self._path(key))
+
+    def delete(self, key):
+        """Drop `key` from the cache, if present."""
+
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        """Drop every entry."""
+
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                self.delete(name[:-len('.json')])
+
+
+class UserCache:
+    """Two-level cache of User rows: a local LRU in front of a shared store."""
+
+    def __init__(self, local, shared=None):
+        self.local = local
+        self.shared = shared
+
+    @classmethod
+    def from_config(cls, config):
+        """Build a cache from USER_CACHE_SIZE, USER_CACHE_TTL and USER_CACHE_DIR."""
+
+        ttl = config['USER_CACHE_TTL']
+        local = LRUCache(max_size=config['USER_CACHE_SIZE'], ttl=ttl)
+
+        shared = None
+        if config.get('USER_CACHE_DIR'):
+            shared = FileCache(config['USER_CACHE_DIR'], ttl=ttl)
+
+        return cls(local, shared)
+
+    def get_row(self, user_id):
+        """Return the cached column values for `user_id`, or None."""
+
+        row = self.local.get(user_id)
+
+        if row is None and self.shared is not None:
+            row = self.shared.get(user_id)
+            if row is not None:
+                self.local.set(user_id, row)
+
+        return row
+
+    def set_row(self, user_id, row):
+        """Cache the column values of a user in every level."""
+
+        self.local.set(user_id, row)
+        if self.shared is not None:
+            self.shared.set(user_id, row)
+
+    def invalidate(self, user_id):
+        """Drop a user from every level, e.g. after they were changed."""
+
+        self.local.delete(user_id)
+        if self.shared is not None:
+            self.shared.delete(user_id)
+
+    def load(self, user_id):
+        """Return the User for `user_id`, from the cache when possible.
+
+        A cached user is merged into the session without a SELECT, so it
+        behaves like a loaded instance: relationships and the password hash
+        lazy load, and changes are flushed as usual.
+
+        Returns None if there's no such user, or their account has been
+        deleted (see User.tombstone).
+        """
+
+        row = self.get_row(user_id)
+
+        if row is None:
+            user = db.session.get(User, user_id)
+
+            if user is None or user.deleted_at is not None:
+                return None
+
+            self.set_row(user_id, row_of(user))
+
+            return user
+
+        user = User(**row)
+        make_transient_to_detached(user)
+
+        return db.session.merge(user, load=False)
+
+    def watch(self, session):
+        """Invalidate users changed by transactions committed on `session`."""
+
+        @event.listens_for(session, 'after_flush')
+        def collect_changed_users(session, flush_context):
+            changed = session.info.setdefault(CHANGED_USER_IDS, set())
+            changed.update(
+                obj.id
+                for obj in chain(session.dirty, session.deleted)
+                if isinstance(obj, User)
+            )
+
+        @event.listens_for(session, 'after_commit')
+        def invalidate_changed_users(session):
+            for user_id in session.info.pop(CHANGED_USER_IDS, ()):
+                self.invalidate(user_id)
+
+        @event.listens_for(session, 'after_rollback')
+        def forget_changed_users(session):
+            session.info.pop(CHANGED_USER_IDS, None)